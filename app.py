@@ -1,3 +1,4 @@
+import io
 import os
 import uuid
 import shutil
@@ -5,7 +6,8 @@ import traceback  # Add this import at the top
 
 import time
 import threading
-from flask import Flask, request, jsonify, send_from_directory
+import json
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 import torch
@@ -13,14 +15,20 @@ from torchvision import transforms
 import numpy as np
 from PIL import Image
 import tifffile
-import matplotlib.pyplot as plt
-from models.features import MultimodalFeatures
+from models.model_registry import ModelRegistry, calibration_batches
 import torch.nn as nn
 import torch.nn.functional as F
 import tifffile as tiff
 import torch
-# Import required model classes from infer.py
-from infer import FusionEncoder, DecoupledDecoder, set_seeds
+# Import the inference helpers from infer.py
+from infer import set_seeds, compute_residuals, compute_residuals_fused, compute_residuals_multi
+from utils.batching_utils import DynamicBatcher
+from utils.feature_cache_utils import FeatureCache
+from utils.tiling_utils import TileStitcher, extract_tiles, pad_to_tile, tile_grid
+from utils.rendering_utils import colorize, denormalize_rgb, overlay, save_colorized, write_png
+from utils.result_encoding_utils import MAP_DTYPES, encode_map, npz_payload, quantize_map
+from models import features as features_config
+from utils.jobs_utils import JobQueue, QueueFullError
 
 app = Flask(__name__)
 CORS(app)
@@ -29,12 +37,89 @@ CORS(app)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 UPLOAD_FOLDER = os.path.join(BASE_DIR, 'temp_input')
 OUTPUT_FOLDER = os.path.join(BASE_DIR, 'temp_output')
-CHECKPOINT_FOLDER = os.path.join(BASE_DIR, 'checkpoints', 'General')
+# CFM checkpoints: the pretrained ones by default, or e.g. the output folder of train.py
+CHECKPOINT_FOLDER = os.environ.get('CHECKPOINT_FOLDER', os.path.join(BASE_DIR, 'checkpoints', 'General'))
+
+# Memory budget (in MB) for the per-class CFM heads kept resident by the model registry
+CFM_CACHE_MB = float(os.environ.get('CFM_CACHE_MB', 1024))
+# Largest share of that budget a stack of heads (multi-class scoring) may take in the cache, larger stacks are
+# rebuilt per request instead of evicting the per-class heads
+CFM_STACKED_FRACTION = float(os.environ.get('CFM_STACKED_FRACTION', 0.5))
+
+# Epochs and batch size in the file names of the CFM checkpoints (see train.py --checkpoint_name_ep / --checkpoint_name_bs)
+CFM_EPOCHS_NO = int(os.environ.get('CFM_EPOCHS_NO', 100))
+CFM_BATCH_SIZE = int(os.environ.get('CFM_BATCH_SIZE', 1))
+
+# Run the CFM heads through their fused inference export (validated against the modules when loaded)
+FUSE_CFM_HEADS = os.environ.get('FUSE_CFM_HEADS', '1') == '1'
+
+# Run the CFM heads on the foreground rows only (the ones with a 3D feature): same combined residual and scores,
+# but the 2D residual maps are zero on the background
+SPARSE_RESIDUALS = os.environ.get('SPARSE_RESIDUALS', '0') == '1'
+
+# Inference precision of the backbones and heads: fp32, bf16, int8 (dynamic) or int8-static, which calibrates on
+# CALIBRATION_SAMPLES training samples of the MVTec 3D-AD / Eyecandies dataset at CALIBRATION_DATASET_PATH
+PRECISION = os.environ.get('PRECISION', 'fp32')
+CALIBRATION_DATASET_PATH = os.environ.get('CALIBRATION_DATASET_PATH')
+CALIBRATION_SAMPLES = int(os.environ.get('CALIBRATION_SAMPLES', 8))
+
+# Folder of the TorchScript artifacts written by export_compiled.py, used in fp32 when present
+COMPILED_FOLDER = os.environ.get('COMPILED_FOLDER', os.path.join(BASE_DIR, 'checkpoints', 'compiled'))
+
+# Backbone feature cache: memory budget (in MB), optional directory of the memory-mapped disk tier and its size (in MB, 0 = unbounded)
+FEATURE_CACHE_MB = float(os.environ.get('FEATURE_CACHE_MB', 1024))
+FEATURE_CACHE_DIR = os.environ.get('FEATURE_CACHE_DIR') or None
+FEATURE_CACHE_DISK_MB = float(os.environ.get('FEATURE_CACHE_DISK_MB', 0)) or None
+
+# Dynamic micro-batching: maximum samples per backbone pass and how long to wait for more requests
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 8))
+BATCH_WAIT_MS = float(os.environ.get('BATCH_WAIT_MS', 10))
+
+# Asynchronous job mode: number of worker threads and how many jobs may wait before new ones are rejected
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 32))
+
+# Tiled mode: inputs keep their native resolution and are scored as overlapping backbone-sized tiles.
+# TILE_STRIDE is the default offset between tiles (smaller = more overlap, finer maps, more latency),
+# TILE_BATCH_SIZE the number of tiles of a request queued in the inference batcher at once
+TILE_SIZE = 224
+TILE_STRIDE = int(os.environ.get('TILE_STRIDE', 112))
+TILE_BATCH_SIZE = int(os.environ.get('TILE_BATCH_SIZE', 4))
+
+# Response modes of the inference routes: 'images' renders the four PNGs served from temp_output, 'compact' returns
+# the residual maps (float16 or uint8-quantized) and the anomaly score inline in the JSON, 'npz' as one binary archive
+RESPONSE_MODES = ('images', 'compact', 'npz')
+
+# zlib level of the rendered PNGs (0-9, higher = smaller files, slower), and whether the combined residual is also
+# rendered over the RGB input ('overlay' output)
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', 1))
+RENDER_OVERLAY = os.environ.get('RENDER_OVERLAY', '0') == '1'
+
+# Uploads are decoded in memory; set to spool those larger than this many MB to temp_input instead (0 disables)
+SPOOL_UPLOAD_MB = float(os.environ.get('SPOOL_UPLOAD_MB', 0))
+
+VALID_CLASSES = [
+    "bagel", "cable_gland", "carrot", "cookie", "dowel", "foam", "peach",
+    "potato", "rope", "tire", "CandyCane", "ChocolateCookie", "ChocolatePraline",
+    "Confetto", "GummyBear", "HazelnutTruffle", "LicoriceSandwich", "Lollipop",
+    "Marshmallow", "PeppermintCandy", "Chair"
+]
 
 # Ensure directories exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
+# Shared backbones and LRU cache of per-class CFM heads, reused across requests
+feature_cache = FeatureCache(max_memory_mb=FEATURE_CACHE_MB, disk_dir=FEATURE_CACHE_DIR, max_disk_mb=FEATURE_CACHE_DISK_MB)
+calibration_data = None
+if PRECISION == 'int8-static' and CALIBRATION_DATASET_PATH:
+    calibration_classes = sorted(c for c in os.listdir(CALIBRATION_DATASET_PATH) if c in VALID_CLASSES)
+    calibration_data = calibration_batches(CALIBRATION_DATASET_PATH, calibration_classes, num_samples=CALIBRATION_SAMPLES)
+model_registry = ModelRegistry(CHECKPOINT_FOLDER, max_memory_mb=CFM_CACHE_MB, epochs_no=CFM_EPOCHS_NO,
+                               batch_size=CFM_BATCH_SIZE, feature_cache=feature_cache,
+                               fuse_heads=FUSE_CFM_HEADS, precision=PRECISION, calibration_data=calibration_data,
+                               compiled_folder=COMPILED_FOLDER, max_stacked_fraction=CFM_STACKED_FRACTION)
+
 def organized_pc_to_unorganized_pc(organized_pc):
     return organized_pc.reshape(organized_pc.shape[0] * organized_pc.shape[1], organized_pc.shape[2])
 
@@ -63,83 +148,91 @@ def allowed_image_file(filename):
 def allowed_point_cloud_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'tiff', 'tif', 'ply', 'pcd', 'obj'}
 
-def load_image(image_path, img_size=224):
-    print(f"Loading image from {image_path}")
+def load_image(image_source, img_size=224):
+    """Load an RGB image from a path or a binary file-like object."""
+    size = img_size if isinstance(img_size, tuple) else (img_size, img_size)
     transform = transforms.Compose([
-        transforms.Resize((img_size, img_size)),
+        transforms.Resize(size),
         transforms.ToTensor(),
         transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
     ])
-    image = Image.open(image_path).convert('RGB')
+    image = Image.open(image_source).convert('RGB')
     image = transform(image).unsqueeze(0)
     return image
 
-def load_point_cloud(tiff_path, img_size=224):
-    print(f"Loading point cloud from {tiff_path}")
-    point_cloud = tifffile.imread(tiff_path)
-    point_cloud = torch.tensor(point_cloud, dtype=torch.float32)
+def organized_pc_to_tensor(organized_pc, img_size=224):
+    point_cloud = torch.tensor(organized_pc, dtype=torch.float32)
     if point_cloud.ndim == 2:
         point_cloud = point_cloud.unsqueeze(-1)
     point_cloud = point_cloud.permute(2, 0, 1).unsqueeze(0)
     point_cloud = F.interpolate(point_cloud, size=(img_size, img_size), mode='bilinear', align_corners=False)
     return point_cloud
 
-def infer_single_CFM(rgb_path, tiff_path, class_name, batch_size=1, epochs_no=100):
-    organized_pc = read_tiff_organized_pc(tiff_path)
+def load_point_cloud(tiff_source, img_size=224):
+    """Load a point cloud from the path of a TIFF or a binary file-like object."""
+    return organized_pc_to_tensor(tifffile.imread(tiff_source), img_size=img_size)
+
+def load_sample(rgb_source, tiff_source):
+    """
+    Load an RGB / TIFF pair into the (batch of one) tensors consumed by the inference pipeline.
+
+    Sources are paths or binary file-like objects. The TIFF is decoded once and both the depth map and the point
+    cloud tensor are derived from the same array.
+    """
+    organized_pc = read_tiff_organized_pc(tiff_source)
     depth_map_3channel = np.repeat(organized_pc_to_depth_map(organized_pc)[:, :, np.newaxis], 3, axis=2)
     depth_map = resize_organized_pc(depth_map_3channel)
 
-    print(f"\n=== Starting inference for class: {class_name} ===")
-    print(f"RGB path: {rgb_path} (exists: {os.path.exists(rgb_path)})")
-    print(f"TIFF path: {tiff_path} (exists: {os.path.exists(tiff_path)})")
-    
-    set_seeds()
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    print(f"Using device: {device}")
-
-    # Load models
-    print("Loading models...")
-    fusion_encoder = FusionEncoder(in_features_2D=768, in_features_3D=1152, out_features=960).to(device)
-    decoder_2D = DecoupledDecoder(in_features=960, out_features=768).to(device)
-    decoder_3D = DecoupledDecoder(in_features=960, out_features=1152).to(device)
-
-    model_name = f'{class_name}_{epochs_no}ep_{batch_size}bs'
-    checkpoint_path = os.path.join(CHECKPOINT_FOLDER, class_name)
-    print(f"\nChecking checkpoint files exist:")
-    fusion_checkpoint = os.path.join(checkpoint_path, f'fusion_encoder_{model_name}.pth')
-    decoder_2d_checkpoint = os.path.join(checkpoint_path, f'decoder_2D_{model_name}.pth')
-    decoder_3d_checkpoint = os.path.join(checkpoint_path, f'decoder_3D_{model_name}.pth')
-    print(f"Fusion encoder: {fusion_checkpoint} (exists: {os.path.exists(fusion_checkpoint)})")
-    print(f"Decoder 2D: {decoder_2d_checkpoint} (exists: {os.path.exists(decoder_2d_checkpoint)})")
-    print(f"Decoder 3D: {decoder_3d_checkpoint} (exists: {os.path.exists(decoder_3d_checkpoint)})")
-
-    if not all(os.path.exists(p) for p in [fusion_checkpoint, decoder_2d_checkpoint, decoder_3d_checkpoint]):
-        raise Exception("One or more checkpoint files are missing")
-
-    try:
-        fusion_encoder.load_state_dict(torch.load(fusion_checkpoint))
-        decoder_2D.load_state_dict(torch.load(decoder_2d_checkpoint))
-        decoder_3D.load_state_dict(torch.load(decoder_3d_checkpoint))
-    except Exception as e:
-        raise Exception(f"Failed to load model checkpoints: {str(e)}")
+    return {
+        'rgb': load_image(rgb_source),
+        'pc': organized_pc_to_tensor(organized_pc),
+        'depth_map': depth_map,
+    }
 
-    fusion_encoder.eval()
-    decoder_2D.eval()
-    decoder_3D.eval()
+def load_sample_native(rgb_source, tiff_source):
+    """
+    load_sample without resizing to the backbone input size, for the tiled mode: the point cloud keeps its native
+    resolution and the RGB image is resized to it. Tensors are [1, C, H, W] like load_sample.
+    """
+    organized_pc = read_tiff_organized_pc(tiff_source)
+    height, width = organized_pc.shape[:2]
+    depth_map_3channel = np.repeat(organized_pc_to_depth_map(organized_pc)[:, :, np.newaxis], 3, axis=2)
 
-    # Load input data
-    rgb = load_image(rgb_path).to(device)
-    pc = load_point_cloud(tiff_path).to(device)
+    return {
+        'rgb': load_image(rgb_source, img_size=(height, width)),
+        'pc': torch.tensor(organized_pc, dtype=torch.float32).permute(2, 0, 1).unsqueeze(0),
+        'depth_map': torch.tensor(depth_map_3channel).permute(2, 0, 1).contiguous(),
+    }
 
-    # Feature extractor
-    print("Extracting features...")
-    feature_extractor = MultimodalFeatures()
+def upload_size(file_storage):
+    stream = file_storage.stream
+    position = stream.tell()
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(position)
+    return size
+
+def read_upload(file_storage, input_subfolder, prefix=''):
+    """
+    Return the source the inference pipeline decodes an uploaded file from.
+
+    Uploads are decoded from an in-memory buffer. Only when SPOOL_UPLOAD_MB is set and the upload is larger than
+    that, the file is saved under input_subfolder and its path is returned instead.
+    """
+    size = upload_size(file_storage)
+    if size == 0:
+        raise Exception(f"Uploaded file is empty: {file_storage.filename}")
+
+    if SPOOL_UPLOAD_MB and size > SPOOL_UPLOAD_MB * 1024 * 1024:
+        os.makedirs(input_subfolder, exist_ok=True)
+        path = os.path.join(input_subfolder, prefix + secure_filename(file_storage.filename))
+        file_storage.save(path)
+        print(f"Spooled {file_storage.filename} ({size} bytes) to {path}")
+        return path
 
-    w_l, w_u = 5, 7
-    pad_l, pad_u = 2, 3
-    weight_l = torch.ones(1, 1, w_l, w_l, device=device) / (w_l**2)
-    weight_u = torch.ones(1, 1, w_u, w_u, device=device) / (w_u**2)
+    return io.BytesIO(file_storage.read())
 
+def save_outputs(class_name, rgb, depth_map, residual_2D, residual_comb):
     unique_id = str(uuid.uuid4())
     output_subfolder = os.path.join(OUTPUT_FOLDER, unique_id)
     os.makedirs(output_subfolder, exist_ok=True)
@@ -152,47 +245,20 @@ def infer_single_CFM(rgb_path, tiff_path, class_name, batch_size=1, epochs_no=10
         'combined_residual': os.path.join(output_subfolder, f"{class_name}_combined_residual.png")
     }
 
-
-    with torch.no_grad():
-            rgb_patch, xyz_patch = feature_extractor.get_features_maps(rgb, pc)
-            # Fusion and Restoration
-            fusion_embedding = fusion_encoder(rgb_patch, xyz_patch)
-            restored_2D = decoder_2D(fusion_embedding)
-            restored_3D = decoder_3D(fusion_embedding)
-
-            xyz_mask = (xyz_patch.sum(axis=-1) == 0)  # Mask only the feature vectors that are 0 everywhere
-
-            residual_2D = (restored_2D - rgb_patch).pow(2).sum(1).sqrt()
-            residual_3D = (restored_3D - xyz_patch).pow(2).sum(1).sqrt()
-
-            residual_comb = (residual_2D * residual_3D)
-            residual_comb[xyz_mask] = 0.0
-
-            residual_comb = residual_comb.reshape(1, 1, 224, 224)
-            for _ in range(5):
-                residual_comb = torch.nn.functional.conv2d(input=residual_comb, padding=pad_l, weight=weight_l)
-            for _ in range(3):
-                residual_comb = torch.nn.functional.conv2d(input=residual_comb, padding=pad_u, weight=weight_u)
-            residual_comb = residual_comb.reshape(224, 224)
-
-            denormalize = transforms.Compose([
-                transforms.Normalize(mean=[0., 0., 0.], std=[1/0.229, 1/0.224, 1/0.225]),
-                transforms.Normalize(mean=[-0.485, -0.456, -0.406], std=[1., 1., 1.]),
-            ])
-
-            rgb_img = denormalize(rgb).squeeze().permute(1, 2, 0).cpu().detach().numpy()
-            depth_map = depth_map.squeeze().permute(1, 2, 0).float().mean(axis=-1).cpu().detach().numpy()
-            # depth_map = depth_map.squeeze().permute(1,2,0).mean(axis=-1).cpu().detach().numpy()
-            residual_3D_img = residual_3D.reshape(224, 224).cpu().detach().numpy()
-            residual_2D_img = residual_2D.reshape(224, 224).cpu().detach().numpy()
-            residual_comb_img = residual_comb.reshape(224, 224).cpu().detach().numpy()
-
-            plt.imsave(os.path.join(output_subfolder,  f"{class_name}_rgb_input.png"), rgb_img)
-            plt.imsave(os.path.join(output_subfolder,  f"{class_name}_2d_residual.png"), residual_2D_img, cmap=plt.cm.jet)
-            plt.imsave(os.path.join(output_subfolder,  f"{class_name}_point_cloud.png"), depth_map)
-            plt.imsave(os.path.join(output_subfolder,  f"{class_name}_combined_residual.png"), residual_comb_img, cmap=plt.cm.jet)
-
-
+    rgb_img = denormalize_rgb(rgb.cpu().detach())
+    depth_map = depth_map.squeeze().permute(1, 2, 0).float().mean(axis=-1).cpu().detach().numpy()
+    # depth_map = depth_map.squeeze().permute(1,2,0).mean(axis=-1).cpu().detach().numpy()
+    residual_2D_img = residual_2D.reshape(residual_2D.shape[-2:]).cpu().detach().numpy()
+    residual_comb_img = residual_comb.reshape(residual_comb.shape[-2:]).cpu().detach().numpy()
+
+    # Colormaps through cached lookup tables (the pixels plt.imsave wrote, jet and the default viridis)
+    write_png(output_paths['input_rgb'], rgb_img, PNG_COMPRESS_LEVEL)
+    write_png(output_paths['residual_2d'], colorize(residual_2D_img, 'jet'), PNG_COMPRESS_LEVEL)
+    write_png(output_paths['point_cloud_mean'], colorize(depth_map, 'viridis'), PNG_COMPRESS_LEVEL)
+    write_png(output_paths['combined_residual'], colorize(residual_comb_img, 'jet'), PNG_COMPRESS_LEVEL)
+    if RENDER_OVERLAY:
+        output_paths['overlay'] = os.path.join(output_subfolder, f"{class_name}_overlay.png")
+        write_png(output_paths['overlay'], overlay(rgb_img, residual_comb_img), PNG_COMPRESS_LEVEL)
 
     # # Create output subfolder
     # unique_id = str(uuid.uuid4())
@@ -256,13 +322,241 @@ def infer_single_CFM(rgb_path, tiff_path, class_name, batch_size=1, epochs_no=10
     # plt.savefig(output_paths['combined_residual'], dpi=256)
     # plt.close()
 
-    # Verify files exist
-    for key, path in output_paths.items():
-        if not os.path.exists(path):
-            raise Exception(f"Output file not saved: {path}")
-
     return output_paths
 
+def compact_outputs(class_name, residual_2D, residual_comb):
+    """Raw residual maps of a sample and its anomaly score (maximum of the combined residual), nothing rendered."""
+    residual_2D = residual_2D.reshape(residual_2D.shape[-2:]).numpy()
+    residual_comb = residual_comb.reshape(residual_comb.shape[-2:]).numpy()
+    return {'class_name': class_name, 'score': float(residual_comb.max()),
+            'maps': {'residual_2d': residual_2D, 'combined_residual': residual_comb}}
+
+def sample_outputs(class_name, sample, residual_2D, residual_comb, response='images'):
+    """The output_paths of the rendered PNGs in the 'images' response mode, the compact_outputs otherwise."""
+    if response == 'images':
+        return save_outputs(class_name, sample['rgb'], sample['depth_map'], residual_2D, residual_comb)
+    return compact_outputs(class_name, residual_2D, residual_comb)
+
+def render_maps(outputs):
+    """Write LUT-colorized PNGs of the maps of compact outputs, return their paths relative to BASE_DIR."""
+    output_subfolder = os.path.join(OUTPUT_FOLDER, str(uuid.uuid4()))
+    os.makedirs(output_subfolder, exist_ok=True)
+    file_names = {'residual_2d': '2d_residual', 'combined_residual': 'combined_residual'}
+
+    paths = {}
+    for key, values in outputs['maps'].items():
+        path = os.path.join(output_subfolder, f"{outputs['class_name']}_{file_names[key]}.png")
+        save_colorized(path, values, compress_level=PNG_COMPRESS_LEVEL)
+        paths[key] = os.path.relpath(path, start=BASE_DIR)
+    return paths
+
+def compact_result(outputs, map_dtype='float16', render=False):
+    """JSON result of compact outputs: score and encoded maps, plus the paths of their PNGs when render is set."""
+    result = {'class_name': outputs['class_name'], 'score': outputs['score'],
+              'maps': {key: encode_map(values, map_dtype) for key, values in outputs['maps'].items()}}
+    if render:
+        result['images'] = render_maps(outputs)
+    return result
+
+def npz_arrays(outputs, map_dtype='float16', prefix=''):
+    """Arrays of compact outputs for an npz response, named prefix + score / residual_2d / combined_residual."""
+    arrays = {f'{prefix}score': np.float32(outputs['score'])}
+    for key, values in outputs['maps'].items():
+        array, value_range = quantize_map(values, map_dtype)
+        arrays[prefix + key] = array
+        if value_range is not None:
+            arrays[f'{prefix}{key}_range'] = np.array(value_range, dtype=np.float32)
+    return arrays
+
+def npz_response(arrays):
+    return Response(npz_payload(arrays), mimetype='application/octet-stream',
+                    headers={'Content-Disposition': 'attachment; filename=results.npz'})
+
+def parse_response_options(form):
+    """Read the response / map_dtype / render form fields, raising ValueError on invalid values."""
+    response = form.get('response', 'images')
+    if response not in RESPONSE_MODES:
+        raise ValueError(f'response must be one of {", ".join(RESPONSE_MODES)}')
+    map_dtype = form.get('map_dtype', 'float16')
+    if map_dtype not in MAP_DTYPES:
+        raise ValueError(f'map_dtype must be one of {", ".join(MAP_DTYPES)}')
+    render = form.get('render', '0').lower() in ('1', 'true', 'yes')
+    return response, map_dtype, render
+
+def report_progress(samples, stage):
+    for sample in samples:
+        if sample.get('progress') is not None:
+            sample['progress'](stage)
+
+def heads_residuals(heads, rgb_patch, xyz_patch):
+    """Residual maps of a class, through the fused export of its heads when available."""
+    if heads.fused is not None:
+        return compute_residuals_fused(heads.fused, rgb_patch, xyz_patch, sparse=SPARSE_RESIDUALS)
+    return compute_residuals(*heads, rgb_patch, xyz_patch, sparse=SPARSE_RESIDUALS)
+
+def run_inference_batch(samples):
+    """
+    Run a micro-batch of samples, possibly of different classes.
+
+    The shared backbones process the samples without cached features in a single forward pass, then the samples
+    are grouped by class so that each set of CFM heads runs once on the stacked patch features of its samples.
+    Returns one output_paths dict, or compact_outputs for samples with a 'response' other than 'images' (or the
+    Exception raised for that sample) per sample. Samples with the 'residuals' response get their raw
+    (residual_2D, residual_comb) maps, and samples with the 'features' response (and no class_name) only go
+    through the backbones and get their (rgb_patch, xyz_patch) features.
+    Samples may carry a 'progress' callback, which is called with the name of each stage they enter.
+    """
+    print(f"\n=== Running inference batch of {len(samples)} sample(s) ===")
+    set_seeds()
+    device = model_registry.device
+
+    samples_per_class = {}
+    for i, sample in enumerate(samples):
+        if sample.get('response') != 'features':
+            samples_per_class.setdefault(sample['class_name'], []).append(i)
+
+    results = [None] * len(samples)
+    with torch.no_grad():
+        rgb = torch.cat([sample['rgb'] for sample in samples]).to(device)
+        pc = torch.cat([sample['pc'] for sample in samples]).to(device)
+
+        print("Extracting features...")
+        report_progress(samples, 'backbone')
+        rgb_patch, xyz_patch = model_registry.get_features_maps_batch(rgb, pc)
+        for i, sample in enumerate(samples):
+            if sample.get('response') == 'features':
+                results[i] = (rgb_patch[i:i + 1], xyz_patch[i:i + 1])
+
+        for class_name, indices in samples_per_class.items():
+            try:
+                # Fetch the resident models (loaded from disk only on the first request for a class)
+                heads = model_registry.get_heads(class_name)
+                report_progress([samples[i] for i in indices], 'cfm')
+                # A slice, not a copy of hundreds of MB, when the samples of the class are contiguous (e.g. tiles)
+                rows = slice(indices[0], indices[-1] + 1) if indices[-1] - indices[0] + 1 == len(indices) else indices
+                residual_2D, _, residual_comb = heads_residuals(heads, rgb_patch[rows], xyz_patch[rows])
+                report_progress([samples[i] for i in indices], 'post-process')
+                residual_2D, residual_comb = residual_2D.cpu(), residual_comb.cpu()
+                for j, i in enumerate(indices):
+                    response = samples[i].get('response', 'images')
+                    if response == 'residuals':
+                        results[i] = (residual_2D[j], residual_comb[j])
+                        continue
+                    report_progress([samples[i]], 'render')
+                    results[i] = sample_outputs(class_name, samples[i], residual_2D[j], residual_comb[j], response)
+            except Exception as e:
+                traceback.print_exc()
+                for i in indices:
+                    results[i] = e
+
+    return results
+
+# Coalesces concurrent inference requests into micro-batches sharing one backbone pass
+inference_batcher = DynamicBatcher(run_inference_batch, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=BATCH_WAIT_MS)
+
+def infer_single_CFM(rgb_source, tiff_source, class_name, progress=None, response='images'):
+    print(f"\n=== Starting inference for class: {class_name} ===")
+
+    if progress is not None:
+        progress('decode')
+    sample = load_sample(rgb_source, tiff_source)
+    sample['class_name'] = class_name
+    sample['progress'] = progress
+    sample['response'] = response
+    return inference_batcher.submit(sample).result()
+
+def infer_tiled_CFM(rgb_source, tiff_source, class_name, tile_stride=TILE_STRIDE, progress=None, response='images'):
+    """
+    Score a sample at its native resolution: the RGB image and the organized point cloud are split into
+    overlapping TILE_SIZE tiles (tile_stride apart), the tiles are scored by the inference batcher (sharing its
+    backbone passes with the other requests), TILE_BATCH_SIZE at a time, and the residual maps of the tiles are
+    stitched with Hann-weighted overlap blending.
+    """
+    print(f"\n=== Starting tiled inference for class: {class_name} (stride {tile_stride}) ===")
+    if progress is not None:
+        progress('decode')
+    sample = load_sample_native(rgb_source, tiff_source)
+    height, width = sample['pc'].shape[-2:]
+
+    rgb = pad_to_tile(sample['rgb'][0], TILE_SIZE)
+    pc = pad_to_tile(sample['pc'][0], TILE_SIZE)
+    positions = tile_grid(*pc.shape[-2:], tile_size=TILE_SIZE, stride=tile_stride)
+
+    # Tiles with fewer valid points than Point-MAE centers (mostly background) cannot be encoded and are left out
+    valid_points = (pc != 0).all(dim=0)
+    positions = [(y, x) for y, x in positions
+                 if valid_points[y:y + TILE_SIZE, x:x + TILE_SIZE].sum() >= features_config.num_group]
+    print(f"Scoring {len(positions)} tile(s) of a {height}x{width} sample")
+
+    stitched_2D = TileStitcher(height, width, TILE_SIZE)
+    stitched_comb = TileStitcher(height, width, TILE_SIZE)
+    if progress is not None:
+        progress('backbone')
+    for start in range(0, len(positions), TILE_BATCH_SIZE):
+        batch_positions = positions[start:start + TILE_BATCH_SIZE]
+        rgb_tiles = extract_tiles(rgb, batch_positions, TILE_SIZE)
+        pc_tiles = extract_tiles(pc, batch_positions, TILE_SIZE)
+
+        # The backbones and the heads only run in the batcher thread, never in the request threads
+        futures = [inference_batcher.submit({'rgb': rgb_tiles[k:k + 1], 'pc': pc_tiles[k:k + 1],
+                                             'class_name': class_name, 'response': 'residuals'})
+                   for k in range(len(batch_positions))]
+        for (y, x), future in zip(batch_positions, futures):
+            tile_2D, tile_comb = future.result()
+            stitched_2D.add(tile_2D, y, x)
+            stitched_comb.add(tile_comb, y, x)
+
+    if progress is not None:
+        progress('render')
+    return sample_outputs(class_name, sample, stitched_2D.result(), stitched_comb.result(), response)
+
+def parse_tiling_options(form):
+    """Read the tiled / tile_stride form fields, raising ValueError on invalid values."""
+    tiled = form.get('tiled', '0').lower() in ('1', 'true', 'yes')
+    tile_stride = int(form.get('tile_stride', TILE_STRIDE))
+    if not 0 < tile_stride <= TILE_SIZE:
+        raise ValueError(f'tile_stride must be between 1 and {TILE_SIZE}')
+    return tiled, tile_stride
+
+def infer_multi_CFM(rgb_source, tiff_source, class_names, response='images'):
+    """
+    Score one sample against several classes: the backbones run once and the CFM heads of all the classes are
+    evaluated together in one stacked pass. Returns one output_paths dict (or compact_outputs) per class, with its
+    anomaly score.
+    """
+    print(f"\n=== Starting multi-class inference for {len(class_names)} class(es) ===")
+    set_seeds()
+
+    sample = load_sample(rgb_source, tiff_source)
+    # The backbones only run in the batcher thread, the sample shares its pass with the other requests
+    rgb_patch, xyz_patch = inference_batcher.submit({'rgb': sample['rgb'], 'pc': sample['pc'],
+                                                     'response': 'features'}).result()
+    with torch.no_grad():
+        stacked_heads = model_registry.get_stacked_heads(class_names)
+        residual_2D, _, residual_comb, scores = compute_residuals_multi(stacked_heads, rgb_patch, xyz_patch,
+                                                                        sparse=SPARSE_RESIDUALS)
+        residual_2D, residual_comb, scores = residual_2D.cpu(), residual_comb.cpu(), scores.cpu()
+
+    results = []
+    for k, class_name in enumerate(class_names):
+        outputs = sample_outputs(class_name, sample, residual_2D[k, 0], residual_comb[k, 0], response)
+        results.append((class_name, scores[k, 0].item(), outputs))
+    return results
+
+def run_job(payload, set_stage):
+    try:
+        if payload.get('tiled'):
+            output_paths = infer_tiled_CFM(payload['rgb_source'], payload['tiff_source'], payload['class_name'],
+                                           tile_stride=payload['tile_stride'], progress=set_stage)
+        else:
+            output_paths = infer_single_CFM(payload['rgb_source'], payload['tiff_source'], payload['class_name'], progress=set_stage)
+    finally:
+        shutil.rmtree(payload['input_subfolder'], ignore_errors=True)
+    return {k: os.path.relpath(v, start=BASE_DIR) for k, v in output_paths.items()}
+
+# Bounded worker pool executing the jobs submitted to /api/jobs
+job_queue = JobQueue(run_job, num_workers=JOB_WORKERS, max_queued=JOB_QUEUE_SIZE)
+
 @app.route('/')
 def index():
     return jsonify({'message': 'Flask backend is running. Use /api/infer for inference or /api/test-upload for testing file uploads.'}), 200
@@ -387,49 +681,32 @@ def infer():
             return jsonify({'error': 'Point cloud file must be TIFF, PLY, PCD, or OBJ'}), 400
 
         # Validate class name
-        valid_classes = [
-            "bagel", "cable_gland", "carrot", "cookie", "dowel", "foam", "peach", 
-            "potato", "rope", "tire", "CandyCane", "ChocolateCookie", "ChocolatePraline", 
-            "Confetto", "GummyBear", "HazelnutTruffle", "LicoriceSandwich", "Lollipop", 
-            "Marshmallow", "PeppermintCandy", "Chair"
-        ]
-        if class_name not in valid_classes:
+        if class_name not in VALID_CLASSES:
             print(f"Invalid class name: {class_name}")
             return jsonify({'error': 'Invalid class name'}), 400
 
-        # Save uploaded files
-        unique_id = str(uuid.uuid4())
-        input_subfolder = os.path.join(UPLOAD_FOLDER, unique_id)
-        os.makedirs(input_subfolder, exist_ok=True)
-        print(f"Saving input files to {input_subfolder}")
-
-        rgb_path = os.path.join(input_subfolder, secure_filename(rgb_file.filename))
-        tiff_path = os.path.join(input_subfolder, secure_filename(tiff_file.filename))
-        
+        # Optional native-resolution tiled mode and compact responses
         try:
-            rgb_file.save(rgb_path)
-            tiff_file.save(tiff_path)
-        except Exception as e:
-            print(f"Error saving files: {str(e)}")
-            raise Exception(f"File save failed: {str(e)}")
-
-        # Verify files were saved and have content
-        if not os.path.exists(rgb_path) or os.path.getsize(rgb_path) == 0:
-            print(f"RGB file not saved or empty: {rgb_path}")
-            raise Exception(f"RGB file not saved or empty: {rgb_path}")
-        if not os.path.exists(tiff_path) or os.path.getsize(tiff_path) == 0:
-            print(f"TIFF file not saved or empty: {tiff_path}")
-            raise Exception(f"TIFF file not saved or empty: {tiff_path}")
-        print(f"\nInput files saved: RGB={rgb_path} (size: {os.path.getsize(rgb_path)} bytes)")
-        print(f"TIFF={tiff_path} (size: {os.path.getsize(tiff_path)} bytes)")
+            tiled, tile_stride = parse_tiling_options(request.form)
+            response, map_dtype, render = parse_response_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Read the uploads (in memory, unless spooling of large payloads is enabled)
+        input_subfolder = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()))
+        rgb_source = read_upload(rgb_file, input_subfolder)
+        tiff_source = read_upload(tiff_file, input_subfolder)
 
         # Run inference
-        print("\n=== BEFORE INFERENCE ===")
-        print(f"RGB path: {rgb_path} (exists: {os.path.exists(rgb_path)})")
-        print(f"TIFF path: {tiff_path} (exists: {os.path.exists(tiff_path)})")
-        print(f"File sizes - RGB: {os.path.getsize(rgb_path)} bytes, TIFF: {os.path.getsize(tiff_path)} bytes")
-        
-        results = infer_single_CFM(rgb_path, tiff_path, class_name)
+        if tiled:
+            results = infer_tiled_CFM(rgb_source, tiff_source, class_name, tile_stride=tile_stride, response=response)
+        else:
+            results = infer_single_CFM(rgb_source, tiff_source, class_name, response=response)
+
+        if response == 'compact':
+            return jsonify(compact_result(results, map_dtype, render)), 200
+        if response == 'npz':
+            return npz_response(npz_arrays(results, map_dtype))
 
         # Convert absolute paths to relative paths for frontend
         results = {k: os.path.relpath(v, start=BASE_DIR) for k, v in results.items()}
@@ -438,21 +715,260 @@ def infer():
         return jsonify(results), 200
     
     except Exception as e:
-        # Clean up input files in case of error
+        # Print full traceback for debugging
+        print("\nError occurred:")
+        traceback.print_exc()  # This shows the file, line number, and error
+
+        return jsonify({'error': str(e)}), 500
+
+    finally:
+        # Clean up spooled input files
         if 'input_subfolder' in locals():
+            shutil.rmtree(input_subfolder, ignore_errors=True)
+
+
+@app.route('/api/infer/batch', methods=['POST'])
+def infer_batch():
+    """
+    Run inference on several samples at once.
+
+    Expects repeated rgb_file / tiff_file fields (paired by position) and either a single class_name applied to
+    every sample or one class_name per sample. The samples are handed to the dynamic batcher together, so they
+    share backbone passes with each other and with any concurrent request.
+    With response=npz, the arrays of sample i are named '<i>/score', '<i>/combined_residual', ... and '<i>/error'
+    for a failed sample.
+    """
+    print("\n=== Received /api/infer/batch request ===")
+    try:
+        rgb_files = request.files.getlist('rgb_file')
+        tiff_files = request.files.getlist('tiff_file')
+        class_names = request.form.getlist('class_name') or ['cable_gland']
+
+        if not rgb_files or len(rgb_files) != len(tiff_files):
+            print("Missing or unpaired files in request")
+            return jsonify({'error': 'The same number of RGB and TIFF files is required'}), 400
+        if len(class_names) == 1:
+            class_names = class_names * len(rgb_files)
+        if len(class_names) != len(rgb_files):
+            return jsonify({'error': 'Provide a single class_name or one class_name per sample'}), 400
+        try:
+            response, map_dtype, render = parse_response_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        for rgb_file, tiff_file, class_name in zip(rgb_files, tiff_files, class_names):
+            if not allowed_image_file(rgb_file.filename):
+                return jsonify({'error': f'RGB file must be PNG, JPG, or JPEG: {rgb_file.filename}'}), 400
+            if not allowed_point_cloud_file(tiff_file.filename):
+                return jsonify({'error': f'Point cloud file must be TIFF, PLY, PCD, or OBJ: {tiff_file.filename}'}), 400
+            if class_name not in VALID_CLASSES:
+                return jsonify({'error': f'Invalid class name: {class_name}'}), 400
+
+        input_subfolder = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()))
+        print(f"Decoding {len(rgb_files)} input pair(s)")
+
+        futures = []
+        for i, (rgb_file, tiff_file, class_name) in enumerate(zip(rgb_files, tiff_files, class_names)):
+            # Prefix spooled files with the sample index, uploads of a batch often share the same file names
+            rgb_source = read_upload(rgb_file, input_subfolder, prefix=f"{i}_")
+            tiff_source = read_upload(tiff_file, input_subfolder, prefix=f"{i}_")
+
+            sample = load_sample(rgb_source, tiff_source)
+            sample['class_name'] = class_name
+            sample['response'] = response
+            futures.append(inference_batcher.submit(sample))
+
+        if response == 'npz':
+            arrays = {}
+            for i, future in enumerate(futures):
+                try:
+                    arrays.update(npz_arrays(future.result(), map_dtype, prefix=f'{i}/'))
+                except Exception as e:
+                    arrays[f'{i}/error'] = np.array(str(e))
+            return npz_response(arrays)
+
+        results = []
+        for class_name, future in zip(class_names, futures):
             try:
-                shutil.rmtree(input_subfolder)
-                print(f"Deleted input folder due to error: {e}")
-            except Exception:
-                pass
+                outputs = future.result()
+                if response == 'compact':
+                    results.append(compact_result(outputs, map_dtype, render))
+                else:
+                    results.append({k: os.path.relpath(v, start=BASE_DIR) for k, v in outputs.items()})
+            except Exception as e:
+                results.append({'class_name': class_name, 'error': str(e)})
+        print(f"\nReturning {len(results)} batch result(s)")
 
-        # Print full traceback for debugging
+        return jsonify({'results': results}), 200
+
+    except Exception as e:
         print("\nError occurred:")
-        traceback.print_exc()  # This shows the file, line number, and error
+        traceback.print_exc()
 
         return jsonify({'error': str(e)}), 500
 
+    finally:
+        if 'input_subfolder' in locals():
+            shutil.rmtree(input_subfolder, ignore_errors=True)
+
+
+@app.route('/api/infer/multi', methods=['POST'])
+def infer_multi():
+    """
+    Score one RGB / TIFF pair against several classes sharing a single backbone pass.
+
+    Expects repeated class_name fields, or class_name=all for every class with a checkpoint.
+    Returns the maps and anomaly score of each class; best_class is the class with the lowest score, i.e. the one
+    whose CFMs reconstruct the sample best. With response=npz, the arrays of each class are named
+    '<class_name>/score', '<class_name>/combined_residual', ... next to best_class.
+    """
+    print("\n=== Received /api/infer/multi request ===")
+    try:
+        if 'rgb_file' not in request.files or 'tiff_file' not in request.files:
+            return jsonify({'error': 'Both RGB and TIFF files are required'}), 400
+
+        rgb_file = request.files['rgb_file']
+        tiff_file = request.files['tiff_file']
+        class_names = request.form.getlist('class_name')
+        if not class_names:
+            return jsonify({'error': 'Provide the class_name(s) to score against, or class_name=all'}), 400
+
+        if not allowed_image_file(rgb_file.filename):
+            return jsonify({'error': 'RGB file must be PNG, JPG, or JPEG'}), 400
+        if not allowed_point_cloud_file(tiff_file.filename):
+            return jsonify({'error': 'Point cloud file must be TIFF, PLY, PCD, or OBJ'}), 400
+
+        if class_names == ['all']:
+            class_names = [c for c in VALID_CLASSES if os.path.isdir(os.path.join(model_registry.checkpoint_folder, c))]
+            if not class_names:
+                return jsonify({'error': 'No class checkpoints available'}), 500
+        invalid = [c for c in class_names if c not in VALID_CLASSES]
+        if invalid:
+            return jsonify({'error': f'Invalid class name: {invalid[0]}'}), 400
+        class_names = list(dict.fromkeys(class_names))
+        try:
+            response, map_dtype, render = parse_response_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        input_subfolder = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()))
+        rgb_source = read_upload(rgb_file, input_subfolder)
+        tiff_source = read_upload(tiff_file, input_subfolder)
+
+        results, arrays = [], {}
+        for class_name, score, outputs in infer_multi_CFM(rgb_source, tiff_source, class_names, response=response):
+            if response == 'npz':
+                arrays.update(npz_arrays(outputs, map_dtype, prefix=f'{class_name}/'))
+                result = {}
+            elif response == 'compact':
+                result = compact_result(outputs, map_dtype, render)
+            else:
+                result = {k: os.path.relpath(v, start=BASE_DIR) for k, v in outputs.items()}
+            result.update({'class_name': class_name, 'score': score})
+            results.append(result)
+        best_class = min(results, key=lambda result: result['score'])['class_name']
+        if response == 'npz':
+            arrays['best_class'] = np.array(best_class)
+            return npz_response(arrays)
+        print(f"\nReturning {len(results)} class result(s), best class: {best_class}")
+
+        return jsonify({'results': results, 'best_class': best_class}), 200
+
+    except Exception as e:
+        print("\nError occurred:")
+        traceback.print_exc()
+
+        return jsonify({'error': str(e)}), 500
+
+    finally:
+        if 'input_subfolder' in locals():
+            shutil.rmtree(input_subfolder, ignore_errors=True)
+
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queue an inference job (same form fields as /api/infer) and return its id without waiting for the result."""
+    print("\n=== Received /api/jobs request ===")
+    rgb_file = request.files.get('rgb_file')
+    tiff_file = request.files.get('tiff_file')
+    class_name = request.form.get('class_name', 'cable_gland')
+
+    if not rgb_file or not tiff_file:
+        return jsonify({'error': 'Both RGB and TIFF files are required'}), 400
+    if not allowed_image_file(rgb_file.filename):
+        return jsonify({'error': 'RGB file must be PNG, JPG, or JPEG'}), 400
+    if not allowed_point_cloud_file(tiff_file.filename):
+        return jsonify({'error': 'Point cloud file must be TIFF, PLY, PCD, or OBJ'}), 400
+    if class_name not in VALID_CLASSES:
+        return jsonify({'error': 'Invalid class name'}), 400
+    try:
+        tiled, tile_stride = parse_tiling_options(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    input_subfolder = os.path.join(UPLOAD_FOLDER, str(uuid.uuid4()))
+
+    try:
+        job = job_queue.submit({
+            'rgb_source': read_upload(rgb_file, input_subfolder),
+            'tiff_source': read_upload(tiff_file, input_subfolder),
+            'class_name': class_name,
+            'tiled': tiled,
+            'tile_stride': tile_stride,
+            'input_subfolder': input_subfolder,
+        })
+    except QueueFullError as e:
+        shutil.rmtree(input_subfolder, ignore_errors=True)
+        print(f"Rejecting job: {e}")
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+    except Exception as e:
+        shutil.rmtree(input_subfolder, ignore_errors=True)
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+    print(f"Queued job {job.id} ({job_queue.pending()} waiting)")
+    return jsonify({
+        'job_id': job.id,
+        'status': job.status,
+        'status_url': f'/api/jobs/{job.id}',
+        'events_url': f'/api/jobs/{job.id}/events',
+    }), 202
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job.to_dict()), 200
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """Server-sent events stream of the job status, progress stages and final result."""
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    def generate():
+        sent = 0
+        while True:
+            events = job.wait_for_events(sent, timeout=15)
+            if not events:
+                yield ": keep-alive\n\n"
+                continue
+            for event, data in events:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+            sent += len(events)
+            if job.finished and sent == len(job.events):
+                return
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
 
 if __name__ == '__main__':
     print(f"Starting Flask app with BASE_DIR: {BASE_DIR}")
+    # Load the shared backbones once at startup (skipped in the reloader's watcher process)
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        model_registry.load_backbone()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
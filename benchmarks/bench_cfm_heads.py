@@ -0,0 +1,60 @@
+import argparse
+
+import torch
+
+from benchmarks.bench_utils import peak_memory_mb, time_fn
+from infer import FusionEncoder, DecoupledDecoder
+from models.cfm_heads import FusedCFMHeads, validate_fused_heads
+
+
+def module_residuals(fusion_encoder, decoder_2D, decoder_3D, rgb_patch, xyz_patch):
+    # Reconstruction errors as computed by infer.compute_residuals.
+    fusion_embedding = fusion_encoder(rgb_patch, xyz_patch)
+    residual_2D = (decoder_2D(fusion_embedding) - rgb_patch).pow(2).sum(-1).sqrt()
+    residual_3D = (decoder_3D(fusion_embedding) - xyz_patch).pow(2).sum(-1).sqrt()
+    return residual_2D, residual_3D
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    fusion_encoder = FusionEncoder(in_features_2D=768, in_features_3D=1152, out_features=960).eval()
+    decoder_2D = DecoupledDecoder(in_features=960, out_features=768).eval()
+    decoder_3D = DecoupledDecoder(in_features=960, out_features=1152).eval()
+    modules = (fusion_encoder, decoder_2D, decoder_3D)
+
+    fused = FusedCFMHeads(*modules)
+    print(f"Export validation, max relative error: {validate_fused_heads(fused, *modules):.2e}")
+
+    rgb_patch = torch.randn(args.rows, 768)
+    xyz_patch = torch.randn(args.rows, 1152)
+
+    print(f"{'engine':>8} {'chunk':>7} {'time [ms]':>10} {'rows/s':>9} {'peak mem [MB]':>14} {'max rel err':>12}")
+    with torch.no_grad():
+        expected = module_residuals(*modules, rgb_patch, xyz_patch)
+        elapsed = time_fn(module_residuals, *modules, rgb_patch, xyz_patch, repeats=args.repeats, warmup=1)
+        memory = peak_memory_mb(module_residuals, *modules, rgb_patch, xyz_patch)
+        memory = 'n/a' if memory is None else f"{memory:.1f}"
+        print(f"{'modules':>8} {'-':>7} {elapsed:>10.1f} {args.rows / elapsed * 1000:>9.0f} {memory:>14} {0:>12.2e}")
+
+        for chunk_size in args.chunk_sizes:
+            fused.chunk_size = chunk_size
+            residuals = fused.residuals(rgb_patch, xyz_patch)
+            error = max(((r - e).abs().max() / e.abs().max()).item() for r, e in zip(residuals, expected))
+
+            elapsed = time_fn(fused.residuals, rgb_patch, xyz_patch, repeats=args.repeats, warmup=1)
+            memory = peak_memory_mb(fused.residuals, rgb_patch, xyz_patch)
+            memory = 'n/a' if memory is None else f"{memory:.1f}"
+            print(f"{'fused':>8} {chunk_size:>7} {elapsed:>10.1f} {args.rows / elapsed * 1000:>9.0f} {memory:>14} {error:>12.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU throughput of the CFM heads modules against their fused export.')
+    parser.add_argument('--rows', default=224 * 224, type=int, help='Patch feature rows (224 x 224 per sample).')
+    parser.add_argument('--chunk_sizes', default=[512, 2048, 8192], type=int, nargs='+', help='Rows per chunk of the fused export.')
+    parser.add_argument('--repeats', default=3, type=int, help='Timed repetitions per measurement.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
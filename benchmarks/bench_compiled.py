@@ -0,0 +1,85 @@
+import argparse
+import os
+import tempfile
+import time
+
+import torch
+
+from benchmarks.bench_utils import time_fn
+from infer import FusionEncoder, DecoupledDecoder
+from models.compiled_models import export_backbones, export_heads, heads_fingerprint, load_compiled_heads
+from models.features import MultimodalFeatures
+
+
+def random_cloud(batch_size, image_size):
+    # Organized cloud of a tilted plane, with a zero (invalid) border like the preprocessed scans.
+    pc = torch.zeros(batch_size, 3, image_size, image_size)
+    grid = torch.linspace(-1, 1, image_size)
+    pc[:, 0], pc[:, 1] = grid.view(1, -1), grid.view(-1, 1)
+    pc[:, 2] = 0.3 * pc[:, 0] + 0.05 * torch.rand(batch_size, image_size, image_size) + 1
+    pc[..., :8, :] = 0
+    return pc
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+    compiled_folder = args.compiled_folder or tempfile.mkdtemp()
+
+    eager, eager_startup = timed(lambda: MultimodalFeatures().eval())
+    heads = (FusionEncoder().eval(), DecoupledDecoder(out_features=768).eval(), DecoupledDecoder(out_features=1152).eval())
+    if not os.path.exists(os.path.join(compiled_folder, 'bench', 'cfm_heads.pt')):
+        print(f"Exporting to {compiled_folder}...")
+        export_backbones(eager, compiled_folder)
+        export_heads(*heads, compiled_folder, 'bench')
+
+    compiled, compiled_startup = timed(lambda: MultimodalFeatures(compiled_folder=compiled_folder).eval())
+    compiled_heads, heads_startup = timed(load_compiled_heads, compiled_folder, 'bench', eager.device, heads_fingerprint(*heads))
+    assert compiled_heads is not None, f"Stale compiled heads in {compiled_folder}, export to another folder"
+    print(f"Startup: eager backbones {eager_startup:.2f} s, compiled backbones {compiled_startup:.2f} s, "
+          f"compiled heads {heads_startup:.2f} s")
+
+    rgb = torch.randn(args.batch_size, 3, eager.image_size, eager.image_size)
+    pc = random_cloud(args.batch_size, eager.image_size)
+    rgb_rows = torch.randn(args.rows, 768)
+    xyz_rows = torch.randn(args.rows, 1152)
+
+    eager_extractors, compiled_extractors = eager.deep_feature_extractor, compiled.deep_feature_extractor
+    group_divider = eager_extractors.xyz_backbone.group_divider
+    with torch.no_grad():
+        neighborhood, center, _, _ = group_divider(pc.permute(0, 2, 3, 1).reshape(args.batch_size, -1, 3)[:, 8 * eager.image_size:])
+        stages = [
+            ('rgb backbone', eager_extractors.forward_rgb_features, compiled_extractors.forward_rgb_features, (rgb,)),
+            ('xyz tokens', eager_extractors.xyz_backbone.forward_tokens, compiled_extractors.xyz_backbone.token_stage, (neighborhood, center)),
+            ('cfm heads', lambda r, x: (lambda e: (heads[1](e), heads[2](e)))(heads[0](r, x)), compiled_heads, (rgb_rows, xyz_rows)),
+            ('end to end', eager.get_features_maps_batch, compiled.get_features_maps_batch, (rgb, pc)),
+        ]
+
+        print(f"{'stage':>13} {'eager [ms]':>11} {'compiled [ms]':>14} {'speedup':>8} {'max abs err':>12}")
+        for name, eager_fn, compiled_fn, inputs in stages:
+            expected, result = eager_fn(*inputs), compiled_fn(*inputs)
+            expected = expected if isinstance(expected, tuple) else (expected,)
+            result = result if isinstance(result, tuple) else (result,)
+            error = max((e - r).abs().max().item() for e, r in zip(expected, result))
+
+            eager_ms = time_fn(eager_fn, *inputs, repeats=args.repeats, warmup=1)
+            compiled_ms = time_fn(compiled_fn, *inputs, repeats=args.repeats, warmup=1)
+            print(f"{name:>13} {eager_ms:>11.1f} {compiled_ms:>14.1f} {eager_ms / compiled_ms:>7.2f}x {error:>12.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Startup time and steady-state latency of the compiled models against eager mode.')
+    parser.add_argument('--compiled_folder', default=None, type=str, help='Folder of the artifacts (exported from random weights if missing, default: a temporary folder).')
+    parser.add_argument('--batch_size', default=1, type=int, help='Samples per backbone pass.')
+    parser.add_argument('--rows', default=8192, type=int, help='Feature rows through the CFM heads.')
+    parser.add_argument('--repeats', default=3, type=int, help='Timed repetitions per measurement.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,79 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import tifffile
+import yaml
+from PIL import Image
+
+from processing.preprocess_eyecandies import (FOCAL_LENGTH, depth_to_pointcloud, depth_to_pointcloud_loop,
+                                              remove_point_cloud_background, remove_point_cloud_background_loop)
+
+
+def write_sample(folder, sample_id, size, seed):
+    """Synthetic Eyecandies sample files: 16 bit normalized depth PNG, depth normalization yaml and camera pose."""
+    rng = np.random.default_rng(seed)
+    # A tilted table seen from above with an object in the middle, plus sensor noise.
+    v, u = np.mgrid[:size, :size] / size
+    depth = 0.3 + 0.4 * v - 0.2 * np.exp(-((u - 0.5) ** 2 + (v - 0.5) ** 2) / 0.02) + 0.002 * rng.random((size, size))
+    mind, maxd = float(depth.min()), float(depth.max())
+    Image.fromarray(np.round((depth - mind) / (maxd - mind) * 65535).astype(np.uint16)).save(
+        os.path.join(folder, f'{sample_id}_depth.png'))
+    with open(os.path.join(folder, f'{sample_id}_info_depth.yaml'), 'w') as f:
+        yaml.safe_dump({'normalization': {'min': mind, 'max': maxd}}, f)
+
+    angle = 0.3 + 0.1 * rng.random()
+    pose = np.eye(4)
+    pose[1:3, 1:3] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+    pose[:3, 3] = [0.01, -0.02, 0.5]
+    np.savetxt(os.path.join(folder, f'{sample_id}_pose.txt'), pose)
+    return [os.path.join(folder, f'{sample_id}_{suffix}') for suffix in ('depth.png', 'info_depth.yaml', 'pose.txt')]
+
+
+def preprocess(files, depth_fn, background_fn, size):
+    pc = depth_fn(*files, FOCAL_LENGTH)
+    return background_fn(pc).reshape(size, size, 3)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, 1000 * (time.perf_counter() - start)
+
+
+def tiff_bytes(folder, name, pc):
+    path = os.path.join(folder, name)
+    tifffile.imwrite(path, pc)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def run(args):
+    print(f"{'sample':>7} {'loops [ms]':>11} {'vectorized [ms]':>16} {'speedup':>8} {'identical tiff':>15}")
+    with tempfile.TemporaryDirectory() as folder:
+        loop_times, vectorized_times = [], []
+        for i in range(args.samples):
+            files = write_sample(folder, str(i).zfill(3), args.size, seed = i)
+            expected, loop_ms = timed(preprocess, files, depth_to_pointcloud_loop, remove_point_cloud_background_loop, args.size)
+            pc, vectorized_ms = timed(preprocess, files, depth_to_pointcloud, remove_point_cloud_background, args.size)
+
+            identical = tiff_bytes(folder, 'loop.tiff', expected) == tiff_bytes(folder, 'vectorized.tiff', pc)
+            assert identical, f"Mismatch against the loops: {np.nanmax(np.abs(expected - pc))}"
+
+            loop_times.append(loop_ms)
+            vectorized_times.append(vectorized_ms)
+            print(f"{i:>7} {loop_ms:>11.1f} {vectorized_ms:>16.1f} {loop_ms / vectorized_ms:>7.1f}x {str(identical):>15}")
+
+    print(f"{'median':>7} {np.median(loop_times):>11.1f} {np.median(vectorized_times):>16.1f} "
+          f"{np.median(loop_times) / np.median(vectorized_times):>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-sample time of the Eyecandies point cloud conversion: Python loops vs vectorized, checking that the TIFFs are identical.')
+    parser.add_argument('--samples', default=3, type=int, help='Number of synthetic samples.')
+    parser.add_argument('--size', default=512, type=int, help='Side of the depth maps (512 in Eyecandies).')
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,59 @@
+import argparse
+
+import torch
+
+from benchmarks.bench_utils import time_fn
+from models.full_models import FPS_BACKENDS, pointnet2_utils
+from utils.pointnet2_utils import farthest_point_sample
+
+
+def random_surface(num_points):
+    # Height field, like the organized clouds of MVTec 3D-AD.
+    xy = torch.rand(1, num_points, 2)
+    z = 0.1 * torch.sin(6 * xy[..., :1]) * torch.cos(4 * xy[..., 1:])
+    return torch.cat([xy, z], dim=-1) + 0.1
+
+
+def covering_radius(xyz, idx):
+    # Largest distance of a point from its closest sampled center, lower is better.
+    centers = xyz[0, idx[0]]
+    distances = torch.cat([torch.cdist(chunk, centers).min(dim=1)[0] for chunk in xyz[0].split(4096)])
+    return distances.max().item()
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    backends = {'loop': farthest_point_sample}
+    backends.update({name: FPS_BACKENDS[name] for name in args.backends})
+
+    print(f"{'points':>8} {'backend':>8} {'time [ms]':>10} {'speedup':>8} {'radius / exact':>15}")
+    for num_points in args.num_points:
+        xyz = random_surface(num_points).to(args.device)
+        exact = covering_radius(xyz, FPS_BACKENDS['cpu'](xyz, args.num_group))
+
+        # Speedups are against the reference loop, which runs first.
+        loop_elapsed = None
+        for name, backend in backends.items():
+            if name == 'cuda' and (pointnet2_utils is None or not xyz.is_cuda):
+                print(f"{num_points:>8} {name:>8} {'skipped':>10}")
+                continue
+            with torch.no_grad():
+                elapsed = time_fn(backend, xyz, args.num_group, repeats=args.repeats, warmup=1)
+                ratio = covering_radius(xyz, backend(xyz, args.num_group)) / exact
+            loop_elapsed = loop_elapsed or elapsed
+            print(f"{num_points:>8} {name:>8} {elapsed:>10.1f} {loop_elapsed / elapsed:>7.1f}x {ratio:>15.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and sampling quality of the furthest point sampling backends.')
+    parser.add_argument('--num_points', default=[10000, 50000], type=int, nargs='+', help='Points per cloud.')
+    parser.add_argument('--backends', default=['cpu', 'voxel', 'cuda'], nargs='+', choices=sorted(FPS_BACKENDS), help='Registered backends to compare with the reference loop.')
+    parser.add_argument('--num_group', default=1024, type=int, help='Number of sampled centers.')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str, help='Device of the point clouds.')
+    parser.add_argument('--repeats', default=3, type=int, help='Timed repetitions per measurement.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,63 @@
+import argparse
+
+import torch
+
+from benchmarks.bench_utils import peak_memory_mb, time_fn
+from utils.pointnet2_utils import index_points, interpolating_points, square_distance
+
+
+def interpolating_points_sort(xyz1, xyz2, points2):
+    """Previous implementation: full [B, N, S] distance matrix, fully sorted to take the three nearest centers."""
+    xyz1 = xyz1.permute(0, 2, 1)
+    xyz2 = xyz2.permute(0, 2, 1)
+    points2 = points2.permute(0, 2, 1)
+    B, N, C = xyz1.shape
+
+    dists = square_distance(xyz1, xyz2)
+    dists, idx = dists.sort(dim=-1)
+    dists, idx = dists[:, :, :3], idx[:, :, :3]
+    dist_recip = 1.0 / (dists + 1e-8)
+    norm = torch.sum(dist_recip, dim=2, keepdim=True)
+    weight = dist_recip / norm
+    interpolated_points = torch.sum(index_points(points2, idx) * weight.view(B, N, 3, 1), dim=2)
+    return interpolated_points.permute(0, 2, 1)
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    # Points whose three nearest centers include a tie may pick a different center than the full sort.
+    print(f"{'points':>8} {'implementation':>16} {'time [ms]':>10} {'peak mem [MB]':>14} {'mismatches':>11}")
+    for num_points in args.num_points:
+        xyz = torch.rand(1, 3, num_points)
+        centers = xyz[:, :, torch.randperm(num_points)[:args.num_group]]
+        features = torch.randn(1, args.feature_dim, args.num_group)
+
+        with torch.no_grad():
+            chunked = lambda: interpolating_points(xyz, centers, features, chunk_size=args.chunk_size)
+            candidates = [(f'chunked {args.chunk_size}', chunked)]
+            if num_points <= args.max_reference_points:
+                candidates.append(('sort', lambda: interpolating_points_sort(xyz, centers, features)))
+
+            expected = candidates[-1][1]()
+            for name, fn in candidates:
+                memory = peak_memory_mb(fn)
+                elapsed = time_fn(fn, repeats=args.repeats, warmup=1)
+                mismatches = ((fn() - expected).abs().amax(dim=1) > 1e-4).sum().item()
+                memory = 'n/a' if memory is None else f"{memory:.1f}"
+                print(f"{num_points:>8} {name:>16} {elapsed:>10.1f} {memory:>14} {mismatches:>11}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and peak memory of the three-NN feature interpolation.')
+    parser.add_argument('--num_points', default=[10000, 50000, 200000], type=int, nargs='+', help='Interpolated points.')
+    parser.add_argument('--num_group', default=1024, type=int, help='Number of centers carrying features.')
+    parser.add_argument('--feature_dim', default=1152, type=int, help='Dimension of the interpolated features.')
+    parser.add_argument('--chunk_size', default=4096, type=int, help='Points interpolated at once.')
+    parser.add_argument('--max_reference_points', default=50000, type=int, help='Skip the sort implementation above this many points.')
+    parser.add_argument('--repeats', default=3, type=int, help='Timed repetitions per measurement.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
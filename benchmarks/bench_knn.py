@@ -0,0 +1,55 @@
+import argparse
+
+import torch
+
+from benchmarks.bench_utils import peak_memory_mb, time_fn
+from models.full_models import KNN
+
+
+def random_cloud(num_points, num_centers):
+    xyz = torch.rand(1, num_points, 3)
+    centers = xyz[:, torch.randperm(num_points)[:num_centers]]
+    return xyz, centers
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    print(f"{'points':>8} {'method':>8} {'time [ms]':>10} {'peak mem [MB]':>14} {'same sets':>10}")
+    for num_points in args.num_points:
+        xyz, centers = random_cloud(num_points, args.num_group)
+        reference = None
+
+        for method in args.methods:
+            if method == 'dense' and num_points > args.max_dense_points:
+                print(f"{num_points:>8} {method:>8} {'skipped':>10}")
+                continue
+
+            knn = KNN(k=args.group_size, method=method, chunk_size=args.chunk_size)
+            with torch.no_grad():
+                memory = peak_memory_mb(knn, xyz, centers)
+                elapsed = time_fn(knn, xyz, centers, repeats=args.repeats, warmup=1)
+                indices = knn(xyz, centers)
+
+            if reference is None:
+                reference = indices
+            # Compare neighbor sets, the order of neighbors at equal distance is not guaranteed.
+            same = torch.equal(indices.sort(dim=1)[0], reference.sort(dim=1)[0])
+            memory = 'n/a' if memory is None else f"{memory:.1f}"
+            print(f"{num_points:>8} {method:>8} {elapsed:>10.1f} {memory:>14} {str(same):>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency and peak memory of the Group neighbor search engines.')
+    parser.add_argument('--num_points', default=[10000, 50000, 100000], type=int, nargs='+', help='Points per cloud.')
+    parser.add_argument('--methods', default=['chunked', 'dense', 'kdtree'], nargs='+', choices=KNN.methods, help='KNN engines to compare, the first one is the reference.')
+    parser.add_argument('--num_group', default=1024, type=int, help='Number of centers.')
+    parser.add_argument('--group_size', default=128, type=int, help='Neighbors per center.')
+    parser.add_argument('--chunk_size', default=64, type=int, help='Centers per chunk for the chunked engine.')
+    parser.add_argument('--max_dense_points', default=50000, type=int, help='Skip the dense engine above this many points.')
+    parser.add_argument('--repeats', default=3, type=int, help='Timed repetitions per measurement.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
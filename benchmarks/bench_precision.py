@@ -0,0 +1,92 @@
+import argparse
+import time
+
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+
+from infer import compute_residuals, compute_residuals_fused, set_seeds
+from models.dataset import get_data_loader
+from models.model_registry import ModelRegistry, calibration_batches
+from utils.metrics_utils import calculate_au_pro
+from utils.quantization_utils import PRECISIONS
+
+
+def evaluate(registry, class_name, dataset_path, max_samples):
+    """Detection / segmentation metrics and per-sample latency of a registry on the test split of a class."""
+    heads = registry.get_heads(class_name)
+    image_preds, image_labels, predictions, gts = [], [], [], []
+    backbone_times, heads_times = [], []
+
+    test_loader = get_data_loader('test', class_name = class_name, dataset_path = dataset_path)
+    with torch.no_grad():
+        for i, ((rgb, pc, _), gt, label, _) in enumerate(test_loader):
+            if max_samples and i >= max_samples:
+                break
+            start = time.perf_counter()
+            rgb_patch, xyz_patch = registry.extract_features_batch(rgb.to(registry.device), pc.to(registry.device))
+            backbone_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            if heads.fused is not None:
+                _, _, residual_comb = compute_residuals_fused(heads.fused, rgb_patch, xyz_patch)
+            else:
+                _, _, residual_comb = compute_residuals(*heads, rgb_patch, xyz_patch)
+            heads_times.append(time.perf_counter() - start)
+
+            residual_comb = residual_comb[0].cpu().numpy()
+            image_preds.append(residual_comb.max())
+            image_labels.append(label.item())
+            predictions.append(residual_comb)
+            gts.append(gt[0, 0].numpy())
+
+    pixel_preds = np.concatenate([p.ravel() for p in predictions])
+    pixel_labels = np.concatenate([g.ravel() for g in gts])
+    au_pros, _ = calculate_au_pro(gts, predictions)
+    return {
+        'i_auroc': roc_auc_score(image_labels, image_preds),
+        'p_auroc': roc_auc_score(pixel_labels, pixel_preds),
+        'au_pro': au_pros[0],
+        'backbone_ms': 1000 * np.median(backbone_times),
+        'heads_ms': 1000 * np.median(heads_times),
+    }
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+
+    print(f"{'precision':>12} {'I-AUROC':>8} {'P-AUROC':>8} {'AU-PRO@30%':>11} {'backbone [ms]':>14} {'heads [ms]':>11}")
+    reference = None
+    for precision in args.precisions:
+        set_seeds()
+        calibration_data = None
+        if precision == 'int8-static':
+            calibration_data = list(calibration_batches(args.dataset_path, [args.class_name], num_samples = args.calibration_samples))
+
+        registry = ModelRegistry(args.checkpoint_folder, epochs_no = args.epochs_no, batch_size = args.batch_size,
+                                 fuse_heads = True, precision = precision, calibration_data = calibration_data)
+        results = evaluate(registry, args.class_name, args.dataset_path, args.max_samples)
+        reference = reference or results
+
+        deltas = {k: results[k] - reference[k] for k in ('i_auroc', 'p_auroc', 'au_pro')}
+        print(f"{precision:>12} {results['i_auroc']:>8.3f} {results['p_auroc']:>8.3f} {results['au_pro']:>11.3f} "
+              f"{results['backbone_ms']:>14.1f} {results['heads_ms']:>11.1f}")
+        if results is not reference:
+            print(f"{'delta':>12} {deltas['i_auroc']:>+8.3f} {deltas['p_auroc']:>+8.3f} {deltas['au_pro']:>+11.3f} "
+                  f"{results['backbone_ms'] / reference['backbone_ms']:>13.2f}x {results['heads_ms'] / reference['heads_ms']:>10.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy regression and latency of the inference precisions, the first one is the reference.')
+    parser.add_argument('--dataset_path', default='./datasets/mvtec3d', type=str, help='Dataset path.')
+    parser.add_argument('--checkpoint_folder', default='./checkpoints/General', type=str, help='Path to the folder containing the checkpoints.')
+    parser.add_argument('--class_name', default='bagel', type=str, help='Category name.')
+    parser.add_argument('--precisions', default=list(PRECISIONS), nargs='+', choices=PRECISIONS, help='Precisions to compare.')
+    parser.add_argument('--epochs_no', default=100, type=int, help='Number of epochs of the checkpoints.')
+    parser.add_argument('--batch_size', default=1, type=int, help='Batch size of the checkpoints.')
+    parser.add_argument('--calibration_samples', default=8, type=int, help='Training samples used to calibrate int8-static.')
+    parser.add_argument('--max_samples', default=0, type=int, help='Evaluate at most this many test samples (0 for all).')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
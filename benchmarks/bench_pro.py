@@ -0,0 +1,58 @@
+import argparse
+import time
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from utils.metrics_utils import compute_pro, compute_pro_loop
+
+
+def random_test_set(num_maps, img_size, anomalous_fraction, seed = 0):
+    """Smooth random anomaly maps, and ground truths with a few blob-shaped defects on a fraction of the maps."""
+    rng = np.random.default_rng(seed)
+    anomaly_maps, ground_truth_maps = [], []
+    for i in range(num_maps):
+        prediction = gaussian_filter(rng.random((img_size, img_size)), sigma = 4).astype(np.float32)
+        gt = np.zeros((img_size, img_size), dtype = np.uint8)
+        if i < anomalous_fraction * num_maps:
+            yy, xx = np.mgrid[:img_size, :img_size]
+            for _ in range(rng.integers(1, 4)):
+                cy, cx, r = rng.integers(0, img_size, 2).tolist() + [rng.integers(3, img_size // 8)]
+                blob = (yy - cy) ** 2 + (xx - cx) ** 2 <= r ** 2
+                gt[blob] = 1
+                prediction[blob] += 0.05 * rng.random()
+        anomaly_maps.append(prediction)
+        ground_truth_maps.append(gt)
+    return anomaly_maps, ground_truth_maps
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, 1000 * (time.perf_counter() - start)
+
+
+def run(args):
+    print(f"{'maps':>6} {'loop [ms]':>10} {'vectorized [ms]':>16} {'speedup':>8} {'identical':>10}")
+    for num_maps in args.num_maps:
+        anomaly_maps, ground_truth_maps = random_test_set(num_maps, args.img_size, args.anomalous_fraction)
+
+        expected, loop_ms = timed(compute_pro_loop, anomaly_maps, ground_truth_maps, args.num_thresholds)
+        curve, vectorized_ms = timed(compute_pro, anomaly_maps, ground_truth_maps, args.num_thresholds)
+
+        # The curves (fprs, pros, thresholds) must match exactly, not only up to rounding.
+        identical = all(np.array_equal(np.asarray(e), np.asarray(c)) for e, c in zip(expected, curve))
+        assert identical, f"Mismatch against the loop: {max(np.abs(np.subtract(e, c)).max() for e, c in zip(expected, curve))}"
+
+        print(f"{num_maps:>6} {loop_ms:>10.1f} {vectorized_ms:>16.1f} {loop_ms / vectorized_ms:>7.1f}x {str(identical):>10}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='PRO curve computation: per-component loop vs vectorized, checking that the curves are identical.')
+    parser.add_argument('--num_maps', default=[50, 250], type=int, nargs='+', help='Test set sizes (anomaly / ground truth map pairs).')
+    parser.add_argument('--img_size', default=224, type=int, help='Side of the maps.')
+    parser.add_argument('--anomalous_fraction', default=0.7, type=float, help='Fraction of the maps with ground truth defects.')
+    parser.add_argument('--num_thresholds', default=99, type=int, help='Thresholds of the PRO curve.')
+    args = parser.parse_args()
+
+    run(args)
@@ -0,0 +1,102 @@
+import argparse
+import os
+import tempfile
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import torch
+from PIL import Image
+from scipy.ndimage import gaussian_filter
+from torchvision import transforms
+
+from benchmarks.bench_utils import time_fn
+from utils.rendering_utils import colorize, denormalize_rgb, overlay, write_png
+
+IMAGE_NAMES = ('input_rgb', 'point_cloud_mean', 'residual_2d', 'combined_residual')
+
+
+def random_outputs(size, seed = 0):
+    """Inputs of save_outputs: normalized RGB tensor, 3-channel depth map, and smooth residual maps."""
+    rng = np.random.default_rng(seed)
+    image = Image.fromarray((rng.random((size, size, 3)) * 255).astype(np.uint8))
+    rgb = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+    ])(image).unsqueeze(0)
+    depth = gaussian_filter(rng.random((size, size)), sigma = 8).astype(np.float32)
+    depth_map = torch.from_numpy(np.repeat(depth[np.newaxis], 3, axis = 0))
+    residual_2D = torch.from_numpy(gaussian_filter(rng.random((size, size)), sigma = 4).astype(np.float32) * 50)
+    residual_comb = torch.from_numpy(gaussian_filter(rng.random((size, size)), sigma = 4).astype(np.float32) * 2000)
+    return rgb, depth_map, residual_2D, residual_comb
+
+
+def save_matplotlib(folder, rgb, depth_map, residual_2D, residual_comb):
+    """The previous save_outputs: torchvision denormalization and plt.imsave."""
+    denormalize = transforms.Compose([
+        transforms.Normalize(mean=[0., 0., 0.], std=[1/0.229, 1/0.224, 1/0.225]),
+        transforms.Normalize(mean=[-0.485, -0.456, -0.406], std=[1., 1., 1.]),
+    ])
+    rgb_img = denormalize(rgb).squeeze().permute(1, 2, 0).numpy()
+    depth_img = depth_map.permute(1, 2, 0).float().mean(axis=-1).numpy()
+    plt.imsave(os.path.join(folder, 'input_rgb.png'), rgb_img)
+    plt.imsave(os.path.join(folder, 'point_cloud_mean.png'), depth_img)
+    plt.imsave(os.path.join(folder, 'residual_2d.png'), residual_2D.numpy(), cmap=plt.cm.jet)
+    plt.imsave(os.path.join(folder, 'combined_residual.png'), residual_comb.numpy(), cmap=plt.cm.jet)
+
+
+def save_lut(folder, rgb, depth_map, residual_2D, residual_comb, compress_level):
+    """save_outputs through utils.rendering_utils."""
+    rgb_img = denormalize_rgb(rgb)
+    depth_img = depth_map.permute(1, 2, 0).float().mean(axis=-1).numpy()
+    write_png(os.path.join(folder, 'input_rgb.png'), rgb_img, compress_level)
+    write_png(os.path.join(folder, 'point_cloud_mean.png'), colorize(depth_img, 'viridis'), compress_level)
+    write_png(os.path.join(folder, 'residual_2d.png'), colorize(residual_2D.numpy(), 'jet'), compress_level)
+    write_png(os.path.join(folder, 'combined_residual.png'), colorize(residual_comb.numpy(), 'jet'), compress_level)
+
+
+def read_images(folder):
+    return {name: np.array(Image.open(os.path.join(folder, f'{name}.png')).convert('RGB')) for name in IMAGE_NAMES}
+
+
+def folder_kb(folder):
+    return sum(os.path.getsize(os.path.join(folder, f'{name}.png')) for name in IMAGE_NAMES) / 1024
+
+
+def run(args):
+    print(f"{'size':>6} {'renderer':>16} {'4 PNGs [ms]':>12} {'speedup':>8} {'size [KB]':>10} {'identical':>10}")
+    with tempfile.TemporaryDirectory() as root:
+        for size in args.sizes:
+            outputs = random_outputs(size)
+            reference_folder = os.path.join(root, f'matplotlib_{size}')
+            os.makedirs(reference_folder)
+            reference_ms = time_fn(save_matplotlib, reference_folder, *outputs, repeats = args.repeats)
+            reference = read_images(reference_folder)
+            print(f"{size:>6} {'plt.imsave':>16} {reference_ms:>12.2f} {'':>8} {folder_kb(reference_folder):>10.1f}")
+
+            for compress_level in args.compress_levels:
+                folder = os.path.join(root, f'lut_{size}_{compress_level}')
+                os.makedirs(folder)
+                lut_ms = time_fn(save_lut, folder, *outputs, compress_level, repeats = args.repeats)
+
+                # The decoded pixels must match what plt.imsave wrote, for every image.
+                images = read_images(folder)
+                identical = all(np.array_equal(reference[name], images[name]) for name in IMAGE_NAMES)
+                assert identical, f"Mismatch against plt.imsave: {[n for n in IMAGE_NAMES if not np.array_equal(reference[n], images[n])]}"
+                print(f"{size:>6} {f'LUT, level {compress_level}':>16} {lut_ms:>12.2f} {reference_ms / lut_ms:>7.1f}x "
+                      f"{folder_kb(folder):>10.1f} {str(identical):>10}")
+
+            rgb_img = denormalize_rgb(outputs[0])
+            overlay_ms = time_fn(overlay, rgb_img, outputs[3].numpy(), repeats = args.repeats)
+            print(f"{size:>6} {'overlay blend':>16} {overlay_ms:>12.2f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rendering of the four output PNGs: plt.imsave vs colormap lookup tables and Pillow, checking that the pixels are identical.')
+    parser.add_argument('--sizes', default=[224, 800], type=int, nargs='+', help='Sides of the maps (224 per sample, larger in tiled mode).')
+    parser.add_argument('--compress_levels', default=[1, 6], type=int, nargs='+', help='PNG zlib levels to compare.')
+    parser.add_argument('--repeats', default=20, type=int, help='Timed repetitions.')
+    args = parser.parse_args()
+
+    run(args)
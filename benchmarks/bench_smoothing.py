@@ -0,0 +1,41 @@
+import argparse
+
+import torch
+
+from benchmarks.bench_utils import time_fn
+from utils.smoothing_utils import box_blur_loop, smooth_residuals
+
+
+def run(args):
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(0)
+
+    print(f"{'batch':>6} {'loop [ms]':>10} {'operator [ms]':>14} {'speedup':>8} {'max abs err':>12} {'max rel err':>12}")
+    for batch_size in args.batch_sizes:
+        residual = torch.rand(batch_size, 1, args.img_size, args.img_size)
+        # Residuals are zero on the background.
+        residual[..., :args.img_size // 4, :] = 0
+
+        with torch.no_grad():
+            expected = box_blur_loop(residual)
+            smoothed = smooth_residuals(residual)
+
+            err = (expected - smoothed).abs().max().item()
+            rel_err = err / expected.abs().max().item()
+            assert torch.allclose(expected, smoothed, rtol=1e-4, atol=1e-6), f"Mismatch against the loop: {err}"
+
+            loop_ms = time_fn(box_blur_loop, residual, repeats=args.repeats)
+            operator_ms = time_fn(smooth_residuals, residual, repeats=args.repeats)
+
+        print(f"{batch_size:>6} {loop_ms:>10.2f} {operator_ms:>14.2f} {loop_ms / operator_ms:>7.1f}x {err:>12.2e} {rel_err:>12.2e}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='CPU latency of the residual smoothing: conv2d loop vs composed operator.')
+    parser.add_argument('--img_size', default=224, type=int, help='Side of the residual maps.')
+    parser.add_argument('--batch_sizes', default=[1, 8], type=int, nargs='+', help='Number of maps smoothed at once.')
+    parser.add_argument('--repeats', default=50, type=int, help='Timed repetitions per measurement.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    run(args)
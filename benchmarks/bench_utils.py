@@ -0,0 +1,40 @@
+import statistics
+import time
+
+
+def time_fn(fn, *args, repeats = 20, warmup = 3):
+    """Median wall time of fn(*args) in milliseconds."""
+    for _ in range(warmup):
+        fn(*args)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def _read_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+
+def peak_memory_mb(fn, *args):
+    """
+    Peak resident memory growth (in MB) while running fn(*args), or None when it cannot be measured.
+
+    Uses the Linux peak RSS counter (VmHWM), which is reset to the current RSS before running fn.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        fn(*args)
+        return None
+
+    start_kb = _read_status_kb('VmRSS')
+    fn(*args)
+    return (_read_status_kb('VmHWM') - start_kb) / 1024
@@ -0,0 +1,80 @@
+import json
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from infer_batch import build_parser, build_registry, infer_class
+from utils.evaluation_utils import METRICS, evaluate_store, mean_metrics
+
+
+def evaluate(args):
+    """
+    Score the test split of every class with the batch inference path (resuming the prediction stores of a previous
+    run) and compute the metrics of each class in a pool of processes, as soon as its predictions are complete, while
+    the next class is being scored. The metrics of all the classes are written to args.results_file.
+
+    A class whose inference or evaluation fails is reported and left out, the others are still evaluated: the
+    results file holds the metrics of the finished classes, their mean and the errors of the failed ones under
+    'failed'. Returns the results.
+    """
+    registry = None if args.skip_inference else build_registry(args)
+    start = time.perf_counter()
+
+    failed = {}
+    # Spawned workers: the metrics only need NumPy / scikit-learn, not a fork of the process holding the models.
+    with ProcessPoolExecutor(max_workers = args.eval_workers, mp_context = multiprocessing.get_context('spawn')) as pool:
+        futures = {}
+        for class_name in args.class_names:
+            if registry is not None:
+                try:
+                    infer_class(registry, class_name, args)
+                except Exception as e:
+                    traceback.print_exc()
+                    failed[class_name] = f'inference: {type(e).__name__}: {e}'
+                    continue
+                finally:
+                    registry.clear()
+            futures[class_name] = pool.submit(evaluate_store, os.path.join(args.output_folder, class_name), class_name,
+                                              args.dataset_path, features_path = args.features_path)
+
+        results = {}
+        for class_name, future in futures.items():
+            try:
+                results[class_name] = future.result()[1]
+            except Exception as e:
+                traceback.print_exc()
+                failed[class_name] = f'evaluation: {type(e).__name__}: {e}'
+
+    print(f"{'class':>16} " + ' '.join(f'{name:>10}' for name in METRICS))
+    for class_name, metrics in results.items():
+        print(f"{class_name:>16} " + ' '.join(f'{metrics[name]:>10.3f}' for name in METRICS))
+    if results:
+        results['mean'] = mean_metrics(results)
+        print(f"{'mean':>16} " + ' '.join(f"{results['mean'][name]:>10.3f}" for name in METRICS))
+    for class_name, error in failed.items():
+        print(f"{class_name:>16} failed, {error}")
+    if failed:
+        results['failed'] = failed
+
+    results_file = args.results_file or os.path.join(args.output_folder, 'results.json')
+    os.makedirs(os.path.dirname(os.path.abspath(results_file)), exist_ok = True)
+    with open(results_file, 'w') as f:
+        json.dump(results, f, indent = 2)
+    print(f"Evaluated {len(args.class_names) - len(failed)}/{len(args.class_names)} class(es) in "
+          f"{time.perf_counter() - start:.1f} s, results in {results_file}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = build_parser(description='Compute I-AUROC, P-AUROC and AU-PRO on the test split of whole datasets.')
+    parser.add_argument('--eval_workers', default=4, type=int, help='Processes computing the metrics of the classes.')
+    parser.add_argument('--results_file', default=None, type=str, help='JSON file of the results (default: results.json in the output folder).')
+    parser.add_argument('--skip_inference', action='store_true', help='Only evaluate the predictions already in the output folder.')
+    args = parser.parse_args()
+
+    results = evaluate(args)
+    if 'failed' in results:
+        sys.exit(1)
@@ -0,0 +1,53 @@
+import argparse
+import os
+
+import torch
+
+from infer import FusionEncoder, DecoupledDecoder
+from models.compiled_models import export_backbones, export_heads
+from models.features import MultimodalFeatures
+from models.model_registry import cfm_checkpoint_paths
+
+
+def export_compiled(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    os.makedirs(args.output_folder, exist_ok=True)
+
+    if not args.skip_backbones:
+        print("Tracing the shared backbones...")
+        feature_extractor = MultimodalFeatures()
+        feature_extractor.eval()
+        export_backbones(feature_extractor, args.output_folder, freeze=not args.no_freeze)
+
+    class_names = args.class_names or sorted(c for c in os.listdir(args.checkpoint_folder)
+                                             if os.path.isdir(os.path.join(args.checkpoint_folder, c)))
+    for class_name in class_names:
+        checkpoints = cfm_checkpoint_paths(args.checkpoint_folder, class_name, epochs_no=args.epochs_no, batch_size=args.batch_size)
+        if not all(os.path.exists(p) for p in checkpoints):
+            print(f"Skipping {class_name}: missing checkpoints")
+            continue
+
+        print(f"Tracing the CFM heads of class: {class_name}")
+        fusion_encoder = FusionEncoder(in_features_2D=768, in_features_3D=1152, out_features=960)
+        decoder_2D = DecoupledDecoder(in_features=960, out_features=768)
+        decoder_3D = DecoupledDecoder(in_features=960, out_features=1152)
+        for module, checkpoint in zip((fusion_encoder, decoder_2D, decoder_3D), checkpoints):
+            module.load_state_dict(torch.load(checkpoint, map_location=device))
+            module.to(device).eval()
+        export_heads(fusion_encoder, decoder_2D, decoder_3D, args.output_folder, class_name, freeze=not args.no_freeze)
+
+    print(f"Saved the compiled models to {args.output_folder}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the backbones and the CFM heads as TorchScript artifacts for the inference server.')
+    parser.add_argument('--checkpoint_folder', default='./checkpoints/General', type=str, help='Path to the folder containing CFMs checkpoints.')
+    parser.add_argument('--output_folder', default='./checkpoints/compiled', type=str, help='Path to save the compiled artifacts.')
+    parser.add_argument('--class_names', default=None, type=str, nargs='+', help='Classes to export (default: every class with checkpoints).')
+    parser.add_argument('--epochs_no', default=100, type=int, help='Number of epochs used in training.')
+    parser.add_argument('--batch_size', default=1, type=int, help='Batch size used in training.')
+    parser.add_argument('--skip_backbones', action='store_true', help='Only export the CFM heads.')
+    parser.add_argument('--no_freeze', action='store_true', help='Keep the weights as module attributes instead of freezing them.')
+    args = parser.parse_args()
+
+    export_compiled(args)
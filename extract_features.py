@@ -0,0 +1,91 @@
+import argparse
+import os
+import time
+
+import torch
+
+import models.features as features
+from infer import set_seeds
+from models.dataset import get_data_loader, mvtec3d_classes, TestDataset, TrainValDataset, RGB_SIZE
+from models.features import MultimodalFeatures, backbone_config
+from utils.feature_cache_utils import module_fingerprint
+from utils.feature_store_utils import FeatureStore, feature_shapes
+
+
+def split_dataset(split, class_name, dataset_path):
+    if split == 'test':
+        return TestDataset(class_name = class_name, img_size = 224, dataset_path = dataset_path)
+    return TrainValDataset(split = split, class_name = class_name, img_size = 224, dataset_path = dataset_path)
+
+
+def extract_split(feature_extractor, fingerprint, class_name, split, args):
+    """Extract the pending samples of a class and split into its FeatureStore, return the number of samples extracted."""
+    if not os.path.isdir(os.path.join(args.dataset_path, class_name, split)):
+        print(f"{class_name}/{split}: no such split in {args.dataset_path}, skipped")
+        return 0
+
+    dataset = split_dataset(split, class_name, args.dataset_path)
+    test = split == 'test'
+    store = FeatureStore(os.path.join(args.output_folder, class_name, split), [rgb for rgb, _ in dataset.img_paths],
+                         dataset.labels, fingerprint, feature_shapes(features.num_group, feature_extractor.image_size),
+                         dtype = 'float16' if args.fp16 else 'float32',
+                         chunk_size = args.chunk_size, gt_size = RGB_SIZE if test else None, overwrite = args.overwrite)
+
+    pending = store.pending()
+    print(f"{class_name}/{split}: {len(store) - len(pending)}/{len(store)} sample(s) already extracted")
+    if not pending:
+        return 0
+
+    data_loader = get_data_loader(split, class_name = class_name, dataset_path = args.dataset_path,
+                                  batch_size = args.extract_batch_size, num_workers = args.num_workers,
+                                  prefetch_factor = args.prefetch_factor, indices = pending)
+
+    start, done = time.perf_counter(), 0
+    with torch.no_grad():
+        for batch in data_loader:
+            (rgb, pc, _), gts = batch[0], (batch[1] if test else None)
+            indices = pending[done:done + rgb.shape[0]]
+            # The backbone outputs only, the per-pixel features are upsampled from them on read.
+            rgb_maps, xyz_features, centers = feature_extractor.backbone_features_batch(rgb, pc)
+            if gts is not None:
+                gts = gts[:, 0].to(torch.uint8).numpy()
+            store.write(indices, {'rgb': rgb_maps.cpu().numpy(), 'xyz': xyz_features.cpu().numpy(),
+                                  'centers': centers.cpu().numpy(), 'pc': pc.numpy()}, gts)
+
+            done += len(indices)
+            print(f"{class_name}/{split}: {done}/{len(pending)} ({done / (time.perf_counter() - start):.2f} samples/s)")
+    return done
+
+
+def extract_features(args):
+    set_seeds()
+    torch.set_num_threads(args.threads)
+
+    feature_extractor = MultimodalFeatures()
+    feature_extractor.eval()
+    # Features extracted with other backbone weights or settings are never mixed in a store.
+    fingerprint = module_fingerprint(feature_extractor, backbone_config(feature_extractor.image_size))
+
+    start, total = time.perf_counter(), 0
+    for class_name in args.class_names:
+        for split in args.splits:
+            total += extract_split(feature_extractor, fingerprint, class_name, split, args)
+    print(f"Extracted the features of {total} sample(s) in {time.perf_counter() - start:.1f} s, stores in {args.output_folder}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute the backbone features of whole dataset splits into memory-mapped stores.')
+    parser.add_argument('--dataset_path', default='./datasets/mvtec3d', type=str, help='Dataset path.')
+    parser.add_argument('--class_names', default=mvtec3d_classes(), type=str, nargs='+', help='Categories to extract (default: every MVTec 3D-AD class).')
+    parser.add_argument('--splits', default=['train', 'test'], type=str, nargs='+', choices=['train', 'validation', 'test'], help='Dataset splits to extract.')
+    parser.add_argument('--output_folder', default='./datasets/features', type=str, help='Path of the feature stores, one folder per class and split.')
+    parser.add_argument('--fp16', action='store_true', help='Store the backbone features in float16 (half the size of float32).')
+    parser.add_argument('--chunk_size', default=16, type=int, help='Samples per chunk file.')
+    parser.add_argument('--extract_batch_size', default=4, type=int, help='Samples per backbone pass.')
+    parser.add_argument('--num_workers', default=4, type=int, help='DataLoader worker processes decoding the samples.')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='Batches loaded ahead by each worker.')
+    parser.add_argument('--overwrite', action='store_true', help='Discard the features of a previous run instead of resuming it.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    extract_features(args)
@@ -6,11 +6,9 @@ import numpy as np
 from PIL import Image
 import tifffile
 from models.features import MultimodalFeatures
+from utils.smoothing_utils import smooth_residuals
 import torch.nn as nn
 import torch.nn.functional as F
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 
 def set_seeds(sid=42):
     np.random.seed(sid)
@@ -110,6 +108,104 @@ class DecoupledDecoder(nn.Module):
         x = self.output_fc(x) + residual
         return x
 
+def foreground_rows(xyz_patch):
+    """
+    Indices of the rows of xyz_patch (N, C) with a 3D feature, i.e. the valid points and the halo the feature
+    pooling spreads around them. The other rows are masked out of the combined residual by combine_residuals.
+    """
+    return torch.nonzero(xyz_patch.sum(axis=-1) != 0).squeeze(1)
+
+def sparse_residuals(residuals_fn, rgb_patch, xyz_patch):
+    """
+    Run residuals_fn (rgb_rows, xyz_rows) -> (residual_2D, residual_3D) on the foreground rows only, and scatter the
+    (..., n) residuals back to (..., N) rows, the background ones being left at zero.
+    """
+    foreground = foreground_rows(xyz_patch)
+    residual_2D, residual_3D = residuals_fn(rgb_patch[foreground], xyz_patch[foreground])
+
+    def scatter(residual):
+        full = residual.new_zeros(residual.shape[:-1] + (xyz_patch.shape[0],))
+        return full.index_copy_(-1, foreground, residual)
+
+    return scatter(residual_2D), scatter(residual_3D)
+
+def compute_residuals(fusion_encoder, decoder_2D, decoder_3D, rgb_patch, xyz_patch, img_size=224, sparse=False):
+    """
+    Restore the patch features with the CFMs and compute the residual maps.
+
+    rgb_patch and xyz_patch hold the feature rows of B samples, either stacked as (B, img_size * img_size, C) or
+    flattened to (B * img_size * img_size, C).
+    Returns the 2D, 3D and smoothed combined residuals, each of shape (B, img_size, img_size).
+    With sparse, only the foreground rows go through the CFMs: the combined residual is unchanged, the 2D and 3D
+    residuals are zero on the background.
+    """
+    rgb_patch = rgb_patch.reshape(-1, rgb_patch.shape[-1])
+    xyz_patch = xyz_patch.reshape(-1, xyz_patch.shape[-1])
+
+    def residuals(rgb_rows, xyz_rows):
+        # Fusion and restoration
+        fusion_embedding = fusion_encoder(rgb_rows, xyz_rows)
+        restored_2D = decoder_2D(fusion_embedding)
+        restored_3D = decoder_3D(fusion_embedding)
+
+        # Calculate reconstruction residuals
+        return ((restored_2D - rgb_rows).pow(2).sum(-1).sqrt(),
+                (restored_3D - xyz_rows).pow(2).sum(-1).sqrt())
+
+    if sparse:
+        residual_2D, residual_3D = sparse_residuals(residuals, rgb_patch, xyz_patch)
+    else:
+        residual_2D, residual_3D = residuals(rgb_patch, xyz_patch)
+
+    return combine_residuals(residual_2D, residual_3D, xyz_patch, img_size)
+
+def combine_residuals(residual_2D, residual_3D, xyz_patch, img_size=224):
+    """
+    Combine the per-row 2D and 3D residuals (..., N) into the residual maps (..., B, img_size, img_size).
+    """
+    # Mask for valid 3D points
+    xyz_mask = (xyz_patch.sum(axis=-1) == 0)
+
+    # Combine residuals
+    residual_comb = (residual_2D * residual_3D)
+    residual_comb[..., xyz_mask] = 0.0
+
+    # Apply Gaussian blur approximation (5x5 box filter 5 times, then 7x7 box filter 3 times)
+    map_shape = residual_2D.shape[:-1] + (-1, img_size, img_size)
+    residual_comb = smooth_residuals(residual_comb.reshape(map_shape))
+
+    return (residual_2D.reshape(map_shape),
+            residual_3D.reshape(map_shape),
+            residual_comb)
+
+def compute_residuals_fused(fused_heads, rgb_patch, xyz_patch, img_size=224, sparse=False):
+    """compute_residuals with the inference export of the heads of a class (FusedCFMHeads)."""
+    rgb_patch = rgb_patch.reshape(-1, rgb_patch.shape[-1])
+    xyz_patch = xyz_patch.reshape(-1, xyz_patch.shape[-1])
+
+    if sparse:
+        residual_2D, residual_3D = sparse_residuals(fused_heads.residuals, rgb_patch, xyz_patch)
+    else:
+        residual_2D, residual_3D = fused_heads.residuals(rgb_patch, xyz_patch)
+    return combine_residuals(residual_2D, residual_3D, xyz_patch, img_size)
+
+def compute_residuals_multi(stacked_heads, rgb_patch, xyz_patch, img_size=224, sparse=False):
+    """
+    compute_residuals for K classes at once with StackedCFMHeads.
+
+    Returns the 2D, 3D and smoothed combined residuals, each of shape (K, B, img_size, img_size), and the anomaly
+    score (maximum of the combined residual) of every class and sample, of shape (K, B).
+    """
+    rgb_patch = rgb_patch.reshape(-1, rgb_patch.shape[-1])
+    xyz_patch = xyz_patch.reshape(-1, xyz_patch.shape[-1])
+
+    if sparse:
+        residual_2D, residual_3D = sparse_residuals(stacked_heads.residuals, rgb_patch, xyz_patch)
+    else:
+        residual_2D, residual_3D = stacked_heads.residuals(rgb_patch, xyz_patch)
+    residual_2D, residual_3D, residual_comb = combine_residuals(residual_2D, residual_3D, xyz_patch, img_size)
+    return residual_2D, residual_3D, residual_comb, residual_comb.amax(dim=(-2, -1))
+
 def load_image(image_path, img_size=224):
     """Load and preprocess an RGB image."""
     transform = transforms.Compose([
@@ -160,42 +256,21 @@ def infer_single_CFM(args):
     # Extract features
     with torch.no_grad():
         rgb_patch, xyz_patch = feature_extractor.get_features_maps(rgb, pc)
-
-        # Fusion and restoration
-        fusion_embedding = fusion_encoder(rgb_patch, xyz_patch)
-        restored_2D = decoder_2D(fusion_embedding)
-        restored_3D = decoder_3D(fusion_embedding)
-
-        # Mask for valid 3D points
-        xyz_mask = (xyz_patch.sum(axis=-1) == 0)
-
-        # Calculate reconstruction residuals
-        residual_2D = (restored_2D - rgb_patch).pow(2).sum(1).sqrt()
-        residual_3D = (restored_3D - xyz_patch).pow(2).sum(1).sqrt()
-
-        # Combine residuals
-        residual_comb = (residual_2D * residual_3D)
-        residual_comb[xyz_mask] = 0.0
-
-        # Apply Gaussian blur approximation
-        w_l, w_u = 5, 7
-        pad_l, pad_u = 2, 3
-        weight_l = torch.ones(1, 1, w_l, w_l, device=device) / (w_l**2)
-        weight_u = torch.ones(1, 1, w_u, w_u, device=device) / (w_u**2)
-        residual_comb = residual_comb.reshape(1, 1, 224, 224)
-        for _ in range(5):
-            residual_comb = F.conv2d(residual_comb, weight=weight_l, padding=pad_l)
-        for _ in range(3):
-            residual_comb = F.conv2d(residual_comb, weight=weight_u, padding=pad_u)
-        residual_comb = residual_comb.reshape(224, 224)
+        residual_2D, residual_3D, residual_comb = compute_residuals(fusion_encoder, decoder_2D, decoder_3D, rgb_patch, xyz_patch,
+                                                                      sparse=args.sparse)
 
     # Prepare outputs
-    residual_2D = residual_2D.reshape(224, 224).cpu().numpy()
-    residual_3D = residual_3D.reshape(224, 224).cpu().numpy()
-    residual_comb = residual_comb.cpu().numpy()
+    residual_2D = residual_2D[0].cpu().numpy()
+    residual_3D = residual_3D[0].cpu().numpy()
+    residual_comb = residual_comb[0].cpu().numpy()
 
     # Visualize results if requested
     if args.visualize_plot or args.produce_qualitatives:
+        # Imported here, the modules importing the CFMs from infer.py (e.g. app.py) do not need matplotlib
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+
         denormalize = transforms.Compose([
             transforms.Normalize(mean=[0., 0., 0.], std=[1/0.229, 1/0.224, 1/0.225]),
             transforms.Normalize(mean=[-0.485, -0.456, -0.406], std=[1., 1., 1.])
@@ -244,6 +319,7 @@ if __name__ == '__main__':
     parser.add_argument('--output_folder', default='./results/single_inference', type=str, help='Path to save the output residuals and visualizations.')
     parser.add_argument('--epochs_no', default=100, type=int, help='Number of epochs used in training.')
     parser.add_argument('--batch_size', default=1, type=int, help='Batch size used in training.')
+    parser.add_argument('--sparse', action='store_true', help='Run the CFMs on the foreground rows only (2D and 3D residuals are zero on the background).')
     parser.add_argument('--visualize_plot', action='store_true', help='Whether to display the visualization plot.')
     parser.add_argument('--produce_qualitatives', action='store_true', help='Whether to save the visualization.')
     args = parser.parse_args()
@@ -0,0 +1,122 @@
+import argparse
+import os
+import time
+
+import torch
+
+from infer import set_seeds, compute_residuals, compute_residuals_fused
+from models.dataset import PrecomputedFeaturesDataset, TestDataset, get_data_loader, mvtec3d_classes
+from models.features import upsample_features
+from models.model_registry import ModelRegistry, calibration_batches
+from utils.prediction_store_utils import PredictionStore
+from utils.quantization_utils import PRECISIONS
+
+
+def test_features(registry, inputs, features_path):
+    """(rgb_patch, xyz_patch) of a test batch, upsampled from the backbone outputs of a feature store or extracted."""
+    if features_path is not None:
+        rgb_maps, xyz_features, centers, pc = (tensor.to(registry.device, torch.float32) for tensor in inputs)
+        return upsample_features(pc, rgb_maps, xyz_features, centers)
+    rgb, pc, _ = inputs
+    return registry.get_features_maps_batch(rgb.to(registry.device), pc.to(registry.device))
+
+
+def infer_class(registry, class_name, args):
+    """
+    Score the pending test samples of a class into its PredictionStore, return the number of samples scored. With
+    args.features_path, the backbone outputs are read from the test FeatureStore of the class (see
+    extract_features.py) and the backbones do not run.
+    """
+    if args.features_path is not None:
+        dataset = PrecomputedFeaturesDataset('test', class_name = class_name, features_path = args.features_path)
+        sample_paths = dataset.img_paths
+    else:
+        dataset = TestDataset(class_name = class_name, img_size = 224, dataset_path = args.dataset_path)
+        sample_paths = [rgb for rgb, _ in dataset.img_paths]
+    map_names = ('residual_comb', 'residual_2D', 'residual_3D') if args.save_all_maps else ('residual_comb',)
+    store = PredictionStore(os.path.join(args.output_folder, class_name), sample_paths,
+                            dataset.labels, map_names = map_names, overwrite = args.overwrite)
+
+    pending = store.pending()
+    print(f"{class_name}: {len(store) - len(pending)}/{len(store)} sample(s) already scored")
+    if not pending:
+        return 0
+
+    heads = registry.get_heads(class_name)
+    test_loader = get_data_loader('test', class_name = class_name, dataset_path = args.dataset_path,
+                                  batch_size = args.infer_batch_size, num_workers = args.num_workers,
+                                  prefetch_factor = args.prefetch_factor, indices = pending,
+                                  features_path = args.features_path)
+
+    start, done = time.perf_counter(), 0
+    with torch.no_grad():
+        for inputs, _, _, _ in test_loader:
+            indices = pending[done:done + inputs[0].shape[0]]
+            rgb_patch, xyz_patch = test_features(registry, inputs, args.features_path)
+            if heads.fused is not None:
+                residuals = compute_residuals_fused(heads.fused, rgb_patch, xyz_patch, sparse = args.sparse)
+            else:
+                residuals = compute_residuals(*heads, rgb_patch, xyz_patch, sparse = args.sparse)
+            residual_2D, residual_3D, residual_comb = (r.cpu() for r in residuals)
+
+            maps = {'residual_comb': residual_comb, 'residual_2D': residual_2D, 'residual_3D': residual_3D}
+            store.write(indices, residual_comb.amax(dim = (-2, -1)).numpy(),
+                        {name: maps[name].numpy() for name in map_names})
+
+            done += len(indices)
+            elapsed = time.perf_counter() - start
+            print(f"{class_name}: {done}/{len(pending)} ({done / elapsed:.2f} samples/s)")
+
+    print(f"{class_name}: scores written to {store.export_csv()}")
+    return done
+
+
+def build_registry(args):
+    set_seeds()
+    torch.set_num_threads(args.threads)
+
+    calibration_data = None
+    if args.precision == 'int8-static':
+        calibration_data = list(calibration_batches(args.dataset_path, args.class_names))
+
+    # Models are loaded once: the backbones are shared and the heads of each class stay resident while it is scored.
+    return ModelRegistry(args.checkpoint_folder, epochs_no = args.epochs_no, batch_size = args.batch_size,
+                         fuse_heads = True, precision = args.precision, calibration_data = calibration_data,
+                         compiled_folder = args.compiled_folder)
+
+
+def infer_batch(args):
+    registry = build_registry(args)
+
+    start, total = time.perf_counter(), 0
+    for class_name in args.class_names:
+        total += infer_class(registry, class_name, args)
+        registry.clear()
+    print(f"Scored {total} sample(s) in {time.perf_counter() - start:.1f} s, predictions in {args.output_folder}")
+
+
+def build_parser(description = 'Score the test split of whole MVTec-style dataset folders, resuming interrupted runs.'):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--dataset_path', default='./datasets/mvtec3d', type=str, help='Dataset path.')
+    parser.add_argument('--features_path', default=None, type=str, help='Feature stores written by extract_features.py (default: run the backbones on the fly).')
+    parser.add_argument('--class_names', default=mvtec3d_classes(), type=str, nargs='+', help='Categories to score (default: every MVTec 3D-AD class).')
+    parser.add_argument('--checkpoint_folder', default='./checkpoints/General', type=str, help='Path to the folder containing CFMs checkpoints.')
+    parser.add_argument('--output_folder', default='./results/batch_inference', type=str, help='Path of the prediction stores, one folder per class.')
+    parser.add_argument('--epochs_no', default=100, type=int, help='Number of epochs used in training.')
+    parser.add_argument('--batch_size', default=1, type=int, help='Batch size used in training.')
+    parser.add_argument('--infer_batch_size', default=4, type=int, help='Samples per backbone and CFM pass.')
+    parser.add_argument('--num_workers', default=4, type=int, help='DataLoader worker processes decoding the samples.')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='Batches loaded ahead by each worker.')
+    parser.add_argument('--precision', default='fp32', choices=PRECISIONS, help='Inference precision of the backbones and heads.')
+    parser.add_argument('--compiled_folder', default=None, type=str, help='Folder of the TorchScript artifacts written by export_compiled.py (fp32 only).')
+    parser.add_argument('--sparse', action='store_true', help='Run the CFMs on the foreground rows only (2D and 3D residuals are zero on the background).')
+    parser.add_argument('--save_all_maps', action='store_true', help='Also store the 2D and 3D residual maps, not only the combined one.')
+    parser.add_argument('--overwrite', action='store_true', help='Discard the predictions of a previous run instead of resuming it.')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_parser().parse_args()
+
+    infer_batch(args)
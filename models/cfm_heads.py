@@ -0,0 +1,298 @@
+import contextlib
+
+import torch
+import torch.nn.functional as F
+
+
+def folded_cbam(x, channel_fc1, channel_fc2, spatial_weights):
+    """
+    CBAM of DecoupledDecoder applied to feature rows, without the 1x1 spatial dimensions.
+
+    On a 1x1 map the average and max pooling of ChannelAttention both return the input, so its output is
+    x * sigmoid(2 * fc(x)), and the 7x7 convolution of SpatialAttention only sees its center tap, so it reduces to
+    x * sigmoid(w_avg * mean(x) + w_max * max(x)).
+
+    Input:
+        x: [..., C]
+        channel_fc1, channel_fc2: (weight, bias) of the channel attention MLP, as taken by linear
+        spatial_weights: [..., 2] center taps of the spatial attention convolution (avg, max)
+    """
+    channel = linear(F.relu(linear(x, *channel_fc1)), *channel_fc2)
+    x = x * torch.sigmoid(2 * channel)
+    spatial = spatial_weights[..., :1] * x.mean(dim=-1, keepdim=True) + spatial_weights[..., 1:] * x.amax(dim=-1, keepdim=True)
+    return x * torch.sigmoid(spatial)
+
+
+def linear(x, weight, bias):
+    """
+    Linear layer on rows, or on a stack of K heads.
+
+    Input:
+        x: [N, C_in] or [K, N, C_in]
+        weight: [C_in, C_out] or [K, C_in, C_out] (transposed nn.Linear weight)
+        bias: [1, C_out] or [K, 1, C_out]
+    """
+    if weight.dim() == 2:
+        return torch.addmm(bias, x, weight)
+    if x.dim() == 2:
+        x = x.unsqueeze(0).expand(weight.shape[0], -1, -1)
+    return torch.baddbmm(bias, x, weight)
+
+
+def layer_norm(x, weight, bias, eps):
+    return F.layer_norm(x, x.shape[-1:], eps=eps) * weight + bias
+
+
+def stack(tensors):
+    """The tensor of one head as is, or the tensors of K heads stacked along a new leading class dimension."""
+    return tensors[0] if len(tensors) == 1 else torch.stack(tensors)
+
+
+def stack_linear(layers):
+    """(weight, bias) of the nn.Linear layers of K heads, as taken by linear: ([K, C_in, C_out], [K, 1, C_out])."""
+    weight = stack([layer.weight.detach().t().contiguous() for layer in layers])
+    bias = stack([layer.bias.detach().unsqueeze(0) for layer in layers])
+    return weight, bias
+
+
+def stack_layer_norm(norms):
+    weight = stack([norm.weight.detach().unsqueeze(0) for norm in norms])
+    bias = stack([norm.bias.detach().unsqueeze(0) for norm in norms])
+    return weight, bias
+
+
+def spatial_center_taps(spatial_attention):
+    """Center taps [1, 2] (avg, max) of the SpatialAttention convolution, the only ones seen by a 1x1 map."""
+    height, width = spatial_attention.conv.kernel_size
+    return spatial_attention.conv.weight.detach()[0, :, height // 2, width // 2].unsqueeze(0)
+
+
+def encoder_params(encoders):
+    """Weights of the FusionEncoders of K heads (of one head without the class dimension), see encode_hidden."""
+    return {
+        'input_fc': stack_linear([e.input_fc for e in encoders]),
+        'layers': [stack_linear(layers) for layers in zip(*[e.layers for e in encoders])],
+        'output_fc': stack_linear([e.output_fc for e in encoders]),
+        'norm': stack_layer_norm([e.layer_norm for e in encoders]),
+        'eps': encoders[0].layer_norm.eps,
+    }
+
+
+def decoder_params(decoders):
+    """Weights of the DecoupledDecoders of K heads (of one head without the class dimension), see decode_hidden."""
+    skip = decoders[0].skip
+    return {
+        'skip': None if isinstance(skip, torch.nn.Identity) else stack_linear([d.skip for d in decoders]),
+        'input_fc': stack_linear([d.input_fc for d in decoders]),
+        'layers': [stack_linear(layers) for layers in zip(*[d.layers for d in decoders])],
+        'output_fc': stack_linear([d.output_fc for d in decoders]),
+        'norm': stack_layer_norm([d.norm for d in decoders]),
+        'eps': decoders[0].norm.eps,
+        'channel_fc1': stack_linear([d.cbam.channel_attention.fc[0] for d in decoders]),
+        'channel_fc2': stack_linear([d.cbam.channel_attention.fc[2] for d in decoders]),
+        'spatial_weights': stack([spatial_center_taps(d.cbam.spatial_attention) for d in decoders]),
+    }
+
+
+def encode_hidden(x, p):
+    """FusionEncoder after its input layer: x is the output of input_fc, p the encoder_params."""
+    x = layer_norm(F.gelu(x), *p['norm'], p['eps'])
+    for layer in p['layers']:
+        x = layer_norm(F.gelu(linear(x, *layer)), *p['norm'], p['eps'])
+    return linear(x, *p['output_fc'])
+
+
+def decode_hidden(x, residual, p):
+    """
+    DecoupledDecoder after its input layer: x is the output of input_fc, residual the skip connection (the fusion
+    embedding or its skip projection), p the decoder_params. Dropout is skipped and CBAM folded (see folded_cbam).
+    """
+    x = F.gelu(layer_norm(x, *p['norm'], p['eps']))
+    for layer in p['layers']:
+        x = F.gelu(layer_norm(linear(x, *layer), *p['norm'], p['eps']))
+    x = folded_cbam(x, p['channel_fc1'], p['channel_fc2'], p['spatial_weights'])
+    return linear(x, *p['output_fc']) + residual
+
+
+def param_tensors(value):
+    """Tensors of nested parameter dicts, lists and tuples."""
+    if isinstance(value, torch.Tensor):
+        yield value
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            yield from param_tensors(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from param_tensors(item)
+
+
+def compute_context(device_type, compute_dtype):
+    """Autocast of the matmuls to compute_dtype (e.g. torch.bfloat16), or no-op for None."""
+    if compute_dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=compute_dtype)
+
+
+class StackedCFMHeads:
+    """
+    The FusionEncoder / DecoupledDecoder triplets of K classes evaluated together.
+
+    The weights of every layer are stacked along a leading class dimension, so each layer of all the classes runs
+    as a single batched matmul on the shared patch features. Dropout is skipped (inference only) and CBAM is folded
+    (see folded_cbam). Rows are processed in chunks of at most chunk_size // K rows to bound the memory of the
+    [K, rows, C] activations. With compute_dtype the matmuls are autocast to it, as in FusedCFMHeads.
+    """
+
+    def __init__(self, heads, chunk_size = 32768, compute_dtype = None):
+        heads = list(heads)
+        self.class_names = [h.class_name for h in heads]
+        self.chunk_size = chunk_size
+        self.compute_dtype = compute_dtype
+
+        self.encoder = encoder_params([h.fusion_encoder for h in heads])
+        self.decoder_2D = decoder_params([h.decoder_2D for h in heads])
+        self.decoder_3D = decoder_params([h.decoder_3D for h in heads])
+
+    def __len__(self):
+        return len(self.class_names)
+
+    def tensors(self):
+        return param_tensors((self.encoder, self.decoder_2D, self.decoder_3D))
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.tensors())
+
+    def encode(self, x_2D, x_3D):
+        x = linear(torch.cat((x_2D, x_3D), dim=-1), *self.encoder['input_fc'])
+        return encode_hidden(x, self.encoder)
+
+    @staticmethod
+    def decode(p, x):
+        residual = x if p['skip'] is None else linear(x, *p['skip'])
+        return decode_hidden(linear(x, *p['input_fc']), residual, p)
+
+    def residuals(self, rgb_patch, xyz_patch):
+        """
+        Input:
+            rgb_patch: [N, 768], xyz_patch: [N, 1152] feature rows shared by all the classes
+        Return:
+            residual_2D, residual_3D: [K, N] reconstruction errors of every class
+        """
+        num_rows = rgb_patch.shape[0]
+        residual_2D = rgb_patch.new_empty((len(self), num_rows))
+        residual_3D = rgb_patch.new_empty((len(self), num_rows))
+
+        rows_per_chunk = max(1, self.chunk_size // len(self))
+        with compute_context(rgb_patch.device.type, self.compute_dtype):
+            for start in range(0, num_rows, rows_per_chunk):
+                rgb_rows = rgb_patch[start:start + rows_per_chunk]
+                xyz_rows = xyz_patch[start:start + rows_per_chunk]
+                embedding = self.encode(rgb_rows, xyz_rows)
+                residual_2D[:, start:start + rows_per_chunk] = (self.decode(self.decoder_2D, embedding) - rgb_rows).pow(2).sum(-1).sqrt()
+                residual_3D[:, start:start + rows_per_chunk] = (self.decode(self.decoder_3D, embedding) - xyz_rows).pow(2).sum(-1).sqrt()
+        return residual_2D, residual_3D
+
+
+class FusedCFMHeads:
+    """
+    Inference export of the FusionEncoder / DecoupledDecoder triplet of one class, with the weights and layers of
+    StackedCFMHeads for a single class (see encoder_params / decoder_params) and two more fusions:
+
+    - the encoder input layer is split by modality, so the 2D and 3D rows are never concatenated;
+    - the input layers and the skip projections of both decoders, which all read the fusion embedding, run as a
+      single matmul with their weights concatenated along the output dimension.
+    Rows are processed in chunks of chunk_size to bound the activation memory.
+    With compute_dtype (e.g. torch.bfloat16) the matmuls are autocast to it, the residuals stay in fp32.
+    """
+
+    def __init__(self, fusion_encoder, decoder_2D, decoder_3D, chunk_size = 2048, compute_dtype = None):
+        self.chunk_size = chunk_size
+        self.compute_dtype = compute_dtype
+
+        # decoder_2D restores the 2D features, so its output width is the 2D input width of the encoder.
+        self.encoder = encoder_params([fusion_encoder])
+        weight, bias = self.encoder.pop('input_fc')
+        in_features_2D = decoder_2D.output_fc.out_features
+        self.encoder_input_2D = (weight[:in_features_2D].contiguous(), bias)
+        self.encoder_input_3D = weight[in_features_2D:].contiguous()
+
+        # Layers reading the fusion embedding, concatenated: [input_fc 2D | input_fc 3D | skip 2D | skip 3D]
+        self.decoders = [decoder_params([d]) for d in (decoder_2D, decoder_3D)]
+        entry = [p.pop('input_fc') for p in self.decoders] + [p['skip'] for p in self.decoders if p['skip'] is not None]
+        self.decoder_entry = (torch.cat([w for w, _ in entry], dim=1), torch.cat([b for _, b in entry], dim=1))
+        self.decoder_entry_splits = [w.shape[1] for w, _ in entry]
+        for p in self.decoders:
+            p['has_skip'] = p.pop('skip') is not None
+
+    def tensors(self):
+        return param_tensors((self.encoder_input_2D, self.encoder_input_3D, self.encoder, self.decoder_entry, self.decoders))
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.tensors())
+
+    def encode(self, x_2D, x_3D):
+        weight, bias = self.encoder_input_2D
+        x = torch.addmm(torch.addmm(bias, x_2D, weight), x_3D, self.encoder_input_3D)
+        return encode_hidden(x, self.encoder)
+
+    def decode(self, embedding):
+        """Return the restored 2D and 3D features of the fusion embedding rows."""
+        entry = linear(embedding, *self.decoder_entry).split(self.decoder_entry_splits, dim=-1)
+        hidden, skips = entry[:2], list(entry[2:])
+        return [decode_hidden(x, skips.pop(0) if p['has_skip'] else embedding, p) for p, x in zip(self.decoders, hidden)]
+
+    def __call__(self, rgb_patch, xyz_patch):
+        """Return the restored 2D and 3D features of all the rows (without chunking)."""
+        return self.decode(self.encode(rgb_patch, xyz_patch))
+
+    def residuals(self, rgb_patch, xyz_patch):
+        """
+        Input:
+            rgb_patch: [N, 768], xyz_patch: [N, 1152] feature rows
+        Return:
+            residual_2D, residual_3D: [N] reconstruction errors
+        """
+        with compute_context(rgb_patch.device.type, self.compute_dtype):
+            return chunked_residuals(self, rgb_patch, xyz_patch, self.chunk_size)
+
+
+def chunked_residuals(restore, rgb_patch, xyz_patch, chunk_size):
+    """
+    Reconstruction errors [N] of the rows of rgb_patch [N, 768] and xyz_patch [N, 1152], restored chunk_size rows
+    at a time by restore(rgb_rows, xyz_rows) -> (restored_2D, restored_3D).
+    """
+    num_rows = rgb_patch.shape[0]
+    residual_2D = rgb_patch.new_empty(num_rows)
+    residual_3D = rgb_patch.new_empty(num_rows)
+
+    for start in range(0, num_rows, chunk_size):
+        rgb_rows = rgb_patch[start:start + chunk_size]
+        xyz_rows = xyz_patch[start:start + chunk_size]
+        restored_2D, restored_3D = restore(rgb_rows, xyz_rows)
+        # Elementwise ops are not autocast, the residuals are computed in the dtype of the rows.
+        residual_2D[start:start + chunk_size] = (restored_2D - rgb_rows).pow(2).sum(-1).sqrt()
+        residual_3D[start:start + chunk_size] = (restored_3D - xyz_rows).pow(2).sum(-1).sqrt()
+    return residual_2D, residual_3D
+
+
+def validate_fused_heads(fused_heads, fusion_encoder, decoder_2D, decoder_3D, num_rows = 256, rtol = 1e-4, seed = 0):
+    """
+    Compare the restored features of an export (FusedCFMHeads or CompiledCFMHeads) with the eval-mode modules on
+    random rows. Returns the largest error relative to the feature scale, and raises if it exceeds rtol.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    device = next(decoder_2D.parameters()).device
+    rgb_rows = torch.randn(num_rows, decoder_2D.output_fc.out_features, generator=generator).to(device)
+    xyz_rows = torch.randn(num_rows, decoder_3D.output_fc.out_features, generator=generator).to(device)
+
+    with torch.no_grad():
+        embedding = fusion_encoder.eval()(rgb_rows, xyz_rows)
+        expected = (decoder_2D.eval()(embedding), decoder_3D.eval()(embedding))
+        restored = fused_heads(rgb_rows, xyz_rows)
+
+    error = max(((r - e).abs().max() / e.abs().max().clamp(min=1e-12)).item() for r, e in zip(restored, expected))
+    if error > rtol:
+        raise Exception(f"Exported CFM heads do not match the modules: relative error {error:.2e} > {rtol:.0e}")
+    return error
@@ -0,0 +1,162 @@
+import os
+import zipfile
+
+import torch
+import torch.nn as nn
+
+from models.cfm_heads import chunked_residuals
+from models.features import backbone_config
+from models.full_models import COMPILED_RGB_FILE, COMPILED_XYZ_FILE
+from utils.feature_cache_utils import module_fingerprint
+
+# TorchScript artifact of the CFM heads of a class, in <compiled_folder>/<class_name>/.
+COMPILED_HEADS_FILE = 'cfm_heads.pt'
+# Extra file of every artifact identifying what it was traced from: the backbone settings, or the heads weights.
+SOURCE_FINGERPRINT_FILE = 'source_fingerprint'
+
+
+class RGBFeatureStage(nn.Module):
+    """FeatureExtractors.forward_rgb_features (DINO patch embedding to the 28x28 feature map) as a module."""
+
+    def __init__(self, feature_extractors):
+        super().__init__()
+        self.feature_extractors = feature_extractors
+
+    def forward(self, rgb):
+        return self.feature_extractors.forward_rgb_features(rgb)
+
+
+class PointTokenStage(nn.Module):
+    """PointTransformer.forward_tokens: the mini-PointNet, positional embedding and transformer on point groups."""
+
+    def __init__(self, point_transformer):
+        super().__init__()
+        self.point_transformer = point_transformer
+
+    def forward(self, neighborhood, center):
+        return self.point_transformer.forward_tokens(neighborhood, center)
+
+
+class CFMHeadsStage(nn.Module):
+    """FusionEncoder and both DecoupledDecoders of a class, restoring the 2D and 3D features of feature rows."""
+
+    def __init__(self, fusion_encoder, decoder_2D, decoder_3D):
+        super().__init__()
+        self.fusion_encoder = fusion_encoder
+        self.decoder_2D = decoder_2D
+        self.decoder_3D = decoder_3D
+
+    def forward(self, rgb_rows, xyz_rows):
+        fusion_embedding = self.fusion_encoder(rgb_rows, xyz_rows)
+        return self.decoder_2D(fusion_embedding), self.decoder_3D(fusion_embedding)
+
+
+class CompiledCFMHeads:
+    """Traced CFMHeadsStage with the residuals interface of FusedCFMHeads (see infer.compute_residuals_fused)."""
+
+    def __init__(self, module, chunk_size = 2048):
+        self.module = module
+        self.chunk_size = chunk_size
+
+    def __call__(self, rgb_rows, xyz_rows):
+        return self.module(rgb_rows, xyz_rows)
+
+    def residuals(self, rgb_patch, xyz_patch):
+        return chunked_residuals(self, rgb_patch, xyz_patch, self.chunk_size)
+
+
+def trace_module(module, example_inputs, freeze = True):
+    """
+    Trace an eval-mode module. The Python control flow (e.g. the encoder_dims branch and the tapped blocks of
+    PointTransformer) is resolved at trace time; freezing inlines the weights and folds the constant ops.
+    """
+    module = module.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_inputs, check_trace = False)
+    return torch.jit.freeze(traced) if freeze else traced
+
+
+def save_traced(module, path, source_fingerprint):
+    module.save(path, _extra_files = {SOURCE_FINGERPRINT_FILE: source_fingerprint})
+
+
+def read_source_fingerprint(path):
+    """Source fingerprint stored in a TorchScript artifact (None for older exports), without loading the module."""
+    with zipfile.ZipFile(path) as archive:
+        names = [n for n in archive.namelist() if n.endswith(f'/extra/{SOURCE_FINGERPRINT_FILE}')]
+        return archive.read(names[0]).decode() if names else None
+
+
+def heads_fingerprint(fusion_encoder, decoder_2D, decoder_3D):
+    """Fingerprint of the weights of the CFM heads of a class, i.e. of the checkpoints they were loaded from."""
+    return module_fingerprint(CFMHeadsStage(fusion_encoder, decoder_2D, decoder_3D))
+
+
+def export_backbones(feature_extractor, compiled_folder, freeze = True):
+    """Trace the RGB stage and the point token stage of a MultimodalFeatures into compiled_folder."""
+    os.makedirs(compiled_folder, exist_ok = True)
+    extractors = feature_extractor.deep_feature_extractor
+    device = next(extractors.parameters()).device
+    image_size = feature_extractor.image_size
+    group_divider = extractors.xyz_backbone.group_divider
+
+    rgb = torch.randn(1, 3, image_size, image_size, device = device)
+    rgb_stage = trace_module(RGBFeatureStage(extractors), (rgb,), freeze)
+    config = backbone_config(image_size)
+    save_traced(rgb_stage, os.path.join(compiled_folder, COMPILED_RGB_FILE), config)
+
+    neighborhood = torch.randn(1, group_divider.num_group, group_divider.group_size, 3, device = device) * 0.01
+    center = torch.randn(1, group_divider.num_group, 3, device = device)
+    xyz_stage = trace_module(PointTokenStage(extractors.xyz_backbone), (neighborhood, center), freeze)
+    # The group count and size are baked in the traced shapes, the tapped Point-MAE blocks in the graph.
+    save_traced(xyz_stage, os.path.join(compiled_folder, COMPILED_XYZ_FILE), config)
+
+
+def export_heads(fusion_encoder, decoder_2D, decoder_3D, compiled_folder, class_name, freeze = True):
+    """Trace the CFM heads of a class into compiled_folder/class_name."""
+    class_folder = os.path.join(compiled_folder, class_name)
+    os.makedirs(class_folder, exist_ok = True)
+    device = next(fusion_encoder.parameters()).device
+
+    rgb_rows = torch.randn(256, decoder_2D.output_fc.out_features, device = device)
+    xyz_rows = torch.randn(256, decoder_3D.output_fc.out_features, device = device)
+    heads_stage = trace_module(CFMHeadsStage(fusion_encoder, decoder_2D, decoder_3D), (rgb_rows, xyz_rows), freeze)
+    save_traced(heads_stage, os.path.join(class_folder, COMPILED_HEADS_FILE),
+                heads_fingerprint(fusion_encoder, decoder_2D, decoder_3D))
+
+
+def compiled_backbones_available(compiled_folder, config):
+    """
+    True if both backbones were exported with the settings config (see models.features.backbone_config).
+    Artifacts traced with other settings, e.g. another xyz_feature_layers, are stale and reported.
+    """
+    if compiled_folder is None:
+        return False
+    paths = [os.path.join(compiled_folder, f) for f in (COMPILED_RGB_FILE, COMPILED_XYZ_FILE)]
+    if not all(os.path.exists(p) for p in paths):
+        return False
+    for path in paths:
+        exported = read_source_fingerprint(path)
+        if exported != config:
+            print(f"Ignoring stale compiled backbone {path}: exported with {exported}, expected {config}")
+            return False
+    return True
+
+
+def load_compiled_heads(compiled_folder, class_name, device, source_fingerprint):
+    """
+    Return the CompiledCFMHeads of a class, or None if it was not exported or was traced from other checkpoints
+    than the ones of fingerprint source_fingerprint (see heads_fingerprint).
+    """
+    if compiled_folder is None:
+        return None
+    path = os.path.join(compiled_folder, class_name, COMPILED_HEADS_FILE)
+    if not os.path.exists(path):
+        return None
+    extra_files = {SOURCE_FINGERPRINT_FILE: ''}
+    module = torch.jit.load(path, map_location = device, _extra_files = extra_files)
+    # Exports without the extra file keep the empty placeholder and count as stale.
+    if extra_files[SOURCE_FINGERPRINT_FILE] != source_fingerprint.encode():
+        print(f"Ignoring stale compiled CFM heads {path}: traced from other checkpoints")
+        return None
+    return CompiledCFMHeads(module)
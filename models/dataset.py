@@ -4,9 +4,10 @@ from torchvision import transforms
 import glob
 from torch.utils.data import Dataset
 from utils.mvtec3d_utils import *
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 import numpy as np
 from utils.general_utils import SquarePad
+from utils.feature_store_utils import FeatureStoreReader
 
 def eyecandies_classes():
     return [
@@ -164,15 +165,59 @@ class TestDataset(BaseAnomalyDetectionDataset):
         return (img, resized_organized_pc, resized_depth_map_3channel), gt[:1], label, rgb_path
 
 
-def get_data_loader(split, class_name, dataset_path, img_size = 224, batch_size = 1, shuffle = False):
-    if split in ['train']:
+class PrecomputedFeaturesDataset(Dataset):
+    """
+    Backbone outputs of the samples of a class and split, read from the FeatureStore written by
+    extract_features.py instead of decoding the samples and running the backbones.
+
+    Items are ((rgb_maps, xyz_features, centers, pc), label) for the train and validation splits and
+    ((rgb_maps, xyz_features, centers, pc), gt, label, rgb_path) for the test split, as in TrainValDataset /
+    TestDataset, with rgb_maps (768, 28, 28) and xyz_features (1152, num_group) in the dtype of the store, centers
+    (num_group, 3) and the organized point cloud pc (3, 224, 224) in float32. models.features.upsample_features turns
+    a batch of them into the features of MultimodalFeatures.get_features_maps_batch.
+    """
+    def __init__(self, split, class_name, features_path):
+        self.split = split
+        self.reader = FeatureStoreReader(os.path.join(features_path, class_name, split))
+        self.labels = self.reader.manifest['labels']
+        self.img_paths = self.reader.manifest['samples']
+
+    def __len__(self):
+        return len(self.reader)
+
+    def __getitem__(self, idx):
+        # Tensors sharing the memory of the copy-on-write mapped chunks.
+        features = tuple(torch.from_numpy(array) for array in self.reader.features(idx))
+        label = self.labels[idx]
+        if self.split != 'test':
+            return features, label
+
+        gt = torch.from_numpy(self.reader.gt(idx)).float().unsqueeze(0)
+        return features, gt, label, self.img_paths[idx]
+
+
+def get_data_loader(split, class_name, dataset_path, img_size = 224, batch_size = 1, shuffle = False,
+                    num_workers = 1, prefetch_factor = None, indices = None, features_path = None):
+    if features_path is not None:
+        # Precomputed backbone features (see extract_features.py) instead of the decoded samples.
+        dataset = PrecomputedFeaturesDataset(split = split, class_name = class_name, features_path = features_path)
+    elif split in ['train']:
         dataset = TrainValDataset(split = "train", class_name = class_name, img_size = img_size, dataset_path = dataset_path)
     elif split in ['validation']:
         dataset = TrainValDataset(split = "validation", class_name = class_name, img_size = img_size, dataset_path = dataset_path)
     elif split in ['test']:
         dataset = TestDataset(class_name = class_name, img_size = img_size, dataset_path = dataset_path)
 
+    if indices is not None:
+        # Only load these samples (e.g. the ones a resumed run has left), in the given order.
+        dataset = Subset(dataset, indices)
+
+    # prefetch_factor (batches loaded ahead by each worker) is only valid with worker processes, and torch 1.13
+    # rejects an explicit None: left out, the DataLoader default applies.
+    loader_kwargs = {}
+    if prefetch_factor is not None and num_workers > 0:
+        loader_kwargs['prefetch_factor'] = prefetch_factor
     data_loader = DataLoader(dataset = dataset, batch_size = batch_size, shuffle = shuffle, 
-                             num_workers = 1, drop_last = False, pin_memory = True)
+                             num_workers = num_workers, drop_last = False, pin_memory = True, **loader_kwargs)
     
     return data_loader
@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
 
 from sklearn.metrics import roc_auc_score
@@ -10,16 +11,28 @@ from models.full_models import FeatureExtractors
 dino_backbone_name = 'vit_base_patch8_224.dino' # 224/8 -> 28 patches.
 group_size = 128
 num_group = 1024
+knn_method = 'chunked' if torch.cuda.is_available() else 'kdtree' # 'dense', 'chunked' or 'kdtree', see models.full_models.KNN.
+knn_chunk_size = 64
+interpolation_chunk_size = 4096 # Points interpolated at once by interpolating_points.
+fps_backend = None # 'cuda', 'cpu', 'voxel' or None for automatic selection, see models.full_models.fps.
+xyz_feature_layers = None # Point-MAE blocks concatenated into the XYZ features, None for models.full_models.default_feature_layers.
+
+def backbone_config(image_size = 224):
+    """Settings of the backbones above, as recorded in the compiled artifacts and the feature cache fingerprints."""
+    return f'{dino_backbone_name}/{group_size}/{num_group}/{fps_backend}/{xyz_feature_layers}/{image_size}'
 
 class MultimodalFeatures(torch.nn.Module):
-    def __init__(self, image_size = 224):
+    def __init__(self, image_size = 224, compiled_folder = None):
         super().__init__()
 
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
 
         self.deep_feature_extractor = FeatureExtractors(device = self.device, 
                                                  rgb_backbone_name = dino_backbone_name, 
-                                                 group_size = group_size, num_group = num_group)
+                                                 group_size = group_size, num_group = num_group,
+                                                 knn_method = knn_method, knn_chunk_size = knn_chunk_size,
+                                                 fps_backend = fps_backend, xyz_feature_layers = xyz_feature_layers,
+                                                 compiled_folder = compiled_folder)
 
         self.deep_feature_extractor.to(self.device)
 
@@ -31,15 +44,17 @@ class MultimodalFeatures(torch.nn.Module):
         
         self.average = torch.nn.AvgPool2d(kernel_size = 3, stride = 1) 
 
-    def __call__(self, rgb, xyz):
+    def __call__(self, rgb, xyz, mask = None):
         rgb = rgb.to(self.device)
         xyz = xyz.to(self.device)
+        if mask is not None:
+            mask = mask.to(self.device)
 
         with torch.no_grad():
-            rgb_feature_maps, xyz_feature_maps, center, ori_idx, center_idx = self.deep_feature_extractor(rgb, xyz)
+            rgb_feature_maps, xyz_feature_maps, center, ori_idx, center_idx = self.deep_feature_extractor(rgb, xyz, mask)
 
 
-        interpolated_feature_maps = interpolating_points(xyz, center.permute(0,2,1), xyz_feature_maps)
+        interpolated_feature_maps = interpolating_points(xyz, center.permute(0,2,1), xyz_feature_maps, chunk_size = interpolation_chunk_size)
 
         xyz_feature_maps = [fmap for fmap in [xyz_feature_maps]]
         rgb_feature_maps = [fmap for fmap in [rgb_feature_maps]]
@@ -56,31 +71,104 @@ class MultimodalFeatures(torch.nn.Module):
         self.au_pro, _ = calculate_au_pro(self.gts, self.predictions)
 
     def get_features_maps(self, rgb, pc):
-
-        unorganized_pc = pc.squeeze().permute(1, 2, 0).reshape(-1, pc.shape[1])
-
-        # Find nonzero indices.
-        nonzero_indices = torch.nonzero(torch.all(unorganized_pc != 0, dim=1)).squeeze(dim=1)
-
-        # Select nonzero indices and discard the others.
-        unorganized_pc_no_zeros = unorganized_pc[nonzero_indices, :].unsqueeze(dim=0).permute(0, 2, 1)
-
-        rgb_feature_maps, xyz_feature_maps, center, neighbor_idx, center_idx, interpolated_pc = self(rgb, unorganized_pc_no_zeros.contiguous())
-                
-        # Interpolation to obtain a "full image" with point cloud features.
-        xyz_patch = torch.cat(xyz_feature_maps, 1)
-
-        xyz_patch_full = torch.zeros((1, interpolated_pc.shape[1], self.image_size * self.image_size), dtype = xyz_patch.dtype, device = self.device)
-        xyz_patch_full[..., nonzero_indices] = interpolated_pc
-        
-        xyz_patch_full_2d = xyz_patch_full.view(1, interpolated_pc.shape[1], self.image_size, self.image_size)
-        xyz_patch_full_resized = self.resize(self.average(xyz_patch_full_2d))
-        xyz_patch = xyz_patch_full_resized.reshape(xyz_patch_full_resized.shape[1], -1).T 
-
-        rgb_patch = torch.cat(rgb_feature_maps, 1)
-
-        upsample_shape = xyz_patch_full_resized.shape[-2:]
-        rgb_patch_upsample = torch.nn.functional.interpolate(rgb_patch, size = upsample_shape, mode = 'bilinear', align_corners = False)
-        rgb_patch_upsample = rgb_patch_upsample.reshape(rgb_patch.shape[1], -1).T
-
-        return rgb_patch_upsample, xyz_patch
\ No newline at end of file
+        rgb_patch, xyz_patch = self.get_features_maps_batch(rgb, pc)
+
+        return rgb_patch[0], xyz_patch[0]
+
+    def get_features_maps_batch(self, rgb, pc):
+        """
+        Batched version of get_features_maps.
+
+        Input:
+            rgb: normalized RGB images, [B, 3, H, W]
+            pc: organized point clouds, [B, 3, image_size, image_size]
+        Return:
+            rgb_patch: [B, image_size * image_size, 768]
+            xyz_patch: [B, image_size * image_size, 1152]
+
+        The backbones run on the batch (see backbone_features_batch), then their outputs are upsampled to one row
+        per pixel (see upsample_features).
+        """
+        pc = pc.to(self.device)
+        padding = pad_point_clouds(pc)
+        rgb_maps, xyz_features, centers = self.backbone_features_batch(rgb, pc, padding)
+        return upsample_features(pc, rgb_maps, xyz_features, centers, self.image_size, padding)
+
+    def backbone_features_batch(self, rgb, pc, padding = None):
+        """
+        Outputs of the backbones, before the upsampling of get_features_maps_batch: a few MB per sample, against
+        hundreds for the upsampled features.
+
+        Input:
+            rgb: normalized RGB images, [B, 3, H, W]
+            pc: organized point clouds, [B, 3, image_size, image_size]
+            padding: pad_point_clouds(pc), if already computed
+        Return:
+            rgb_maps: DINO feature maps, [B, 768, 28, 28]
+            xyz_features: Point-MAE features of the point groups, [B, 1152, num_group]
+            centers: centers of the point groups, [B, num_group, 3]
+        """
+        padded_pc, point_mask, _ = padding if padding is not None else pad_point_clouds(pc.to(self.device))
+        with torch.no_grad():
+            rgb_maps, xyz_features, centers, _, _ = self.deep_feature_extractor(rgb.to(self.device), padded_pc, point_mask)
+        return rgb_maps, xyz_features, centers
+
+
+def pad_point_clouds(pc):
+    """
+    Nonzero points of organized point clouds [B, 3, H, W], as (padded_pc [B, 3, max_points], point_mask
+    [B, max_points], nonzero_indices).
+
+    Each cloud keeps a different number of valid (nonzero) points: the clouds are padded to the largest one by
+    repeating their first valid point, which is never picked by the furthest point sampling, and the padding is
+    masked out of the neighbor search.
+    """
+    batch_size = pc.shape[0]
+    unorganized_pc = pc.permute(0, 2, 3, 1).reshape(batch_size, -1, pc.shape[1])
+
+    # Find nonzero indices.
+    nonzero_indices = [torch.nonzero(torch.all(sample_pc != 0, dim=1)).squeeze(dim=1) for sample_pc in unorganized_pc]
+    max_points = max(len(indices) for indices in nonzero_indices)
+
+    # Select nonzero indices and pad every cloud to the same number of points.
+    padded_pc = torch.zeros((batch_size, max_points, pc.shape[1]), dtype = pc.dtype, device = pc.device)
+    point_mask = torch.zeros((batch_size, max_points), dtype = torch.bool, device = pc.device)
+    for i, indices in enumerate(nonzero_indices):
+        num_points = len(indices)
+        padded_pc[i, :num_points] = unorganized_pc[i, indices]
+        padded_pc[i, num_points:] = unorganized_pc[i, indices[0]]
+        point_mask[i, :num_points] = True
+    return padded_pc.permute(0, 2, 1).contiguous(), point_mask, nonzero_indices
+
+
+def upsample_features(pc, rgb_maps, xyz_features, centers, image_size = 224, padding = None):
+    """
+    Per-pixel features of MultimodalFeatures.get_features_maps_batch from the backbone outputs of
+    MultimodalFeatures.backbone_features_batch and the point clouds pc [B, 3, image_size, image_size]: the group
+    features are interpolated to the points and smoothed, the DINO maps bilinearly upsampled. Needs no weights, so
+    it also runs on cached or stored backbone outputs.
+
+    Return:
+        rgb_patch: [B, image_size * image_size, 768]
+        xyz_patch: [B, image_size * image_size, 1152]
+    """
+    batch_size = pc.shape[0]
+    device = xyz_features.device
+    padded_pc, _, nonzero_indices = padding if padding is not None else pad_point_clouds(pc.to(device))
+
+    interpolated_pc = interpolating_points(padded_pc, centers.permute(0, 2, 1), xyz_features, chunk_size = interpolation_chunk_size)
+
+    # Interpolation to obtain a "full image" with point cloud features.
+    xyz_patch_full = torch.zeros((batch_size, interpolated_pc.shape[1], image_size * image_size), dtype = interpolated_pc.dtype, device = device)
+    for i, indices in enumerate(nonzero_indices):
+        xyz_patch_full[i][..., indices.to(device)] = interpolated_pc[i, :, :len(indices)]
+
+    xyz_patch_full_2d = xyz_patch_full.view(batch_size, interpolated_pc.shape[1], image_size, image_size)
+    xyz_patch_full_resized = F.adaptive_avg_pool2d(F.avg_pool2d(xyz_patch_full_2d, kernel_size = 3, stride = 1), (224, 224))
+    xyz_patch = xyz_patch_full_resized.reshape(batch_size, xyz_patch_full_resized.shape[1], -1).permute(0, 2, 1)
+
+    upsample_shape = xyz_patch_full_resized.shape[-2:]
+    rgb_patch_upsample = F.interpolate(rgb_maps, size = upsample_shape, mode = 'bilinear', align_corners = False)
+    rgb_patch_upsample = rgb_patch_upsample.reshape(batch_size, rgb_maps.shape[1], -1).permute(0, 2, 1)
+
+    return rgb_patch_upsample, xyz_patch
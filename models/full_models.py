@@ -1,17 +1,40 @@
+import os
+
+import numpy as np
 import torch
 import torch.nn as nn
 import timm
 from timm.models.layers import DropPath
-from pointnet2_ops import pointnet2_utils
+
+try:
+    from pointnet2_ops import pointnet2_utils
+except ImportError:
+    # CUDA extension, only needed by the 'cuda' furthest point sampling backend.
+    pointnet2_utils = None
+
+# TorchScript artifacts of the backbones, written by models.compiled_models.export_backbones.
+COMPILED_RGB_FILE = 'rgb_backbone.pt'
+COMPILED_XYZ_FILE = 'xyz_tokens.pt'
 
 class FeatureExtractors(torch.nn.Module):
     def __init__(self, device, 
                  rgb_backbone_name = 'vit_base_patch8_224_dino.dino', out_indices = None,
-                 group_size = 128, num_group = 1024):
+                 group_size = 128, num_group = 1024, knn_method = 'chunked', knn_chunk_size = 64, fps_backend = None,
+                 xyz_feature_layers = None, compiled_folder = None):
         
         super().__init__()
 
         self.device = device
+        self.rgb_stage = None
+
+        if compiled_folder is not None:
+            # Warm start: the traced backbones replace timm and the Point-MAE checkpoint, only the grouping runs eagerly.
+            self.rgb_stage = torch.jit.load(os.path.join(compiled_folder, COMPILED_RGB_FILE), map_location = device)
+            self.xyz_backbone = CompiledPointTransformer(
+                Group(num_group = num_group, group_size = group_size, knn_method = knn_method,
+                      knn_chunk_size = knn_chunk_size, fps_backend = fps_backend),
+                torch.jit.load(os.path.join(compiled_folder, COMPILED_XYZ_FILE), map_location = device))
+            return
 
         kwargs = {'features_only': True if out_indices else False}
 
@@ -26,48 +49,185 @@ class FeatureExtractors(torch.nn.Module):
         self.rgb_backbone.blocks = torch.nn.Sequential(*self.rgb_backbone.blocks[:layers_keep]) # Remove Block(s) from 5 to 11.
 
         ## XYZ backbone
-        self.xyz_backbone = PointTransformer(group_size = group_size, num_group = num_group)
+        self.xyz_backbone = PointTransformer(group_size = group_size, num_group = num_group,
+                                             knn_method = knn_method, knn_chunk_size = knn_chunk_size,
+                                             fps_backend = fps_backend, feature_layers = xyz_feature_layers)
         self.xyz_backbone.load_model_from_ckpt(r"C:\Users\tsatt\Downloads\cmm\crossmodal-feature-mapping\checkpoints\feature_extractors\pointmae_pretrain.pth")
         # ! Use only the first k blocks.
-        self.xyz_backbone.blocks.blocks = torch.nn.Sequential(*self.xyz_backbone.blocks.blocks[:layers_keep]) # Remove Block(s) from 5 to 11.
+        self.xyz_backbone.keep_blocks(layers_keep) # Remove Block(s) from 5 to 11.
 
 
     def forward_rgb_features(self, x):
+        if self.rgb_stage is not None:
+            return self.rgb_stage(x)
+
         x = self.rgb_backbone.patch_embed(x)
         x = self.rgb_backbone._pos_embed(x)
         x = self.rgb_backbone.norm_pre(x)
         x = self.rgb_backbone.blocks(x) 
         x = self.rgb_backbone.norm(x)
 
-        feat = x[:,1:].permute(0, 2, 1).view(1, -1, 28, 28) # view(1, -1, 14, 14)
+        feat = x[:,1:].permute(0, 2, 1).view(x.shape[0], -1, 28, 28) # view(B, -1, 14, 14)
         return feat
 
 
-    def forward(self, rgb, xyz):
+    def forward(self, rgb, xyz, mask = None):
         rgb_features = self.forward_rgb_features(rgb)
-        xyz_features, center, ori_idx, center_idx = self.xyz_backbone(xyz)
+        xyz_features, center, ori_idx, center_idx = self.xyz_backbone(xyz, mask)
 
         return rgb_features, xyz_features, center, ori_idx, center_idx
 
 
-def fps(data, number):
+FPS_BACKENDS = {}
+
+def register_fps_backend(name):
+    '''
+        Register a furthest point sampling implementation: fn(data B N 3, number) -> indices B number (long)
+    '''
+    def register(fn):
+        FPS_BACKENDS[name] = fn
+        return fn
+    return register
+
+
+@register_fps_backend('cuda')
+def furthest_point_sample_cuda(data, number):
+    if pointnet2_utils is None:
+        raise ImportError("The 'cuda' FPS backend requires the pointnet2_ops extension")
+    return pointnet2_utils.furthest_point_sample(data, number).long()
+
+
+@torch.jit.script
+def _furthest_point_sample_loop(data: torch.Tensor, number: int) -> torch.Tensor:
+    B, N, _ = data.shape
+    # One contiguous B N plane per coordinate: the distances are accumulated coordinate by coordinate in
+    # preallocated buffers, without a B N 3 temporary and a reduction over its last dimension every iteration.
+    coords = data.permute(2, 0, 1).contiguous()
+    batch_idx = torch.arange(B, device=data.device)
+    fps_idx = torch.zeros((B, number), dtype=torch.long, device=data.device)
+    distance = torch.full((B, N), 1e10, dtype=data.dtype, device=data.device)
+    # Like the pointnet2_ops kernel, points this close to the origin are never selected.
+    distance.masked_fill_(data.pow(2).sum(-1) <= 1e-3, -1.0)
+    dist = torch.empty_like(distance)
+    delta = torch.empty_like(distance)
+    farthest = torch.zeros(B, dtype=torch.long, device=data.device)
+    for i in range(number):
+        fps_idx[:, i] = farthest
+        centroid = data[batch_idx, farthest].unsqueeze(-1)
+        torch.sub(coords[0], centroid[:, 0], out=dist)
+        dist.mul_(dist)
+        for k in range(1, 3):
+            torch.sub(coords[k], centroid[:, k], out=delta)
+            dist.addcmul_(delta, delta)
+        torch.minimum(distance, dist, out=distance)
+        farthest = distance.argmax(-1)
+    return fps_idx
+
+
+@register_fps_backend('cpu')
+def furthest_point_sample_cpu(data, number):
+    '''
+        Exact FPS with the conventions of the pointnet2_ops kernel (starts from the first point), as a TorchScript
+        loop whose iterations are vectorized over all the points and clouds and update the distances in place.
+    '''
+    return _furthest_point_sample_loop(data.contiguous(), number)
+
+
+@register_fps_backend('voxel')
+def furthest_point_sample_voxel(data, number, oversampling = 4):
+    '''
+        Approximate FPS: keeps the first point of every occupied cell of a voxel grid sized to leave about
+        oversampling * number candidates, then runs the exact CPU FPS on the candidates only.
+    '''
+    fps_idx = []
+    for points in data:
+        candidates = voxel_grid_candidates(points, number * oversampling)
+        if candidates.numel() < number:
+            fps_idx.append(furthest_point_sample_cpu(points.unsqueeze(0), number)[0])
+            continue
+        selected = furthest_point_sample_cpu(points[candidates].unsqueeze(0), number)[0]
+        fps_idx.append(candidates[selected])
+    return torch.stack(fps_idx)
+
+
+def voxel_grid_candidates(points, target, iterations = 5):
+    '''
+        points N 3
+        ---------------------------
+        Sorted indices of the first point of each occupied voxel, with the voxel size adjusted to leave between
+        target and 2 * target voxels when possible. Sorting keeps the first point of the cloud first.
+    '''
+    min_bound = points.min(dim=0)[0]
+    extent = (points.max(dim=0)[0] - min_bound).clamp(min=1e-6)
+    voxel_size = (extent.prod() / target) ** (1 / 3)
+
+    point_idx = torch.arange(points.shape[0], device=points.device)
+    for _ in range(iterations):
+        voxels = ((points - min_bound) / voxel_size).floor().long()
+        _, inverse = torch.unique(voxels, dim=0, return_inverse=True)
+        num_voxels = int(inverse.max()) + 1
+        if target <= num_voxels <= 2 * target:
+            break
+        # Scans are surfaces: the number of occupied voxels grows with the inverse of the squared voxel size.
+        voxel_size = voxel_size * (num_voxels / (1.5 * target)) ** 0.5
+
+    first = torch.full((num_voxels,), points.shape[0], dtype=torch.long, device=points.device)
+    first = first.scatter_reduce(0, inverse, point_idx, reduce='amin')
+    return first.sort()[0]
+
+
+def fps(data, number, backend = None):
     '''
         data B N 3
         number int
+        backend: registered FPS backend, None for the CUDA kernel when available and the CPU loop otherwise
     '''
-    fps_idx = pointnet2_utils.furthest_point_sample(data, number)
-    fps_data = pointnet2_utils.gather_operation(data.transpose(1, 2).contiguous(), fps_idx).transpose(1, 2).contiguous()
+    if backend is None:
+        backend = 'cuda' if data.is_cuda and pointnet2_utils is not None else 'cpu'
+    fps_idx = FPS_BACKENDS[backend](data, number)
+    fps_data = torch.gather(data, 1, fps_idx.unsqueeze(-1).expand(-1, -1, data.shape[-1])).contiguous()
     return fps_data, fps_idx
 
 
 class KNN(nn.Module):
-    def __init__(self, k):
+    """
+    k nearest points of each center.
+
+    method selects the neighbor search engine:
+        'dense':   distances between all points and all centers at once ([B, N, K] tensor, highest memory).
+        'chunked': same computation over chunks of chunk_size centers, so peak memory is bounded by
+                   N * chunk_size instead of N * K. Returns exactly the same neighbors as 'dense'.
+        'kdtree':  scipy cKDTree built on the CPU for every cloud; lowest memory, neighbors at equal distance
+                   may come in a different order.
+    """
+    methods = ('dense', 'chunked', 'kdtree')
+
+    def __init__(self, k, method = 'chunked', chunk_size = 64):
         super(KNN, self).__init__()
+        assert method in self.methods, f"Unknown KNN method {method}, use one of {self.methods}"
         self.k = k
+        self.method = method
+        self.chunk_size = chunk_size
 
-    def forward(self, xyz, centers):
+    def forward(self, xyz, centers, mask = None):
+        '''
+            xyz: B N 3
+            centers: B K 3
+            mask: B N, False for padding points that must never be selected as neighbors
+            ---------------------------
+            indices: B k K
+        '''
         assert xyz.size(0) == centers.size(0), "Batch size of xyz and centers should be the same"
 
+        if self.method == 'kdtree':
+            return self.kdtree_search(xyz, centers, mask)
+
+        chunk_size = centers.size(1) if self.method == 'dense' else self.chunk_size
+        indices = [self.dense_search(xyz, centers[:, start:start + chunk_size], mask)
+                   for start in range(0, centers.size(1), chunk_size)]
+        return torch.cat(indices, dim=2)
+
+    def dense_search(self, xyz, centers, mask = None):
         B, N_points, _ = xyz.size()
         K = centers.size(1)
 
@@ -75,22 +235,40 @@ class KNN(nn.Module):
         xyz = xyz.unsqueeze(2)  # [B, N, 1, 3]
         centers = centers.unsqueeze(1)  # [B, 1, K, 3]
         distances = torch.norm(xyz - centers, dim=-1)  # [B, N, K]
+        if mask is not None:
+            distances = distances.masked_fill(~mask.unsqueeze(-1), float('inf'))
 
         # Get the indices of the k nearest neighbors
         _, indices = torch.topk(distances, self.k, dim=1, largest=False, sorted=True)
         return indices
 
+    def kdtree_search(self, xyz, centers, mask = None):
+        from scipy.spatial import cKDTree
+
+        indices = []
+        for i in range(xyz.size(0)):
+            points = xyz[i].detach().cpu().numpy()
+            point_idx = np.arange(points.shape[0])
+            if mask is not None:
+                point_idx = point_idx[mask[i].cpu().numpy()]
+                points = points[point_idx]
+            _, neighbors = cKDTree(points).query(centers[i].detach().cpu().numpy(), k=self.k, workers=-1)
+            indices.append(torch.from_numpy(point_idx[neighbors.reshape(-1, self.k)].T))
+        return torch.stack(indices).to(xyz.device)
+
 
 class Group(nn.Module):
-    def __init__(self, num_group, group_size):
+    def __init__(self, num_group, group_size, knn_method = 'chunked', knn_chunk_size = 64, fps_backend = None):
         super().__init__()
         self.num_group = num_group
         self.group_size = group_size
-        self.knn = KNN(k=self.group_size)
+        self.fps_backend = fps_backend
+        self.knn = KNN(k=self.group_size, method=knn_method, chunk_size=knn_chunk_size)
 
-    def forward(self, xyz):
+    def forward(self, xyz, mask = None):
         '''
             input: B N 3
+            mask: B N, False for padding points (padding must repeat the first valid point of the cloud)
             ---------------------------
             output: B G M 3
             center : B G 3
@@ -98,18 +276,18 @@ class Group(nn.Module):
 
         batch_size, num_points, _ = xyz.shape
         # fps the centers out
-        center, center_idx = fps(xyz.contiguous(), self.num_group)  # B G 3
+        center, center_idx = fps(xyz.contiguous(), self.num_group, self.fps_backend)  # B G 3
 
         # knn to get the neighborhood
         # _, idx = self.knn(xyz, center)  # B G M
-        idx = self.knn(xyz, center).permute(0,2,1)  # B G M
+        idx = self.knn(xyz, center, mask).permute(0,2,1)  # B G M
 
         assert idx.size(1) == self.num_group
         assert idx.size(2) == self.group_size
         ori_idx = idx
         idx_base = torch.arange(0, batch_size, device=xyz.device).view(-1, 1, 1) * num_points
         idx = idx + idx_base
-        idx = idx[-1]
+        idx = idx.reshape(-1)
         neighborhood = xyz.reshape(batch_size * num_points, -1)[idx, :]
         neighborhood = neighborhood.reshape(batch_size, self.num_group, self.group_size, 3).contiguous()
         # normalize
@@ -234,18 +412,29 @@ class TransformerEncoder(nn.Module):
             )
             for i in range(depth)])
 
-    def forward(self, x, pos):
+    def forward(self, x, pos, fetch_idx = None):
+        # fetch_idx: outputs to return (all blocks if None), the blocks after the last one are not run.
         feature_list = []
-        # fetch_idx = [3, 7, 11] ### ! PD
+        last_idx = len(self.blocks) - 1 if fetch_idx is None else max(fetch_idx)
         for i, block in enumerate(self.blocks):
             x = block(x + pos)
-            # if i in fetch_idx: ### ! PD
-            feature_list.append(x)
+            if fetch_idx is None or i in fetch_idx:
+                feature_list.append(x)
+            if i == last_idx:
+                break
         return feature_list
 
 
+def default_feature_layers(depth, cls_token):
+    """Transformer blocks whose outputs PointTransformer concatenates into the point features."""
+    if cls_token:
+        return (0, 1, 2)
+    return {12: (3, 7, 11), 8: (1, 4, 7), 4: (1, 2, 3)}.get(depth, (depth - 1,))
+
+
 class PointTransformer(nn.Module):
-    def __init__(self, group_size = 128, num_group = 1024, encoder_dims = 384):
+    def __init__(self, group_size = 128, num_group = 1024, encoder_dims = 384, knn_method = 'chunked', knn_chunk_size = 64,
+                 fps_backend = None, feature_layers = None):
         super().__init__()
 
         self.trans_dim = 384
@@ -256,7 +445,8 @@ class PointTransformer(nn.Module):
         self.group_size = group_size
         self.num_group = num_group
         # grouper
-        self.group_divider = Group(num_group = self.num_group, group_size = self.group_size)
+        self.group_divider = Group(num_group = self.num_group, group_size = self.group_size,
+                                   knn_method = knn_method, knn_chunk_size = knn_chunk_size, fps_backend = fps_backend)
         # define the encoder
         self.encoder_dims = encoder_dims
         if self.encoder_dims != self.trans_dim:
@@ -282,6 +472,26 @@ class PointTransformer(nn.Module):
 
         self.norm = nn.LayerNorm(self.trans_dim)
 
+        # Tapped blocks: only these are normalized, and the blocks after the last one are skipped.
+        self.requested_feature_layers = feature_layers
+        self.feature_layers = self.select_feature_layers()
+
+    def select_feature_layers(self):
+        """
+        Tapped blocks: the requested ones or the defaults for the number of blocks actually kept (see keep_blocks),
+        which the baseline branched on, validated against it.
+        """
+        depth = len(self.blocks.blocks)
+        feature_layers = tuple(self.requested_feature_layers or default_feature_layers(depth, self.encoder_dims != self.trans_dim))
+        if not all(0 <= i < depth for i in feature_layers):
+            raise ValueError(f"feature_layers {feature_layers} out of range for {depth} blocks")
+        return feature_layers
+
+    def keep_blocks(self, layers_keep):
+        """Only keep the first layers_keep transformer blocks, and select the taps again."""
+        self.blocks.blocks = nn.Sequential(*self.blocks.blocks[:layers_keep])
+        self.feature_layers = self.select_feature_layers()
+
     def load_model_from_ckpt(self, bert_ckpt_path):
         if bert_ckpt_path is not None:
             device = "cuda" if torch.cuda.is_available() else "cpu"
@@ -323,12 +533,22 @@ class PointTransformer(nn.Module):
                 
         print(f'[Transformer] Successful Loading the ckpt from {bert_ckpt_path}')
 
-    def forward(self, pts):
+    def forward(self, pts, mask = None):
+        B, C, N = pts.shape
+        pts = pts.transpose(-1, -2)  # B N 3
+        # divide the point clo  ud in the same form. This is important
+        neighborhood, center, ori_idx, center_idx = self.group_divider(pts, mask)
+        x = self.forward_tokens(neighborhood, center)
+        return x, center, ori_idx, center_idx
+
+    def forward_tokens(self, neighborhood, center):
+        '''
+            neighborhood: B G M 3, center: B G 3
+            -----------------
+            features: B C G
+            Token stage after the grouping (FPS / KNN), traceable: see models.compiled_models.
+        '''
         if self.encoder_dims != self.trans_dim:
-            B,C,N = pts.shape
-            pts = pts.transpose(-1, -2) # B N 3
-            # divide the point clo  ud in the same form. This is important
-            neighborhood,  center, ori_idx, center_idx = self.group_divider(pts)
             # # generate mask
             # bool_masked_pos = self._mask_center(center, no_mask = False) # B G
             # encoder the input cloud blocks
@@ -343,30 +563,34 @@ class PointTransformer(nn.Module):
             x = torch.cat((cls_tokens, group_input_tokens), dim=1)
             pos = torch.cat((cls_pos, pos), dim=1)
             # transformer
-            feature_list = self.blocks(x, pos)
+            feature_list = self.blocks(x, pos, self.feature_layers)
             feature_list = [self.norm(x)[:,1:].transpose(-1, -2).contiguous() for x in feature_list]
-            x = torch.cat((feature_list[0],feature_list[1],feature_list[2]), dim=1) #1152
-            return x, center, ori_idx, center_idx 
+            x = torch.cat(feature_list, dim=1) #1152
+            return x
         else:
-            B, C, N = pts.shape
-            pts = pts.transpose(-1, -2)  # B N 3
-            # divide the point clo  ud in the same form. This is important
-
-            neighborhood, center, ori_idx, center_idx = self.group_divider(pts)
             group_input_tokens = self.encoder(neighborhood)  # B G N
 
             pos = self.pos_embed(center)
             # final input
             x = group_input_tokens
             # transformer
-            feature_list = self.blocks(x, pos)
+            feature_list = self.blocks(x, pos, self.feature_layers)
             feature_list = [self.norm(x).transpose(-1, -2).contiguous() for x in feature_list]
-            if len(feature_list) == 12:
-                x = torch.cat((feature_list[3],feature_list[7],feature_list[11]), dim=1) 
-            elif len(feature_list) == 8:
-                x = torch.cat((feature_list[1],feature_list[4],feature_list[7]), dim=1) 
-            elif len(feature_list) == 4:
-                x = torch.cat((feature_list[1],feature_list[2],feature_list[3]), dim=1) 
-            else:
-                x = feature_list[-1]
-            return x, center, ori_idx, center_idx
\ No newline at end of file
+            x = torch.cat(feature_list, dim=1) #1152
+            return x
+
+
+class CompiledPointTransformer(nn.Module):
+    '''
+        PointTransformer.forward with the token stage replaced by its traced export.
+    '''
+    def __init__(self, group_divider, token_stage):
+        super().__init__()
+        self.group_divider = group_divider
+        self.token_stage = token_stage
+
+    def forward(self, pts, mask = None):
+        pts = pts.transpose(-1, -2)  # B N 3
+        neighborhood, center, ori_idx, center_idx = self.group_divider(pts, mask)
+        x = self.token_stage(neighborhood, center)
+        return x, center, ori_idx, center_idx
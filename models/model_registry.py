@@ -0,0 +1,330 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import torch
+
+from models.features import MultimodalFeatures, backbone_config, upsample_features
+from models.cfm_heads import FusedCFMHeads, StackedCFMHeads, validate_fused_heads
+from infer import FusionEncoder, DecoupledDecoder
+from models.compiled_models import compiled_backbones_available, heads_fingerprint, load_compiled_heads
+from models.full_models import COMPILED_RGB_FILE, COMPILED_XYZ_FILE
+from utils.feature_cache_utils import feature_key, file_digest, module_fingerprint
+from utils.quantization_utils import check_precision, precision_context, quantize_module
+
+
+def calibration_batches(dataset_path, class_names, num_samples = 8, split = 'train'):
+    """
+    (rgb, pc) batches of one sample drawn evenly from the TrainValDataset of each class, used to calibrate the
+    activation ranges of the int8-static precision.
+    """
+    from models.dataset import TrainValDataset
+
+    datasets = [TrainValDataset(split = split, class_name = class_name, img_size = 224, dataset_path = dataset_path)
+                for class_name in class_names]
+    datasets = [dataset for dataset in datasets if len(dataset) > 0]
+    samples_per_class = -(-num_samples // len(datasets))
+    indices = [(dataset, j * len(dataset) // samples_per_class) for j in range(samples_per_class) for dataset in datasets]
+    for dataset, idx in indices[:num_samples]:
+        (rgb, pc, _), _ = dataset[idx]
+        yield rgb.unsqueeze(0), pc.unsqueeze(0)
+
+
+def cfm_checkpoint_paths(checkpoint_folder, class_name, epochs_no = 100, batch_size = 1):
+    """Return the fusion encoder / 2D decoder / 3D decoder checkpoint paths of a class."""
+    model_name = f'{class_name}_{epochs_no}ep_{batch_size}bs'
+    checkpoint_path = os.path.join(checkpoint_folder, class_name)
+    return (os.path.join(checkpoint_path, f'fusion_encoder_{model_name}.pth'),
+            os.path.join(checkpoint_path, f'decoder_2D_{model_name}.pth'),
+            os.path.join(checkpoint_path, f'decoder_3D_{model_name}.pth'))
+
+
+def module_nbytes(module):
+    """Size in bytes of the parameters and buffers of a module."""
+    tensors = list(module.parameters()) + list(module.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors)
+
+
+class CFMHeads:
+    """Per-class FusionEncoder / DecoupledDecoder triplet kept resident by the ModelRegistry."""
+
+    def __init__(self, class_name, fusion_encoder, decoder_2D, decoder_3D):
+        self.class_name = class_name
+        self.fusion_encoder = fusion_encoder
+        self.decoder_2D = decoder_2D
+        self.decoder_3D = decoder_3D
+        self.fused = None
+        self.nbytes = sum(module_nbytes(m) for m in (fusion_encoder, decoder_2D, decoder_3D))
+
+    def __iter__(self):
+        return iter((self.fusion_encoder, self.decoder_2D, self.decoder_3D))
+
+    def fuse(self):
+        """Build (and validate against the modules) the inference export used by compute_residuals_fused."""
+        if self.fused is None:
+            fused = FusedCFMHeads(self.fusion_encoder, self.decoder_2D, self.decoder_3D)
+            validate_fused_heads(fused, self.fusion_encoder, self.decoder_2D, self.decoder_3D)
+            self.fused = fused
+            self.nbytes += fused.nbytes
+        return self.fused
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of the inference models.
+
+    The class-agnostic MultimodalFeatures backbones (DINO ViT-B/8 and Point-MAE) are loaded once and shared by every
+    request, while the per-class CFM heads are loaded on demand and kept in an LRU cache whose total size is bounded
+    by max_memory_mb. The least recently used heads are evicted when a new class does not fit in the budget.
+    With fuse_heads, the heads are also exported to FusedCFMHeads when loaded. If a FeatureCache is given, the
+    backbone features are cached per sample, so re-scoring the same inputs against other classes only runs the
+    CFM heads.
+
+    precision selects the inference precision of the backbones and heads (see utils.quantization_utils.PRECISIONS);
+    int8-static calibrates on calibration_data, an iterable of (rgb, pc) batches (see calibration_batches).
+    In fp32, the TorchScript artifacts found in compiled_folder (see export_compiled.py) replace the eager backbones
+    and heads, which also skips building timm and loading the Point-MAE checkpoint at startup. Artifacts exported
+    with other backbone settings or from other checkpoints, or whose heads do not match the modules, are ignored.
+    """
+
+    def __init__(self, checkpoint_folder, device = None, max_memory_mb = 1024, epochs_no = 100, batch_size = 1,
+                 feature_cache = None, fuse_heads = False, precision = 'fp32', calibration_data = None,
+                 compiled_folder = None, max_stacked_fraction = 0.5):
+        self.checkpoint_folder = checkpoint_folder
+        self.device = device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu")
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        # Stacked heads copy the weights of their classes: larger stacks would evict the per-class heads.
+        self.max_stacked_bytes = int(max_stacked_fraction * self.max_memory_bytes)
+        self.epochs_no = epochs_no
+        self.batch_size = batch_size
+
+        self.feature_cache = feature_cache
+        self.fuse_heads = fuse_heads
+
+        check_precision(precision, self.device)
+        self.precision = precision
+        self.calibration_data = calibration_data
+        # Compiled artifacts are traced in fp32, the other precisions run the eager modules.
+        self.compiled_folder = compiled_folder if precision == 'fp32' else None
+        # Feature rows of the calibration samples, used to calibrate the heads in int8-static
+        self._calibration_rows = None
+
+        self._feature_extractor = None
+        self._backbone_fingerprint = None
+        self._heads = OrderedDict()
+        # Future of the heads being loaded, per cache key: concurrent requests for the same heads wait on it.
+        self._loading = {}
+        self._lock = threading.RLock()
+
+    @property
+    def feature_extractor(self):
+        if self._feature_extractor is None:
+            self.load_backbone()
+        return self._feature_extractor
+
+    def load_backbone(self):
+        # Set once and never reset: after the first load, the backbone is returned without taking the lock.
+        if self._feature_extractor is not None:
+            return self._feature_extractor
+        with self._lock:
+            if self._feature_extractor is None:
+                compiled = compiled_backbones_available(self.compiled_folder, backbone_config())
+                print(f"Loading shared backbones{' (compiled)' if compiled else ''}...")
+                feature_extractor = MultimodalFeatures(compiled_folder = self.compiled_folder if compiled else None)
+                feature_extractor.eval()
+                if self.feature_cache is not None:
+                    # Fingerprint of the fp32 weights, features of other precisions differ and are keyed apart.
+                    config = f'{backbone_config(feature_extractor.image_size)}/{self.precision}'
+                    if compiled:
+                        config += ''.join(file_digest(os.path.join(self.compiled_folder, f))
+                                          for f in (COMPILED_RGB_FILE, COMPILED_XYZ_FILE))
+                    self._backbone_fingerprint = module_fingerprint(feature_extractor, config)
+                if self.precision.startswith('int8'):
+                    print(f"Quantizing shared backbones ({self.precision})...")
+                    quantize_module(feature_extractor.deep_feature_extractor, self.precision,
+                                    calibrate = lambda _: self._calibrate_backbone(feature_extractor))
+                self._feature_extractor = feature_extractor
+        return self._feature_extractor
+
+    def _calibrate_backbone(self, feature_extractor, rows_per_sample = 2048):
+        if self.calibration_data is None:
+            raise ValueError("Precision int8-static requires calibration data")
+        rgb_rows, xyz_rows = [], []
+        generator = torch.Generator().manual_seed(0)
+        for rgb, pc in self.calibration_data:
+            rgb_patch, xyz_patch = feature_extractor.get_features_maps_batch(rgb.to(self.device), pc.to(self.device))
+            rgb_patch, xyz_patch = rgb_patch.reshape(-1, rgb_patch.shape[-1]), xyz_patch.reshape(-1, xyz_patch.shape[-1])
+            # Keep a subset of the foreground rows, the ones the heads are trained on.
+            foreground = torch.nonzero(xyz_patch.sum(dim=-1) != 0).squeeze(1).cpu()
+            rows = foreground[torch.randperm(len(foreground), generator=generator)[:rows_per_sample]].to(self.device)
+            rgb_rows.append(rgb_patch[rows])
+            xyz_rows.append(xyz_patch[rows])
+        self._calibration_rows = (torch.cat(rgb_rows), torch.cat(xyz_rows))
+
+    def _calibrate_heads(self, fusion_encoder, decoder_2D, decoder_3D):
+        self.load_backbone()
+        rgb_rows, xyz_rows = self._calibration_rows
+        embedding = fusion_encoder(rgb_rows, xyz_rows)
+        decoder_2D(embedding)
+        decoder_3D(embedding)
+
+    def extract_features_batch(self, rgb, pc):
+        """MultimodalFeatures.get_features_maps_batch at the precision of the registry, returning fp32 features."""
+        feature_extractor = self.feature_extractor
+        with precision_context(self.precision, self.device):
+            rgb_patch, xyz_patch = feature_extractor.get_features_maps_batch(rgb, pc)
+        return rgb_patch.float(), xyz_patch.float()
+
+    def get_features_maps_batch(self, rgb, pc):
+        """
+        extract_features_batch through the feature cache: only the samples without cached backbone outputs go
+        through the backbones, the upsampling to per-pixel features runs on the whole batch.
+        """
+        if self.feature_cache is None:
+            return self.extract_features_batch(rgb, pc)
+        feature_extractor = self.feature_extractor
+
+        keys = [feature_key(self._backbone_fingerprint, rgb[i], pc[i]) for i in range(rgb.shape[0])]
+        cached = [self.feature_cache.get(key) for key in keys]
+        missing = [i for i, features in enumerate(cached) if features is None]
+
+        with precision_context(self.precision, self.device):
+            if missing:
+                features = feature_extractor.backbone_features_batch(rgb[missing], pc[missing])
+                for j, i in enumerate(missing):
+                    # fp32 in the cache, numpy (the disk tier) has no bfloat16.
+                    cached[i] = tuple(tensor[j].float() for tensor in features)
+                    self.feature_cache.put(keys[i], cached[i])
+
+            rgb_maps, xyz_features, centers = (torch.stack([features[k].to(self.device) for features in cached])
+                                               for k in range(3))
+            rgb_patch, xyz_patch = upsample_features(pc.to(self.device), rgb_maps, xyz_features, centers,
+                                                     feature_extractor.image_size)
+        return rgb_patch.float(), xyz_patch.float()
+
+    def get_heads(self, class_name):
+        """Return the CFMHeads of a class, loading them from disk on a cache miss."""
+        return self._get_or_load(class_name, lambda: self._load_heads(class_name))
+
+    def _get_or_load(self, key, load, max_bytes = None):
+        """
+        Return the cached entry of key, or load it with load() and cache it (if it is at most max_bytes). The lock is
+        only held to look up and update the cache, not while loading (reading the checkpoints, validating the
+        exports), so other requests and the backbone pass are not blocked: concurrent misses on the same key wait
+        for the one load in flight.
+        """
+        with self._lock:
+            entry = self._heads.get(key)
+            if entry is not None:
+                self._heads.move_to_end(key)
+                return entry
+            future = self._loading.get(key)
+            loading = future is None
+            if loading:
+                future = self._loading[key] = Future()
+        if not loading:
+            return future.result()
+
+        try:
+            entry = load()
+        except BaseException as e:
+            with self._lock:
+                del self._loading[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            if max_bytes is None or entry.nbytes <= max_bytes:
+                self._evict(entry.nbytes)
+                self._heads[key] = entry
+            else:
+                print(f"Not caching {key}: {entry.nbytes / 2 ** 20:.0f} MB, more than {max_bytes / 2 ** 20:.0f} MB")
+            del self._loading[key]
+        future.set_result(entry)
+        return entry
+
+    def get_stacked_heads(self, class_names):
+        """
+        Return the CFM heads of several classes stacked for a single batched pass (see StackedCFMHeads).
+        The stacked heads are cached in the LRU under the tuple of class names and charged to the memory budget,
+        unless they take more than max_stacked_fraction of it: they are then rebuilt on every call.
+        The stacks are built from the resident heads; the other classes are only read from disk to be stacked,
+        they are not cached.
+        """
+        if self.precision.startswith('int8'):
+            raise ValueError(f"Multi-class scoring does not support the {self.precision} precision")
+        return self._get_or_load(tuple(class_names), lambda: self._stack_heads(class_names), self.max_stacked_bytes)
+
+    def _stack_heads(self, class_names):
+        with self._lock:
+            resident = {class_name: self._heads.get(class_name) for class_name in class_names}
+        heads = [resident[class_name] or self._load_heads(class_name, export = False) for class_name in class_names]
+        print(f"Stacking CFM heads for {len(heads)} class(es)")
+        return StackedCFMHeads(heads, compute_dtype = torch.bfloat16 if self.precision == 'bf16' else None)
+
+    def _load_heads(self, class_name, export = True):
+        fusion_checkpoint, decoder_2d_checkpoint, decoder_3d_checkpoint = cfm_checkpoint_paths(
+            self.checkpoint_folder, class_name, epochs_no = self.epochs_no, batch_size = self.batch_size)
+
+        if not all(os.path.exists(p) for p in [fusion_checkpoint, decoder_2d_checkpoint, decoder_3d_checkpoint]):
+            raise Exception(f"One or more checkpoint files are missing for class {class_name}")
+
+        print(f"Loading CFM heads for class: {class_name}")
+        fusion_encoder = FusionEncoder(in_features_2D=768, in_features_3D=1152, out_features=960)
+        decoder_2D = DecoupledDecoder(in_features=960, out_features=768)
+        decoder_3D = DecoupledDecoder(in_features=960, out_features=1152)
+
+        try:
+            fusion_encoder.load_state_dict(torch.load(fusion_checkpoint, map_location=self.device))
+            decoder_2D.load_state_dict(torch.load(decoder_2d_checkpoint, map_location=self.device))
+            decoder_3D.load_state_dict(torch.load(decoder_3d_checkpoint, map_location=self.device))
+        except Exception as e:
+            raise Exception(f"Failed to load model checkpoints: {str(e)}")
+
+        modules = [m.to(self.device).eval() for m in (fusion_encoder, decoder_2D, decoder_3D)]
+        heads = CFMHeads(class_name, *modules)
+        if not export:
+            return heads
+        compiled_heads = load_compiled_heads(self.compiled_folder, class_name, self.device, heads_fingerprint(*modules))
+        if compiled_heads is not None:
+            try:
+                validate_fused_heads(compiled_heads, *modules)
+            except Exception as e:
+                print(f"Ignoring compiled CFM heads for class {class_name}: {str(e)}")
+                compiled_heads = None
+        if compiled_heads is not None:
+            print(f"Using compiled CFM heads for class: {class_name}")
+            heads.fused = compiled_heads
+            # The frozen artifact holds its own copy of the weights.
+            heads.nbytes *= 2
+        elif self.precision.startswith('int8'):
+            # The fused export reads the fp32 weights, quantized heads run as modules.
+            # nbytes keeps the fp32 size, an upper bound of the quantized one.
+            with torch.no_grad():
+                calibrate = lambda _: self._calibrate_heads(*modules)
+                for module in modules:
+                    quantize_module(module, self.precision, calibrate = calibrate)
+        elif self.fuse_heads or self.precision == 'bf16':
+            heads.fuse()
+            if self.precision == 'bf16':
+                heads.fused.compute_dtype = torch.bfloat16
+        return heads
+
+    def _evict(self, incoming_bytes):
+        # Always keep room for the incoming heads, even if they alone exceed the budget.
+        while self._heads and self.memory_usage() + incoming_bytes > self.max_memory_bytes:
+            evicted_class, _ = self._heads.popitem(last=False)
+            print(f"Evicting CFM heads for class: {evicted_class}")
+
+    def memory_usage(self):
+        """Bytes currently held by the cached CFM heads (per class and stacked)."""
+        return sum(heads.nbytes for heads in self._heads.values())
+
+    def loaded_classes(self):
+        with self._lock:
+            # The other keys are the class name tuples of stacked heads.
+            return [key for key in self._heads.keys() if isinstance(key, str)]
+
+    def clear(self):
+        with self._lock:
+            self._heads.clear()
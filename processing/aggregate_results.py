@@ -1,4 +1,5 @@
 import os
+import json
 import argparse
 import numpy as np
 import pandas as pd
@@ -18,9 +19,20 @@ def read_md_files(directory):
             aggregated_results.append(file_contents_num)
     return np.array(aggregated_results) # Expected shape (10,6)
 
+def read_json_results(results_file):
+    # Results written by evaluate.py: {class_name: {metric: value}}, the metric names without the LaTeX escapes.
+    with open(results_file, "r", encoding = "utf-8") as file:
+        results = json.load(file)
+    results.pop('mean', None)
+    data = [[results[class_name][metric.replace("\\", "")] for metric in metrics] for class_name in results]
+    return np.array(data), list(results)
+
 def produce_table(args):
-    data = read_md_files(args.quantitative_folder)
-    results = pd.DataFrame(data, index=classes, columns=metrics).T
+    if args.results_file is not None:
+        data, index = read_json_results(args.results_file)
+    else:
+        data, index = read_md_files(args.quantitative_folder), classes
+    results = pd.DataFrame(data, index=index, columns=metrics).T
     results['mean'] = results.mean(axis=1)
 
     print(results.to_latex(float_format = "%.3f"))
@@ -30,6 +42,8 @@ if __name__ == '__main__':
 
     parser.add_argument('--quantitative_folder', default = None, type = str,
                         help = 'Path to the folder from which to fetch the quantitatives.')
+    parser.add_argument('--results_file', default = None, type = str,
+                        help = 'Path to a results.json written by evaluate.py, used instead of the quantitatives folder.')
 
     args = parser.parse_args()
 
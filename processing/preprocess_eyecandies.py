@@ -1,4 +1,6 @@
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from shutil import copyfile
 import cv2
 import numpy as np
@@ -21,6 +23,18 @@ def load_and_convert_depth(depth_img, info_depth):
     dimg = dimg / 65535.0 * (maxd - mind) + mind
     return dimg
 
+def camera_projection(focal_length, height, width, pose):
+    # camera intrinsics
+    intrinsics_4x4 = np.array([
+        [focal_length, 0, width / 2, 0],
+        [0, focal_length, height / 2, 0],
+        [0, 0, 1, 0],
+        [0, 0, 0, 1]]
+    )
+
+    # build the camera projection matrix
+    return intrinsics_4x4 @ pose
+
 def depth_to_pointcloud(depth_img, info_depth, pose_txt, focal_length):
     # input depth map (in meters) --- cfr previous section
     depth_mt = load_and_convert_depth(depth_img, info_depth)
@@ -28,6 +42,55 @@ def depth_to_pointcloud(depth_img, info_depth, pose_txt, focal_length):
     # input pose
     pose = np.loadtxt(pose_txt)
 
+    height, width = depth_mt.shape[:2]
+    camera_proj = camera_projection(focal_length, height, width, pose)
+
+    # build the (u, v, 1, 1/depth) vectors of all the pixels at once, in row-major order. The reciprocal is computed
+    # in float64 like the per-pixel 1/depth_mt[j, i] of depth_to_pointcloud_loop, so that the point clouds are identical.
+    v, u = np.meshgrid(np.arange(height), np.arange(width), indexing='ij')
+    camera_vectors = np.stack([u.ravel(), v.ravel(), np.ones(width * height), 1.0 / depth_mt.astype(np.float64).ravel()], axis=1)
+
+    # invert and apply to each 4-vector
+    hom_3d_pts= np.linalg.inv(camera_proj) @ camera_vectors.T
+    # remove the homogeneous coordinate
+    pcd = depth_mt.reshape(-1, 1) * hom_3d_pts.T
+    return pcd[:, :3]
+
+def remove_point_cloud_background(pc):
+
+    # The second dim is z
+    dz =  pc[256,1] - pc[-256,1]
+    dy =  pc[256,2] - pc[-256,2]
+
+    norm =  math.sqrt(dz**2 + dy**2)
+    start_points = np.array([0, pc[-256, 1], pc[-256, 2]])
+    cos_theta = dy / norm
+    sin_theta = dz / norm
+
+    # Transform and rotation
+    rotation_matrix = np.array([[1, 0, 0], [0, cos_theta, -sin_theta],[0, sin_theta, cos_theta]])
+    processed_pc = (rotation_matrix @ (pc - start_points).T).T
+
+    # Remove background point: the points failing any of the tests of remove_point_cloud_background_loop (on their
+    # rotated coordinates) are moved to the origin of the rotated frame.
+    background = ((processed_pc[:, 1] > -0.02) | (processed_pc[:, 2] > 1.8) |
+                  (processed_pc[:, 0] > 1) | (processed_pc[:, 0] < -1))
+    processed_pc[background] = -start_points
+
+    processed_pc = (rotation_matrix.T @ processed_pc.T).T + start_points
+
+    index = [0, 2, 1]
+    processed_pc = processed_pc[:,index]
+    return processed_pc*[0.1, -0.1, 0.1]
+
+def depth_to_pointcloud_loop(depth_img, info_depth, pose_txt, focal_length):
+    # Reference implementation of depth_to_pointcloud, one pixel at a time.
+    # input depth map (in meters) --- cfr previous section
+    depth_mt = load_and_convert_depth(depth_img, info_depth)
+
+    # input pose
+    pose = np.loadtxt(pose_txt)
+
     # camera intrinsics
     height, width = depth_mt.shape[:2]
     intrinsics_4x4 = np.array([
@@ -55,7 +118,8 @@ def depth_to_pointcloud(depth_img, info_depth, pose_txt, focal_length):
     pcd = depth_mt.reshape(-1, 1) * hom_3d_pts.T
     return pcd[:, :3]
 
-def remove_point_cloud_background(pc):
+def remove_point_cloud_background_loop(pc):
+    # Reference implementation of remove_point_cloud_background, one point at a time.
 
     # The second dim is z
     dz =  pc[256,1] - pc[-256,1]
@@ -86,91 +150,71 @@ def remove_point_cloud_background(pc):
     return processed_pc*[0.1, -0.1, 0.1]
 
 
+
+def category_tasks(dataset_path, target_dir, category_dir):
+    """Create the MVTec-style folders of a category and return one task per sample, for preprocess_sample."""
+    category_root_path = os.path.join(dataset_path, category_dir)
+    category_train_path = os.path.join(category_root_path, 'train/data')
+    category_test_path = os.path.join(category_root_path, 'test_public/data')
+    category_target_path = os.path.join(target_dir, category_dir)
+
+    for split in ('train/good', 'test/good', 'test/bad'):
+        for folder in ('rgb', 'xyz', 'gt') if split.startswith('test') else ('rgb', 'xyz'):
+            os.makedirs(os.path.join(category_target_path, split, folder), exist_ok=True)
+
+    # Every sample has 17 files (depth, pose, images, ...)
+    num_train_files = len(os.listdir(category_train_path))//17
+    num_test_files = len(os.listdir(category_test_path))//17
+    tasks = [(category_train_path, str(i).zfill(3), os.path.join(category_target_path, 'train'), str(i).zfill(3), False)
+             for i in range(num_train_files)]
+    tasks += [(category_test_path, str(i).zfill(2), os.path.join(category_target_path, 'test'), str(i).zfill(3), True)
+              for i in range(num_test_files)]
+    return tasks
+
+def preprocess_sample(task):
+    """Convert one Eyecandies sample to an MVTec 3D-AD style sample, return the seconds spent."""
+    start = time.perf_counter()
+    source_path, source_id, target_path, target_id, test = task
+
+    split = 'good'
+    if test:
+        mask = cv2.imread(os.path.join(source_path, source_id+'_mask.png'))
+        split = 'bad' if np.any(mask) else 'good'
+        cv2.imwrite(os.path.join(target_path, split, 'gt', target_id+'.png'), mask)
+
+    pc = depth_to_pointcloud(
+            os.path.join(source_path, source_id+'_depth.png'),
+            os.path.join(source_path, source_id+'_info_depth.yaml'),
+            os.path.join(source_path, source_id+'_pose.txt'),
+            FOCAL_LENGTH,
+        )
+    pc = remove_point_cloud_background(pc)
+    pc = pc.reshape(512,512,3)
+    tifffile.imwrite(os.path.join(target_path, split, 'xyz', target_id+'.tiff'), pc)
+    copyfile(os.path.join(source_path, source_id+'_image_4.png'), os.path.join(target_path, split, 'rgb', target_id+'.png'))
+    return time.perf_counter() - start
+
+
 if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser(description='Process some integers.')
+    parser = argparse.ArgumentParser(description='Convert the Eyecandies dataset to the MVTec 3D-AD layout.')
     parser.add_argument('--dataset_path', default='datasets/eyecandies', type=str, help="Original Eyecandies dataset path.")
     parser.add_argument('--target_dir', default='datasets/eyecandies_preprocessed', type=str, help="Processed Eyecandies dataset path")
+    parser.add_argument('--workers', default=os.cpu_count(), type=int, help="Number of worker processes.")
     args = parser.parse_args()
-    
-    os.mkdir(args.target_dir)
-    categories_list = os.listdir(args.dataset_path)
-
-    for category_dir in categories_list:
-        category_root_path = os.path.join(args.dataset_path, category_dir)
-
-        category_train_path = os.path.join(category_root_path, '/train/data')
-        category_test_path = os.path.join(category_root_path, '/test_public/data')
-
-        category_target_path = os.path.join(args.target_dir, category_dir)
-        os.mkdir(category_target_path)
-
-        os.mkdir(os.path.join(category_target_path, 'train'))
-        category_target_train_good_path = os.path.join(category_target_path, 'train/good')
-        category_target_train_good_rgb_path = os.path.join(category_target_train_good_path, 'rgb')
-        category_target_train_good_xyz_path = os.path.join(category_target_train_good_path, 'xyz')
-        os.mkdir(category_target_train_good_path)
-        os.mkdir(category_target_train_good_rgb_path)
-        os.mkdir(category_target_train_good_xyz_path)
-
-        os.mkdir(os.path.join(category_target_path, 'test'))
-        category_target_test_good_path = os.path.join(category_target_path, 'test/good')
-        category_target_test_good_rgb_path = os.path.join(category_target_test_good_path, 'rgb')
-        category_target_test_good_xyz_path = os.path.join(category_target_test_good_path, 'xyz')
-        category_target_test_good_gt_path = os.path.join(category_target_test_good_path, 'gt')
-        os.mkdir(category_target_test_good_path)
-        os.mkdir(category_target_test_good_rgb_path)
-        os.mkdir(category_target_test_good_xyz_path)
-        os.mkdir(category_target_test_good_gt_path)
-        category_target_test_bad_path = os.path.join(category_target_path, 'test/bad')
-        category_target_test_bad_rgb_path = os.path.join(category_target_test_bad_path, 'rgb')
-        category_target_test_bad_xyz_path = os.path.join(category_target_test_bad_path, 'xyz')
-        category_target_test_bad_gt_path = os.path.join(category_target_test_bad_path, 'gt')
-        os.mkdir(category_target_test_bad_path)
-        os.mkdir(category_target_test_bad_rgb_path)
-        os.mkdir(category_target_test_bad_xyz_path)
-        os.mkdir(category_target_test_bad_gt_path)
-
-        category_train_files = os.listdir(category_train_path)
-        num_train_files = len(category_train_files)//17
-        for i in range(0, num_train_files):
-            pc = depth_to_pointcloud(
-                    os.path.join(category_train_path,str(i).zfill(3)+'_depth.png'),
-                    os.path.join(category_train_path,str(i).zfill(3)+'_info_depth.yaml'),
-                    os.path.join(category_train_path,str(i).zfill(3)+'_pose.txt'),
-                    FOCAL_LENGTH,
-                )
-            pc = remove_point_cloud_background(pc)
-            pc = pc.reshape(512,512,3)
-            tifffile.imwrite(os.path.join(category_target_train_good_xyz_path, str(i).zfill(3)+'.tiff'), pc)
-            copyfile(os.path.join(category_train_path,str(i).zfill(3)+'_image_4.png'),os.path.join(category_target_train_good_rgb_path, str(i).zfill(3)+'.png'))
-            
-        
-        category_test_files = os.listdir(category_test_path)
-        num_test_files = len(category_test_files)//17
-        for i in range(0, num_test_files):
-            mask = cv2.imread(os.path.join(category_test_path,str(i).zfill(2)+'_mask.png'))
-            if np.any(mask):
-                pc = depth_to_pointcloud(
-                    os.path.join(category_test_path,str(i).zfill(2)+'_depth.png'),
-                    os.path.join(category_test_path,str(i).zfill(2)+'_info_depth.yaml'),
-                    os.path.join(category_test_path,str(i).zfill(2)+'_pose.txt'),
-                    FOCAL_LENGTH,
-                    )
-                pc = remove_point_cloud_background(pc)
-                pc = pc.reshape(512,512,3)
-                tifffile.imwrite(os.path.join(category_target_test_bad_xyz_path, str(i).zfill(3)+'.tiff'), pc)
-                cv2.imwrite(os.path.join(category_target_test_bad_gt_path, str(i).zfill(3)+'.png'), mask)
-                copyfile(os.path.join(category_test_path,str(i).zfill(2)+'_image_4.png'),os.path.join(category_target_test_bad_rgb_path, str(i).zfill(3)+'.png'))
-            else:
-                pc = depth_to_pointcloud(
-                    os.path.join(category_test_path,str(i).zfill(2)+'_depth.png'),
-                    os.path.join(category_test_path,str(i).zfill(2)+'_info_depth.yaml'),
-                    os.path.join(category_test_path,str(i).zfill(2)+'_pose.txt'),
-                    FOCAL_LENGTH,
-                    )
-                pc = remove_point_cloud_background(pc)
-                pc = pc.reshape(512,512,3)
-                tifffile.imwrite(os.path.join(category_target_test_good_xyz_path, str(i).zfill(3)+'.tiff'), pc)
-                cv2.imwrite(os.path.join(category_target_test_good_gt_path, str(i).zfill(3)+'.png'), mask)
-                copyfile(os.path.join(category_test_path,str(i).zfill(2)+'_image_4.png'),os.path.join(category_target_test_good_rgb_path, str(i).zfill(3)+'.png'))
+
+    tasks = []
+    for category_dir in sorted(os.listdir(args.dataset_path)):
+        tasks += category_tasks(args.dataset_path, args.target_dir, category_dir)
+    print(f"Preprocessing {len(tasks)} samples with {args.workers} worker(s)...")
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        sample_times = []
+        for sample_time in pool.map(preprocess_sample, tasks, chunksize=4):
+            sample_times.append(sample_time)
+            if len(sample_times) % 100 == 0:
+                print(f"Processed {len(sample_times)}/{len(tasks)} samples...")
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {len(sample_times)} samples in {elapsed:.1f} s ({1000 * np.mean(sample_times):.1f} ms/sample per worker)")
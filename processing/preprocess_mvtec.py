@@ -1,4 +1,8 @@
 import os
+import json
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
 import tifffile as tiff
 import open3d as o3d
@@ -96,7 +100,22 @@ def pad_cropped_pc(cropped_pc, single_channel=False):
     else:
         return np.pad(cropped_pc, pad_width=((a, aa), (b, bb), (0, 0)), mode='constant')
 
+class StageTimer:
+    """Accumulates the wall time of the named stages of the preprocessing of a file, in seconds."""
+
+    def __init__(self):
+        self.timings = {}
+        self._start = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.timings[stage] = self.timings.get(stage, 0.0) + now - self._start
+        self._start = now
+
 def preprocess_pc(tiff_path):
+    """Preprocess a point cloud in place, return the time spent in each stage."""
+    timer = StageTimer()
+
     # READ FILES
     organized_pc = mvt_util.read_tiff_organized_pc(tiff_path)
     rgb_path = str(tiff_path).replace("xyz", "rgb").replace("tiff", "png")
@@ -107,9 +126,11 @@ def preprocess_pc(tiff_path):
     gt_exists = os.path.isfile(gt_path)
     if gt_exists:
         organized_gt = np.array(Image.open(gt_path))
+    timer.lap('read')
 
     # REMOVE PLANE
     planeless_organized_pc, planeless_organized_rgb = remove_plane(organized_pc, organized_rgb)
+    timer.lap('plane_fit')
 
 
     # PAD WITH ZEROS TO LARGEST SIDE (SO THAT THE FINAL IMAGE IS SQUARE)
@@ -117,37 +138,136 @@ def preprocess_pc(tiff_path):
     padded_planeless_organized_rgb = pad_cropped_pc(planeless_organized_rgb, single_channel=False)
     #if gt_exists:
     #    padded_organized_gt = pad_cropped_pc(organized_gt, single_channel=True)
+    timer.lap('padding')
 
     organized_clustered_pc, organized_clustered_rgb = connected_components_cleaning(padded_planeless_organized_pc, padded_planeless_organized_rgb, tiff_path)
+    timer.lap('clustering')
     # SAVE PREPROCESSED FILES
-    tiff.imsave(tiff_path, organized_clustered_pc)
+    # Written next to the original and renamed over it, so that an interruption never leaves a truncated file.
+    tmp_path = f'{tiff_path}.tmp'
+    try:
+        tiff.imwrite(tmp_path, organized_clustered_pc)
+        os.replace(tmp_path, tiff_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
     #Image.fromarray(organized_clustered_rgb).save(rgb_path)
     #if gt_exists:
     #    Image.fromarray(padded_organized_gt).save(gt_path)
+    timer.lap('write')
+    return timer.timings
+
+def file_signature(path):
+    # Size and modification time of a file. The preprocessing is done in place, so the manifest records the signature
+    # of a file before it is rewritten ('started') and after ('done'): see is_preprocessed.
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def read_manifest(manifest_path):
+    """{relative path: (state, signature)} of the last manifest entry of each file, from the JSON lines manifest."""
+    entries = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line truncated by an interruption.
+                    continue
+                # Entries written before the started state was recorded are all done.
+                entries[entry['path']] = (entry.get('state', 'done'), entry['signature'])
+    return entries
+
+def line_truncated(manifest_path):
+    """Whether the last line of the manifest was cut by an interruption, i.e. misses its newline."""
+    if not os.path.exists(manifest_path) or os.path.getsize(manifest_path) == 0:
+        return False
+    with open(manifest_path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) != b'\n'
+
+def is_preprocessed(entry, signature):
+    """
+    Whether a file of current signature was preprocessed, given its last manifest entry: it is if its done signature
+    still matches, or if it was started and has changed since, i.e. the rewrite went through but the run was
+    interrupted before the done entry was written.
+    """
+    if entry is None:
+        return False
+    state, recorded = entry
+    return recorded == signature if state == 'done' else recorded != signature
+
+def preprocess_file(root_path, relative_path):
+    """Pool task: preprocess one file, return its relative path, stage timings and new signature."""
+    path = os.path.join(root_path, relative_path)
+    timings = preprocess_pc(path)
+    return relative_path, timings, file_signature(path)
+
+def preprocess_dataset(root_path, workers, manifest_path):
+    """
+    Preprocess every .tiff file of root_path in a pool of worker processes, skipping the files already preprocessed
+    according to the manifest (JSON lines: a 'started' entry with the signature of each file before it is rewritten,
+    then a 'done' entry as soon as it is written) so that an interrupted run can be resumed, and report the time
+    spent in each stage.
+    """
+    tiff_paths = sorted(str(path.relative_to(root_path)) for path in Path(root_path).rglob('*.tiff'))
+    entries = read_manifest(manifest_path)
+    signatures = {path: file_signature(os.path.join(root_path, path)) for path in tiff_paths}
+    pending = [path for path in tiff_paths if not is_preprocessed(entries.get(path), signatures[path])]
+    # Rewritten by an interrupted run before it recorded them as done.
+    recovered = [path for path in tiff_paths if entries.get(path, ('done', None))[0] == 'started'
+                 and is_preprocessed(entries[path], signatures[path])]
+    print(f"Found {len(tiff_paths)} tiff files in {root_path}, {len(tiff_paths) - len(pending)} already preprocessed")
+
+    stage_totals = defaultdict(float)
+    processed_files, failed_files = 0, 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(manifest_path, 'a') as manifest:
+        if line_truncated(manifest_path):
+            # Otherwise the next entry would be appended to the truncated line and lost.
+            manifest.write('\n')
+        for path in recovered:
+            manifest.write(json.dumps({'path': path, 'state': 'done', 'signature': signatures[path]}) + '\n')
+        # The started entries must be on disk before any file is rewritten.
+        for path in pending:
+            manifest.write(json.dumps({'path': path, 'state': 'started', 'signature': signatures[path]}) + '\n')
+        manifest.flush()
+        os.fsync(manifest.fileno())
+
+        futures = {pool.submit(preprocess_file, root_path, path): path for path in pending}
+        for future in as_completed(futures):
+            try:
+                relative_path, timings, signature = future.result()
+            except Exception as e:
+                failed_files += 1
+                print(f"Failed to preprocess {futures[future]}: {e}")
+                continue
+
+            manifest.write(json.dumps({'path': relative_path, 'state': 'done', 'signature': signature, 'timings': timings}) + '\n')
+            manifest.flush()
+            for stage, seconds in timings.items():
+                stage_totals[stage] += seconds
+            processed_files += 1
+            if processed_files % 50 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"Processed {processed_files}/{len(pending)} tiff files ({processed_files / elapsed:.2f} files/s)...")
+
+    elapsed = time.perf_counter() - start
+    print(f"Processed {processed_files} tiff files in {elapsed:.1f} s with {workers} worker(s), {failed_files} failed")
+    if processed_files:
+        busy = sum(stage_totals.values())
+        for stage, seconds in stage_totals.items():
+            print(f"  {stage:>10}: {1000 * seconds / processed_files:8.1f} ms/file ({100 * seconds / busy:4.1f}%)")
+        print(f"  Parallel speedup: {busy / elapsed:.1f}x over the sum of the per-file times")
 
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Preprocess MVTec 3D-AD')
     parser.add_argument('dataset_path', type=str, help='The root path of the MVTec 3D-AD. The preprocessing is done inplace (i.e. the preprocessed dataset overrides the existing one)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes.')
+    parser.add_argument('--manifest', type=str, default=None, help='Manifest of the preprocessed files, used to resume an interrupted run (default: preprocess_manifest.jsonl in the dataset root).')
     args = parser.parse_args()
 
-
-    root_path = args.dataset_path
-    paths = Path(root_path).rglob('*.tiff')
-    print(f"Found {len(list(paths))} tiff files in {root_path}")
-    processed_files = 0
-    for path in Path(root_path).rglob('*.tiff'):
-        preprocess_pc(path)
-        processed_files += 1
-        if processed_files % 50 == 0:
-            print(f"Processed {processed_files} tiff files...")
-
-
-
-
-
-
-
-
-
+    manifest_path = args.manifest or os.path.join(args.dataset_path, 'preprocess_manifest.jsonl')
+    preprocess_dataset(args.dataset_path, args.workers, manifest_path)
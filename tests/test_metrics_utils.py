@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+from utils.metrics_utils import compute_pro, compute_pro_loop
+
+
+def random_maps(seed, num_maps = 4, size = 32, dtype = np.float32, decimals = None):
+    """Random anomaly maps and ground truths with a few rectangular defects, some of them touching."""
+    rng = np.random.default_rng(seed)
+    anomaly_maps, ground_truth_maps = [], []
+    for _ in range(num_maps):
+        gt = np.zeros((size, size), dtype = np.uint8)
+        for _ in range(rng.integers(0, 4)):
+            y, x = rng.integers(0, size - 4, size = 2)
+            h, w = rng.integers(1, 8, size = 2)
+            gt[y:y + h, x:x + w] = 1
+        scores = rng.random((size, size)) + 0.5 * gt
+        if decimals is not None:
+            # Few distinct scores: ties between anomalous and anomaly-free pixels, and at the thresholds.
+            scores = np.round(scores, decimals)
+        anomaly_maps.append(scores.astype(dtype))
+        ground_truth_maps.append(gt)
+    # At least one defect, the PRO curve is undefined otherwise.
+    ground_truth_maps[0][:3, :3] = 1
+    return anomaly_maps, ground_truth_maps
+
+
+def assert_same_curves(anomaly_maps, ground_truth_maps, num_thresholds):
+    fprs, pros, thresholds = compute_pro(anomaly_maps, ground_truth_maps, num_thresholds)
+    fprs_loop, pros_loop, thresholds_loop = compute_pro_loop(anomaly_maps, ground_truth_maps, num_thresholds)
+    np.testing.assert_array_equal(fprs, fprs_loop)
+    np.testing.assert_array_equal(pros, pros_loop)
+    np.testing.assert_array_equal(np.asarray(thresholds, dtype = np.float64), np.asarray(thresholds_loop, dtype = np.float64))
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('num_thresholds', [1, 7, 99])
+def test_compute_pro_matches_loop(seed, num_thresholds):
+    assert_same_curves(*random_maps(seed), num_thresholds)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('decimals', [0, 1, 2])
+def test_compute_pro_matches_loop_with_tied_scores(seed, decimals):
+    assert_same_curves(*random_maps(seed, decimals = decimals), num_thresholds = 99)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_compute_pro_matches_loop_in_float64(seed):
+    assert_same_curves(*random_maps(seed, dtype = np.float64), num_thresholds = 99)
+
+
+def test_compute_pro_without_anomalous_pixels():
+    anomaly_maps = [np.random.default_rng(0).random((16, 16), dtype = np.float32)]
+    ground_truth_maps = [np.zeros((16, 16), dtype = np.uint8)]
+    with pytest.raises(ValueError, match = 'without anomalous pixels'):
+        compute_pro(anomaly_maps, ground_truth_maps, num_thresholds = 10)
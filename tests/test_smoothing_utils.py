@@ -0,0 +1,39 @@
+import pytest
+import torch
+
+from utils.smoothing_utils import BOX_FILTERS, box_blur_loop, smooth_residuals
+
+
+def random_residual(batch_size, height, width, dtype = torch.float32):
+    generator = torch.Generator().manual_seed(0)
+    residual = torch.rand(batch_size, 1, height, width, generator = generator, dtype = dtype)
+    # Residuals are zero on the background.
+    residual[..., :height // 4, :] = 0
+    return residual
+
+
+@pytest.mark.parametrize('batch_size', [1, 3])
+@pytest.mark.parametrize('height, width', [(224, 224), (40, 56), (9, 5)])
+def test_smooth_residuals_matches_loop(batch_size, height, width):
+    residual = random_residual(batch_size, height, width)
+    torch.testing.assert_close(smooth_residuals(residual), box_blur_loop(residual), rtol = 1e-4, atol = 1e-6)
+
+
+@pytest.mark.parametrize('box_filters', [((3, 1),), ((5, 2), (9, 1)), BOX_FILTERS])
+def test_smooth_residuals_matches_loop_with_other_filters(box_filters):
+    residual = random_residual(2, 64, 48)
+    torch.testing.assert_close(smooth_residuals(residual, box_filters), box_blur_loop(residual, box_filters),
+                               rtol = 1e-4, atol = 1e-6)
+
+
+def test_smooth_residuals_matches_loop_in_float64():
+    residual = random_residual(2, 224, 224, dtype = torch.float64)
+    smoothed = smooth_residuals(residual)
+    assert smoothed.dtype == torch.float64
+    torch.testing.assert_close(smoothed, box_blur_loop(residual), rtol = 1e-10, atol = 1e-12)
+
+
+def test_smooth_residuals_keeps_the_shape():
+    residual = random_residual(1, 32, 32)
+    # Any leading dimensions, e.g. a single [H, W] map.
+    torch.testing.assert_close(smooth_residuals(residual[0, 0]), box_blur_loop(residual)[0, 0], rtol = 1e-4, atol = 1e-6)
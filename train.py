@@ -0,0 +1,160 @@
+import argparse
+import os
+import time
+
+import torch
+import torch.nn.functional as F
+
+from infer import set_seeds, FusionEncoder, DecoupledDecoder, foreground_rows
+from models.dataset import get_data_loader, mvtec3d_classes
+from models.features import MultimodalFeatures, upsample_features
+from models.model_registry import cfm_checkpoint_paths
+
+
+def sample_features(batch, feature_extractor, device):
+    """
+    (rgb_patch, xyz_patch) rows (B * 224 * 224, C) of a train batch, upsampled from the backbone outputs of a
+    feature store or extracted.
+    """
+    inputs, _ = batch
+    with torch.no_grad():
+        if feature_extractor is None:
+            rgb_maps, xyz_features, centers, pc = (tensor.to(device, torch.float32) for tensor in inputs)
+            rgb_patch, xyz_patch = upsample_features(pc, rgb_maps, xyz_features, centers)
+        else:
+            rgb, pc, _ = inputs
+            rgb_patch, xyz_patch = feature_extractor.get_features_maps_batch(rgb.to(device), pc.to(device))
+    rgb_patch = rgb_patch.to(device, torch.float32).reshape(-1, rgb_patch.shape[-1])
+    xyz_patch = xyz_patch.to(device, torch.float32).reshape(-1, xyz_patch.shape[-1])
+    return rgb_patch, xyz_patch
+
+
+def patch_batches(data_loader, feature_extractor, patch_batch_size, device):
+    """
+    Yield (rgb_rows, xyz_rows) batches of patch_batch_size foreground patches. The CFMs map every patch on its own,
+    so the patches of the samples of each loader batch are shuffled together and the steps do not depend on the
+    number of samples.
+    """
+    for batch in data_loader:
+        rgb_patch, xyz_patch = sample_features(batch, feature_extractor, device)
+        # The background rows are masked out of the combined residual, they are not trained on.
+        foreground = foreground_rows(xyz_patch)
+        rows = foreground[torch.randperm(len(foreground), device = foreground.device)]
+        for start in range(0, len(rows), patch_batch_size):
+            index = rows[start:start + patch_batch_size]
+            yield rgb_patch[index], xyz_patch[index]
+
+
+def checkpoint_names(args):
+    """(epochs, batch size) in the file names of the periodic and the final checkpoints of a run."""
+    names = [(epoch, args.batch_size) for epoch in range(1, args.epochs_no)
+             if args.save_every and epoch % args.save_every == 0]
+    final = (args.checkpoint_name_ep if args.checkpoint_name_ep is not None else args.epochs_no,
+             args.checkpoint_name_bs if args.checkpoint_name_bs is not None else args.batch_size)
+    return names + [final]
+
+
+def existing_checkpoints(args):
+    """Checkpoint files the run would overwrite."""
+    return [path for class_name in args.class_names for epochs_no, batch_size in checkpoint_names(args)
+            for path in cfm_checkpoint_paths(args.checkpoint_folder, class_name, epochs_no = epochs_no, batch_size = batch_size)
+            if os.path.exists(path)]
+
+
+def save_checkpoints(fusion_encoder, decoder_2D, decoder_3D, checkpoint_folder, class_name, epochs_no, batch_size):
+    paths = cfm_checkpoint_paths(checkpoint_folder, class_name, epochs_no = epochs_no, batch_size = batch_size)
+    os.makedirs(os.path.dirname(paths[0]), exist_ok = True)
+    for module, path in zip((fusion_encoder, decoder_2D, decoder_3D), paths):
+        torch.save(module.state_dict(), path)
+    print(f"{class_name}: saved the {epochs_no}ep_{batch_size}bs checkpoints in {os.path.dirname(paths[0])}")
+
+
+def train_class(class_name, feature_extractor, args):
+    """Train the fusion encoder and the 2D / 3D decoders of a class to restore the features of its train samples."""
+    set_seeds()
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    fusion_encoder = FusionEncoder().to(device)
+    decoder_2D = DecoupledDecoder(out_features=768).to(device)
+    decoder_3D = DecoupledDecoder(out_features=1152).to(device)
+    modules = (fusion_encoder, decoder_2D, decoder_3D)
+    for module in modules:
+        module.train()
+    optimizer = torch.optim.Adam([p for module in modules for p in module.parameters()], lr = args.learning_rate)
+
+    data_loader = get_data_loader('train', class_name = class_name, dataset_path = args.dataset_path,
+                                  batch_size = args.batch_size, shuffle = True, num_workers = args.num_workers,
+                                  prefetch_factor = args.prefetch_factor, features_path = args.features_path)
+
+    for epoch in range(1, args.epochs_no + 1):
+        start, steps, patches, total_loss = time.perf_counter(), 0, 0, 0.0
+        for rgb_rows, xyz_rows in patch_batches(data_loader, feature_extractor, args.patch_batch_size, device):
+            # bfloat16 autocast has the range of float32, no loss scaling is needed.
+            with torch.autocast(device_type = device, dtype = torch.bfloat16, enabled = args.amp):
+                fusion_embedding = fusion_encoder(rgb_rows, xyz_rows)
+                loss = (F.mse_loss(decoder_2D(fusion_embedding).float(), rgb_rows) +
+                        F.mse_loss(decoder_3D(fusion_embedding).float(), xyz_rows))
+
+            optimizer.zero_grad(set_to_none = True)
+            loss.backward()
+            optimizer.step()
+
+            steps += 1
+            patches += len(rgb_rows)
+            total_loss += loss.item()
+            if args.log_every and steps % args.log_every == 0:
+                print(f"{class_name}: epoch {epoch} step {steps} loss {total_loss / steps:.5f} "
+                      f"({patches / (time.perf_counter() - start):.0f} patches/s)")
+
+        elapsed = time.perf_counter() - start
+        print(f"{class_name}: epoch {epoch}/{args.epochs_no} loss {total_loss / max(steps, 1):.5f}, {steps} steps, "
+              f"{patches} patches in {elapsed:.1f} s ({patches / elapsed:.0f} patches/s)")
+
+        if args.save_every and epoch % args.save_every == 0 and epoch < args.epochs_no:
+            save_checkpoints(fusion_encoder, decoder_2D, decoder_3D, args.checkpoint_folder, class_name, epoch,
+                             args.batch_size)
+
+    save_checkpoints(fusion_encoder, decoder_2D, decoder_3D, args.checkpoint_folder, class_name, *checkpoint_names(args)[-1])
+
+
+def train(args):
+    # Checked before any training, e.g. the pretrained checkpoints must not be replaced by accident.
+    existing = existing_checkpoints(args)
+    if existing and not args.overwrite:
+        raise Exception(f"{len(existing)} checkpoint file(s) already exist, e.g. {existing[0]}: "
+                        f"use another --checkpoint_folder or --overwrite")
+
+    torch.set_num_threads(args.threads)
+
+    # Without a feature store the frozen backbones run on every loaded batch.
+    feature_extractor = None
+    if args.features_path is None:
+        feature_extractor = MultimodalFeatures()
+        feature_extractor.eval()
+
+    for class_name in args.class_names:
+        train_class(class_name, feature_extractor, args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the crossmodal feature mapping heads on the train split of whole classes.')
+    parser.add_argument('--dataset_path', default='./datasets/mvtec3d', type=str, help='Dataset path.')
+    parser.add_argument('--features_path', default=None, type=str, help='Feature stores written by extract_features.py (default: run the backbones on the fly).')
+    parser.add_argument('--class_names', default=mvtec3d_classes(), type=str, nargs='+', help='Categories to train (default: every MVTec 3D-AD class).')
+    parser.add_argument('--checkpoint_folder', default='./checkpoints/trained', type=str, help='Path to the folder to save the checkpoints in (the pretrained ones are in ./checkpoints/General).')
+    parser.add_argument('--overwrite', action='store_true', help='Overwrite existing checkpoint files.')
+    parser.add_argument('--epochs_no', default=100, type=int, help='Number of epochs.')
+    parser.add_argument('--batch_size', default=4, type=int, help='Samples per loader batch, whose patches are shuffled together.')
+    parser.add_argument('--patch_batch_size', default=8192, type=int, help='Foreground patches per optimizer step.')
+    parser.add_argument('--learning_rate', default=1e-3, type=float, help='Adam learning rate.')
+    parser.add_argument('--amp', action='store_true', help='Mixed precision training (bfloat16 autocast).')
+    parser.add_argument('--num_workers', default=4, type=int, help='DataLoader worker processes.')
+    parser.add_argument('--prefetch_factor', default=2, type=int, help='Batches loaded ahead by each worker.')
+    parser.add_argument('--save_every', default=10, type=int, help='Save the checkpoints every this many epochs (0: only at the end).')
+    parser.add_argument('--checkpoint_name_ep', default=None, type=int, help='Epochs in the file names of the final checkpoints (default: --epochs_no). app.py loads 100, see CFM_EPOCHS_NO.')
+    parser.add_argument('--checkpoint_name_bs', default=None, type=int, help='Batch size in the file names of the final checkpoints (default: --batch_size). app.py loads 1, see CFM_BATCH_SIZE.')
+    parser.add_argument('--log_every', default=50, type=int, help='Log the loss and throughput every this many steps (0: only per epoch).')
+    parser.add_argument('--threads', default=torch.get_num_threads(), type=int, help='Torch CPU threads.')
+    args = parser.parse_args()
+
+    train(args)
@@ -0,0 +1,67 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class DynamicBatcher:
+    """
+    Coalesces concurrent requests into micro-batches.
+
+    Items submitted from any thread are queued and collected by a single worker thread, which waits at most
+    max_wait_ms after the first item of a batch for further items (up to max_batch_size) and then hands the whole
+    batch to process_batch. process_batch receives the list of items and must return one result per item; a result
+    that is an Exception instance is raised to the caller of that item only.
+    """
+
+    def __init__(self, process_batch, max_batch_size = 8, max_wait_ms = 10):
+        self.process_batch = process_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max_wait_ms / 1000.0
+
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """Queue an item and return a Future resolved with its result."""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name='dynamic-batcher', daemon=True)
+                self._worker.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+
+            try:
+                results = self.process_batch(items)
+            except Exception as e:
+                results = [e] * len(items)
+
+            for future, result in zip(futures, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
@@ -0,0 +1,81 @@
+import json
+import os
+
+import numpy as np
+from PIL import Image
+from sklearn.metrics import roc_auc_score
+
+from models.dataset import RGB_SIZE, TestDataset
+from utils.feature_store_utils import FeatureStoreReader
+from utils.metrics_utils import calculate_au_pro
+from utils.prediction_store_utils import load_store
+
+# Integration limits of the AU-PRO, and the metrics of a class in the order of the result tables.
+AU_PRO_LIMITS = (0.3, 0.1, 0.05, 0.01)
+METRICS = ('AUPRO@30%', 'AUPRO@10%', 'AUPRO@5%', 'AUPRO@1%', 'P-AUROC', 'I-AUROC')
+METRICS_FILE = 'metrics.json'
+
+
+def load_ground_truths(dataset):
+    """
+    Ground truth masks of a TestDataset, (N, RGB_SIZE, RGB_SIZE) uint8, preallocated and filled without decoding
+    the RGB images and the point clouds.
+    """
+    gts = np.zeros((len(dataset), RGB_SIZE, RGB_SIZE), dtype = np.uint8)
+    for i, gt_path in enumerate(dataset.gt_paths):
+        if gt_path != 0:
+            gt = dataset.gt_transform(Image.open(gt_path).convert('L'))
+            gts[i] = (gt[0] > 0.5).numpy()
+    return gts
+
+
+def compute_metrics(predictions, gts, image_scores, labels):
+    """
+    MVTec 3D-AD metrics of a class.
+
+    Input:
+        predictions: anomaly maps, (N, H, W)
+        gts: binary ground truth masks, (N, H, W)
+        image_scores: anomaly score of each sample, (N,)
+        labels: 1 for the anomalous samples, (N,)
+    Return:
+        {metric: value} for every name of METRICS.
+    """
+    au_pros, _ = calculate_au_pro(gts, predictions, integration_limit = list(AU_PRO_LIMITS))
+    metrics = {f'AUPRO@{round(100 * limit)}%': au_pro for limit, au_pro in zip(AU_PRO_LIMITS, au_pros)}
+    metrics['P-AUROC'] = roc_auc_score(gts.ravel(), predictions.ravel())
+    metrics['I-AUROC'] = roc_auc_score(labels, image_scores)
+    return {name: float(metrics[name]) for name in METRICS}
+
+
+def evaluate_store(store_folder, class_name, dataset_path, map_name = 'residual_comb', features_path = None):
+    """
+    Metrics of a complete PredictionStore of a class (written by infer_batch.py), also saved to its metrics.json.
+    Runs in a worker process: only paths are passed in, the predictions are read from the memory-mapped store.
+    With features_path, the ground truths are read from the test FeatureStore of the class instead of the dataset.
+    """
+    manifest, scores, done, maps = load_store(store_folder)
+    if not done.all():
+        raise ValueError(f"{store_folder}: {int(len(done) - done.sum())} sample(s) are not scored yet")
+
+    if features_path is not None:
+        reader = FeatureStoreReader(os.path.join(features_path, class_name, 'test'))
+        samples = reader.manifest['samples']
+        gts = np.stack([reader.gt(i) for i in range(len(reader))])
+    else:
+        dataset = TestDataset(class_name = class_name, img_size = 224, dataset_path = dataset_path)
+        samples = [rgb for rgb, _ in dataset.img_paths]
+        gts = load_ground_truths(dataset)
+    if samples != manifest['samples']:
+        raise ValueError(f"{store_folder} does not hold the predictions of the test split of {class_name}")
+
+    predictions = np.asarray(maps[map_name], dtype = np.float32)
+    metrics = compute_metrics(predictions, gts, np.asarray(scores), np.asarray(manifest['labels']))
+    with open(os.path.join(store_folder, METRICS_FILE), 'w') as f:
+        json.dump(metrics, f, indent = 2)
+    return class_name, metrics
+
+
+def mean_metrics(results):
+    """Mean of every metric over the classes of {class_name: {metric: value}}."""
+    return {name: float(np.mean([metrics[name] for metrics in results.values()])) for name in METRICS}
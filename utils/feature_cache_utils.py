@@ -0,0 +1,173 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+
+def tensor_digest(hasher, tensor):
+    """Feed the dtype, shape and raw bytes of a tensor to a hashlib object."""
+    tensor = tensor.detach().cpu().contiguous()
+    hasher.update(f'{tensor.dtype}{tuple(tensor.shape)}'.encode())
+    hasher.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+
+
+def module_fingerprint(module, config = ''):
+    """
+    Identity of a feature extractor: hash of its configuration string and of every parameter and buffer.
+    Features cached with a different fingerprint (other weights or settings) are never returned.
+    """
+    hasher = hashlib.sha256(config.encode())
+    for name, tensor in module.state_dict().items():
+        hasher.update(name.encode())
+        tensor_digest(hasher, tensor)
+    return hasher.hexdigest()
+
+
+def file_digest(path, block_size = 1 << 20):
+    """sha256 of the content of a file (e.g. a frozen TorchScript artifact, whose weights are not in a state_dict)."""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def feature_key(fingerprint, rgb, pc):
+    """Content address of the features of one sample: backbone fingerprint + decoded RGB and XYZ arrays."""
+    hasher = hashlib.sha256(fingerprint.encode())
+    tensor_digest(hasher, rgb)
+    tensor_digest(hasher, pc)
+    return hasher.hexdigest()
+
+
+# Backbone outputs of a sample held by a FeatureCache entry, in this order.
+FEATURE_PARTS = ('rgb', 'xyz', 'centers')
+
+
+class FeatureCache:
+    """
+    Two-tier cache of the backbone outputs (rgb_maps, xyz_features, centers) of single samples, addressed by
+    feature_key (see MultimodalFeatures.backbone_features_batch). These are a few MB per sample: the upsampling to
+    per-pixel features, which would take hundreds, is redone on every hit (see models.features.upsample_features).
+
+    The memory tier is an LRU bounded by max_memory_mb. If disk_dir is set, every entry is also written there as
+    one .npy file per tensor, read back memory-mapped on a memory miss (and promoted to the memory tier), so
+    features survive restarts and can be shared by several processes. max_disk_mb bounds the disk tier by deleting
+    the least recently used files (None means unbounded).
+    """
+
+    def __init__(self, max_memory_mb = 1024, disk_dir = None, max_disk_mb = None):
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = None if max_disk_mb is None else int(max_disk_mb * 1024 * 1024)
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def _nbytes(features):
+        return sum(t.numel() * t.element_size() for t in features)
+
+    def _paths(self, key):
+        return tuple(os.path.join(self.disk_dir, f'{key}.{part}.npy') for part in FEATURE_PARTS)
+
+    def get(self, key):
+        """Return the cached (rgb_maps, xyz_features, centers) CPU tensors of a key, or None."""
+        with self._lock:
+            features = self._entries.get(key)
+            if features is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return features
+
+        features = self._read_disk(key)
+        with self._lock:
+            if features is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store_memory(key, features)
+        return features
+
+    def put(self, key, features):
+        # Copies, a slice of a batched feature tensor would otherwise keep the storage of the whole batch alive.
+        features = tuple(tensor.detach().cpu().clone() for tensor in features)
+        with self._lock:
+            self._store_memory(key, features)
+        if self.disk_dir:
+            self._write_disk(key, features)
+
+    def _store_memory(self, key, features):
+        nbytes = self._nbytes(features)
+        if nbytes > self.max_memory_bytes:
+            return
+        self._entries.pop(key, None)
+        while self._entries and self.memory_usage() + nbytes > self.max_memory_bytes:
+            self._entries.popitem(last=False)
+        self._entries[key] = features
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        paths = self._paths(key)
+        try:
+            # Tensors backed by copy-on-write mappings: pages are read on first access and shared through the page
+            # cache across processes, the files are never modified.
+            features = tuple(torch.from_numpy(np.load(path, mmap_mode='c')) for path in paths)
+            for path in paths:
+                os.utime(path)
+        except (OSError, ValueError):
+            # Missing, partially evicted or concurrently written entry.
+            return None
+        return features
+
+    def _write_disk(self, key, features):
+        for path, tensor in zip(self._paths(key), features):
+            # Write to a temporary file first so readers never see a truncated array.
+            tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, tensor.numpy())
+            os.replace(tmp_path, path)
+        self._prune_disk()
+
+    def _prune_disk(self):
+        if self.max_disk_bytes is None:
+            return
+        files = []
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith('.npy'):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def memory_usage(self):
+        """Bytes currently held by the memory tier."""
+        return sum(self._nbytes(features) for features in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'memory_bytes': self.memory_usage(),
+                    'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
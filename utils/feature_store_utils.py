@@ -0,0 +1,157 @@
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+MANIFEST_FILE = 'manifest.json'
+DONE_FILE = 'done.npy'
+GT_FILE = 'gt.npy'
+FEATURE_DIMS = {'rgb': 768, 'xyz': 1152}
+# Per-sample arrays of a store, in the order of FeatureStoreReader.features. The backbone features are kept in the
+# dtype of the store, the point clouds and group centers (inputs of the interpolation) always in float32.
+FEATURE_PARTS = ('rgb', 'xyz', 'centers', 'pc')
+FLOAT32_PARTS = ('centers', 'pc')
+
+
+def chunk_file(kind, chunk):
+    return f'{kind}_{chunk:05d}.npy'
+
+
+def feature_shapes(num_group, image_size = 224):
+    """
+    Shapes of the per-sample arrays of a store: the DINO maps (8 pixels per patch), the Point-MAE features and
+    centers of the point groups (see MultimodalFeatures.backbone_features_batch) and the organized point cloud.
+    """
+    return {'rgb': [FEATURE_DIMS['rgb'], image_size // 8, image_size // 8], 'xyz': [FEATURE_DIMS['xyz'], num_group],
+            'centers': [num_group, 3], 'pc': [3, image_size, image_size]}
+
+
+class FeatureStore:
+    """
+    Resumable on-disk store of the backbone outputs of the samples of one class and split, written by
+    extract_features.py. Only what the backbones compute is stored, a few MB per sample: the per-pixel features
+    are rebuilt from it on read with models.features.upsample_features, which needs no weights.
+
+    The arrays are split into chunks of chunk_size samples, one .npy file per part and chunk (e.g. rgb_00000.npy of
+    shape (chunk_size, 768, 28, 28), see feature_shapes), preallocated and written memory-mapped, the features in
+    float16 or float32. The ground truth masks of the test split go to gt.npy. manifest.json records the samples,
+    their labels, the layout and the fingerprint of the backbones, done.npy flags the samples already written;
+    reopening a folder with the same manifest resumes it, another one raises a ValueError unless overwrite is set.
+    """
+
+    def __init__(self, folder, sample_paths, labels, fingerprint, shapes, dtype = 'float16', chunk_size = 16,
+                 gt_size = None, overwrite = False):
+        self.folder = folder
+        self.manifest = {'samples': list(sample_paths), 'labels': [int(label) for label in labels],
+                         'fingerprint': fingerprint, 'shapes': {kind: list(shape) for kind, shape in shapes.items()},
+                         'dtype': dtype, 'chunk_size': chunk_size, 'gt_size': gt_size}
+        os.makedirs(folder, exist_ok = True)
+
+        manifest_path = os.path.join(folder, MANIFEST_FILE)
+        self.resume = os.path.exists(manifest_path) and not overwrite
+        if self.resume:
+            with open(manifest_path) as f:
+                if json.load(f) != self.manifest:
+                    raise ValueError(f"{folder} holds the features of other samples or backbones, use overwrite to replace them")
+
+        num_samples = len(self.manifest['samples'])
+        self._chunks = {}
+        self.gts = None
+        if gt_size is not None:
+            self.gts = self._open(GT_FILE, np.uint8, (num_samples, gt_size, gt_size))
+        # Written last, so that a sample flagged as done always has its features on disk.
+        self.done = self._open(DONE_FILE, np.uint8, (num_samples,))
+
+        if not self.resume:
+            self.done[:] = 0
+            self.done.flush()
+            with open(manifest_path, 'w') as f:
+                json.dump(self.manifest, f)
+
+    def _open(self, file_name, dtype, shape):
+        path = os.path.join(self.folder, file_name)
+        if self.resume and os.path.exists(path):
+            return np.load(path, mmap_mode = 'r+')
+        return open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+
+    def _chunk(self, kind, chunk):
+        key = (kind, chunk)
+        if key not in self._chunks:
+            chunk_size = self.manifest['chunk_size']
+            num_samples = min(chunk_size, len(self) - chunk * chunk_size)
+            dtype = 'float32' if kind in FLOAT32_PARTS else self.manifest['dtype']
+            self._chunks[key] = self._open(chunk_file(kind, chunk), dtype,
+                                           (num_samples, *self.manifest['shapes'][kind]))
+        return self._chunks[key]
+
+    def __len__(self):
+        return len(self.done)
+
+    def pending(self):
+        """Indices of the samples without features yet."""
+        return np.flatnonzero(self.done == 0).tolist()
+
+    def write(self, indices, features, gts = None):
+        """
+        Store the arrays of the samples at indices, features mapping every part of FEATURE_PARTS to a (B, *shape)
+        array, and their (B, gt_size, gt_size) ground truths.
+        """
+        chunk_size = self.manifest['chunk_size']
+        written = set()
+        for j, i in enumerate(indices):
+            chunk, offset = divmod(i, chunk_size)
+            for kind in FEATURE_PARTS:
+                self._chunk(kind, chunk)[offset] = features[kind][j]
+            written.add(chunk)
+            if gts is not None:
+                self.gts[i] = gts[j]
+
+        for chunk in written:
+            for kind in FEATURE_PARTS:
+                self._chunk(kind, chunk).flush()
+        if gts is not None:
+            self.gts.flush()
+
+        self.done[indices] = 1
+        self.done.flush()
+
+
+class FeatureStoreReader:
+    """
+    Read access to a complete FeatureStore folder. The chunks are memory-mapped copy-on-write on first use in each
+    process (the reader can be sent to DataLoader workers, which reopen them), so reading a sample copies nothing.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        if 'shapes' not in self.manifest:
+            raise ValueError(f"{folder} holds upsampled features of an older extract_features.py, extract it again")
+        done = np.load(os.path.join(folder, DONE_FILE))
+        if not done.all():
+            raise ValueError(f"{folder}: the features of {int(len(done) - done.sum())} sample(s) are not extracted yet")
+        self._chunks = {}
+
+    def __getstate__(self):
+        return {'folder': self.folder, 'manifest': self.manifest, '_chunks': {}}
+
+    def __len__(self):
+        return len(self.manifest['samples'])
+
+    def _chunk(self, name):
+        if name not in self._chunks:
+            self._chunks[name] = np.load(os.path.join(self.folder, name), mmap_mode = 'c')
+        return self._chunks[name]
+
+    def features(self, i):
+        """(rgb_maps, xyz_features, centers, pc) of sample i, memory-mapped arrays of the shapes of feature_shapes."""
+        chunk, offset = divmod(i, self.manifest['chunk_size'])
+        return tuple(self._chunk(chunk_file(kind, chunk))[offset] for kind in FEATURE_PARTS)
+
+    def gt(self, i):
+        """Ground truth mask of sample i, (gt_size, gt_size) uint8, or None outside the test split."""
+        if self.manifest['gt_size'] is None:
+            return None
+        return self._chunk(GT_FILE)[i]
@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+import uuid
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    """State of a queued inference job, shared between the worker running it and the clients polling it."""
+
+    def __init__(self, payload):
+        self.id = str(uuid.uuid4())
+        self.payload = payload
+        self.status = 'queued'
+        self.stage = None
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+
+        # Every status / stage change is appended to events, clients follow them by index.
+        self.events = []
+        self._condition = threading.Condition()
+        self._add_event('status', {'status': self.status})
+
+    def _add_event(self, event, data):
+        with self._condition:
+            self.events.append((event, dict(data, job_id=self.id, time=time.time())))
+            self._condition.notify_all()
+
+    def set_stage(self, stage):
+        self.stage = stage
+        self._add_event('progress', {'stage': stage})
+
+    def set_running(self):
+        self.status = 'running'
+        self._add_event('status', {'status': self.status})
+
+    def set_result(self, result):
+        self.result = result
+        self.status = 'done'
+        self.finished_at = time.time()
+        self._add_event('result', {'status': self.status, 'result': result})
+
+    def set_error(self, error):
+        self.error = str(error)
+        self.status = 'failed'
+        self.finished_at = time.time()
+        self._add_event('error', {'status': self.status, 'error': self.error})
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def wait_for_events(self, since, timeout):
+        """Block until there are events after index since (or timeout) and return them."""
+        with self._condition:
+            if len(self.events) <= since and not self.finished:
+                self._condition.wait(timeout)
+            return self.events[since:]
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'status': self.status,
+            'stage': self.stage,
+            'result': self.result,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    """
+    Bounded job queue executed by a fixed pool of worker threads.
+
+    run_job(payload, set_stage) is called by a worker for each job and its return value becomes the job result;
+    set_stage(name) publishes the stage the job is in. submit raises QueueFullError once max_queued jobs are
+    waiting, so callers can apply backpressure. Finished jobs are forgotten after ttl seconds.
+    """
+
+    def __init__(self, run_job, num_workers = 2, max_queued = 32, ttl = 3600):
+        self.run_job = run_job
+        self.num_workers = max(1, int(num_workers))
+        self.ttl = ttl
+
+        self._queue = queue.Queue(maxsize=max(1, int(max_queued)))
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._workers = []
+
+    def _ensure_workers(self):
+        with self._lock:
+            self._workers = [worker for worker in self._workers if worker.is_alive()]
+            while len(self._workers) < self.num_workers:
+                worker = threading.Thread(target=self._run, name=f'job-worker-{len(self._workers)}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def submit(self, payload):
+        self._ensure_workers()
+        self._prune()
+
+        job = Job(payload)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise QueueFullError(f"Job queue is full ({self._queue.maxsize} jobs waiting)")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _prune(self):
+        now = time.time()
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job.finished and now - job.finished_at > self.ttl]
+            for job_id in expired:
+                del self._jobs[job_id]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            job.set_running()
+            try:
+                job.set_result(self.run_job(job.payload, job.set_stage))
+            except Exception as e:
+                job.set_error(e)
+            finally:
+                self._queue.task_done()
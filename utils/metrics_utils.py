@@ -164,11 +164,97 @@ def collect_anomaly_scores(anomaly_maps, ground_truth_maps):
     return ground_truth_components, anomaly_scores_ok_pixels
 
 
+def collect_component_scores(anomaly_maps, ground_truth_maps):
+    """
+    Vectorized counterpart of collect_anomaly_scores, with the anomaly scores of all the ground truth components
+    concatenated instead of one GroundTruthComponent each.
+
+    Returns:
+        component_ids:            Index of the ground truth component of every anomalous pixel, numbered across the
+                                  whole dataset in the order of collect_anomaly_scores.
+
+        component_scores:         Anomaly score of every anomalous pixel.
+
+        anomaly_scores_ok_pixels: Anomaly scores of all anomaly-free pixels of the dataset, unsorted.
+    """
+    assert len(anomaly_maps) == len(ground_truth_maps)
+
+    structure = np.ones((3, 3), dtype=int)
+
+    component_ids, component_scores, ok_scores = [], [], []
+    num_components = 0
+    for gt_map, prediction in zip(ground_truth_maps, anomaly_maps):
+        labeled, n_components = label(gt_map, structure)
+
+        ok_scores.append(prediction[labeled == 0])
+
+        # Component k of this map is component num_components + k - 1 of the dataset.
+        anomalous = labeled > 0
+        component_ids.append(labeled[anomalous] + (num_components - 1))
+        component_scores.append(prediction[anomalous])
+        num_components += n_components
+
+    return np.concatenate(component_ids), np.concatenate(component_scores), np.concatenate(ok_scores)
+
+
 def compute_pro(anomaly_maps, ground_truth_maps, num_thresholds):
     """
     Compute the PRO curve at equidistant interpolation points for a set of anomaly maps with corresponding ground
     truth maps. The number of interpolation points can be set manually.
 
+    Vectorized version of compute_pro_loop, with identical results: the anomaly-free scores are sorted in their own
+    dtype rather than in float64, every anomalous pixel is assigned the first threshold it does not exceed
+    (searchsorted), and the number of pixels of each component below each threshold is the cumulative sum of a
+    bincount over (component, threshold) pairs.
+
+    Args:
+        anomaly_maps:      List of anomaly maps (2D numpy arrays) that contain a real-valued anomaly score at each pixel.
+
+        ground_truth_maps: List of ground truth maps (2D numpy arrays) that contain binary-valued ground truth labels
+                           for each pixel. 0 indicates that a pixel is anomaly-free. 1 indicates that a pixel contains
+                           an anomaly.
+
+        num_thresholds:    Number of thresholds to compute the PRO curve.
+    Returns:
+        fprs: List of false positive rates.
+        pros: List of correspoding PRO values.
+    """
+    component_ids, component_scores, anomaly_scores_ok_pixels = collect_component_scores(anomaly_maps, ground_truth_maps)
+    if len(component_ids) == 0:
+        raise ValueError("The PRO curve is undefined without anomalous pixels: no ground truth map has a component")
+    num_components = int(component_ids.max()) + 1
+
+    # Select equidistant thresholds. The cast to float64 of collect_anomaly_scores is exact and preserves the order,
+    # so it is only applied to the selected scores.
+    threshold_positions = np.linspace(0, len(anomaly_scores_ok_pixels) - 1, num=num_thresholds, dtype=int)
+    thresholds = np.sort(anomaly_scores_ok_pixels)[threshold_positions].astype(np.float64)
+
+    # A pixel with score s is counted as missed (s <= threshold) from the first threshold >= s onwards.
+    first_threshold = np.searchsorted(thresholds, component_scores, side='left')
+    counts = np.bincount(component_ids * (num_thresholds + 1) + first_threshold,
+                         minlength=num_components * (num_thresholds + 1)).reshape(num_components, num_thresholds + 1)
+    counts = np.cumsum(counts, axis=1)[:, :num_thresholds]
+    sizes = np.bincount(component_ids, minlength=num_components)
+
+    # Region overlaps, summed over the components in order (cumsum is sequential, like the loop).
+    overlaps = 1.0 - counts / sizes[:, np.newaxis]
+    pro_values = np.cumsum(overlaps, axis=0)[-1] / num_components
+
+    fprs = [1.0] + [1.0 - (pos + 1) / len(anomaly_scores_ok_pixels) for pos in threshold_positions]
+    pros = [1.0] + pro_values.tolist()
+    thr = [0.0] + thresholds.tolist()
+
+    # Return (FPR/PRO) pairs in increasing FPR order.
+    return fprs[::-1], pros[::-1], thr[::-1]
+
+
+def compute_pro_loop(anomaly_maps, ground_truth_maps, num_thresholds):
+    """
+    Reference implementation of compute_pro, one GroundTruthComponent per ground truth component.
+
+    Compute the PRO curve at equidistant interpolation points for a set of anomaly maps with corresponding ground
+    truth maps. The number of interpolation points can be set manually.
+
     Args:
         anomaly_maps:      List of anomaly maps (2D numpy arrays) that contain a real-valued anomaly score at each pixel.
 
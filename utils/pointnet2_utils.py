@@ -33,7 +33,9 @@ def square_distance(src, dst):
     """
     B, N, _ = src.shape
     _, M, _ = dst.shape
-    dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
+    # Neighbors are wrong with reduced precision distances, keep the matmul out of autocast (bf16 inference).
+    with torch.autocast(device_type=src.device.type, enabled=False):
+        dist = -2 * torch.matmul(src, dst.permute(0, 2, 1))
     dist += torch.sum(src ** 2, -1).view(B, N, 1)
     dist += torch.sum(dst ** 2, -1).view(B, 1, M)
     return dist
@@ -157,12 +159,14 @@ def sample_and_group_all(xyz, points):
     return new_xyz, new_points
 
 
-def interpolating_points(xyz1, xyz2, points2):
+def interpolating_points(xyz1, xyz2, points2, chunk_size=4096):
     """
     Input:
         xyz1: input points position data, [B, C, N]
         xyz2: sampled input points position data, [B, C, S]
         points2: input points data, [B, D, S]
+        chunk_size: number of input points interpolated at once (None for all of them), bounds the
+                    [B, chunk_size, S] distance matrix and the [B, chunk_size, 3, D] gathered features
     Return:
         new_points: upsampled points data, [B, D', N]
     """
@@ -176,13 +180,16 @@ def interpolating_points(xyz1, xyz2, points2):
     if S == 1:
         interpolated_points = points2.repeat(1, N, 1)
     else:
-        dists = square_distance(xyz1, xyz2)
-        dists, idx = dists.sort(dim=-1)
-        dists, idx = dists[:, :, :3], idx[:, :, :3]  # [B, N, 3]
-        dist_recip = 1.0 / (dists + 1e-8)
-        norm = torch.sum(dist_recip, dim=2, keepdim=True)
-        weight = dist_recip / norm
-        interpolated_points = torch.sum(index_points(points2, idx) * weight.view(B, N, 3, 1), dim=2)
-        interpolated_points = interpolated_points.permute(0, 2, 1)
-
-    return interpolated_points
\ No newline at end of file
+        chunk_size = chunk_size or N
+        interpolated_points = torch.empty((B, points2.shape[-1], N), dtype=points2.dtype, device=points2.device)
+        for start in range(0, N, chunk_size):
+            end = min(start + chunk_size, N)
+            dists = square_distance(xyz1[:, start:end], xyz2)
+            dists, idx = torch.topk(dists, 3, dim=-1, largest=False, sorted=True)  # [B, chunk, 3]
+            dist_recip = 1.0 / (dists + 1e-8)
+            norm = torch.sum(dist_recip, dim=2, keepdim=True)
+            weight = dist_recip / norm
+            chunk_points = torch.sum(index_points(points2, idx) * weight.view(B, end - start, 3, 1), dim=2)
+            interpolated_points[:, :, start:end] = chunk_points.permute(0, 2, 1)
+
+    return interpolated_points
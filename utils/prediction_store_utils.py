@@ -0,0 +1,94 @@
+import csv
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+MANIFEST_FILE = 'manifest.json'
+SCORES_FILE = 'scores.npy'
+DONE_FILE = 'done.npy'
+SCORES_CSV_FILE = 'scores.csv'
+
+
+class PredictionStore:
+    """
+    Resumable on-disk store of the predictions of one class: an anomaly score and one or more float16 residual maps
+    per sample, in preallocated .npy files opened memory-mapped (see infer_batch.py).
+
+    manifest.json records the sample paths, their labels and the stored maps, done.npy flags the samples already
+    written. Reopening a folder whose manifest matches resumes it, the pending() samples being the ones left; a
+    folder written for other samples raises a ValueError unless overwrite is set.
+    """
+
+    def __init__(self, folder, sample_paths, labels, map_names = ('residual_comb',), map_size = 224, overwrite = False):
+        self.folder = folder
+        self.manifest = {'samples': list(sample_paths), 'labels': [int(label) for label in labels],
+                         'maps': list(map_names), 'map_size': map_size}
+        os.makedirs(folder, exist_ok = True)
+
+        manifest_path = os.path.join(folder, MANIFEST_FILE)
+        resume = os.path.exists(manifest_path) and not overwrite
+        if resume:
+            with open(manifest_path) as f:
+                if json.load(f) != self.manifest:
+                    raise ValueError(f"{folder} holds the predictions of other samples or maps, use overwrite to replace them")
+
+        num_samples = len(self.manifest['samples'])
+        mode = 'r+' if resume else 'w+'
+        self.scores = self._open(SCORES_FILE, mode, np.float32, (num_samples,))
+        self.maps = {name: self._open(f'{name}.npy', mode, np.float16, (num_samples, map_size, map_size))
+                     for name in map_names}
+        # Written last, so that a sample flagged as done always has its score and maps on disk.
+        self.done = self._open(DONE_FILE, mode, np.uint8, (num_samples,))
+
+        if not resume:
+            self.done[:] = 0
+            self.done.flush()
+            with open(manifest_path, 'w') as f:
+                json.dump(self.manifest, f)
+
+    def _open(self, file_name, mode, dtype, shape):
+        path = os.path.join(self.folder, file_name)
+        if mode == 'r+':
+            return np.load(path, mmap_mode = 'r+')
+        return open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+
+    def __len__(self):
+        return len(self.done)
+
+    def pending(self):
+        """Indices of the samples without predictions yet."""
+        return np.flatnonzero(self.done == 0).tolist()
+
+    def write(self, indices, scores, maps):
+        """Store the scores (B,) and the maps {name: (B, map_size, map_size)} of the samples at indices."""
+        self.scores[indices] = scores
+        for name, values in maps.items():
+            self.maps[name][indices] = values
+        self.scores.flush()
+        for values in self.maps.values():
+            values.flush()
+
+        self.done[indices] = 1
+        self.done.flush()
+
+    def export_csv(self):
+        """Write scores.csv (sample path, label, score) for the samples done so far and return its path."""
+        path = os.path.join(self.folder, SCORES_CSV_FILE)
+        with open(path, 'w', newline = '') as f:
+            writer = csv.writer(f)
+            writer.writerow(['sample', 'label', 'score'])
+            for i in np.flatnonzero(self.done):
+                writer.writerow([self.manifest['samples'][i], self.manifest['labels'][i], f'{self.scores[i]:.6f}'])
+        return path
+
+
+def load_store(folder):
+    """Read-only view of a PredictionStore folder: its manifest, scores, done flags and maps, memory-mapped."""
+    with open(os.path.join(folder, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    scores = np.load(os.path.join(folder, SCORES_FILE), mmap_mode = 'r')
+    done = np.load(os.path.join(folder, DONE_FILE), mmap_mode = 'r')
+    maps = {name: np.load(os.path.join(folder, f'{name}.npy'), mmap_mode = 'r') for name in manifest['maps']}
+    return manifest, scores, done, maps
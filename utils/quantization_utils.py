@@ -0,0 +1,87 @@
+import contextlib
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+# Inference precisions of the backbones and CFM heads:
+# 'fp32'        reference.
+# 'bf16'        autocast of the matmuls and convolutions to bfloat16.
+# 'int8'        dynamic quantization of the nn.Linear layers (int8 weights, activation ranges measured per call).
+# 'int8-static' int8 nn.Linear layers with activation ranges calibrated once on training samples.
+PRECISIONS = ('fp32', 'bf16', 'int8', 'int8-static')
+
+
+def check_precision(precision, device):
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+    if precision.startswith('int8') and str(device).startswith('cuda'):
+        raise ValueError(f"Precision {precision} is only supported on CPU")
+
+
+def precision_context(precision, device):
+    """Context manager to run the forward passes of a model prepared for the given precision."""
+    if precision == 'bf16':
+        return torch.autocast(device_type=str(device).split(':')[0], dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def quantize_dynamic_linear(module):
+    """Replace (in place) the nn.Linear layers of a module by dynamically quantized int8 ones."""
+    return quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+
+class StaticQuantLinear(nn.Sequential):
+    """nn.Linear with quantize / dequantize stubs, turned into a statically quantized layer by convert."""
+
+    def __init__(self, linear):
+        super().__init__(quantization.QuantStub(), linear, quantization.DeQuantStub())
+
+
+def _wrap_linear_layers(module, qconfig):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            wrapper = StaticQuantLinear(child)
+            wrapper.qconfig = qconfig
+            setattr(module, name, wrapper)
+        else:
+            _wrap_linear_layers(child, qconfig)
+
+
+def default_quantized_engine():
+    """Best available quantized engine: x86 (torch >= 2.0), then fbgemm, then qnnpack (ARM)."""
+    for engine in ('x86', 'fbgemm', 'qnnpack'):
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError(f"No supported quantized engine in {torch.backends.quantized.supported_engines}")
+
+
+def quantize_static_linear(module, calibrate, backend = None):
+    """
+    Statically quantize (in place) the nn.Linear layers of a module.
+
+    Every nn.Linear is wrapped between quantize / dequantize stubs, so the rest of the model (attention, norms,
+    pooling, point grouping) keeps running in fp32. calibrate(module) must run representative forward passes,
+    during which the observers record the activation ranges used by the int8 layers.
+    backend defaults to default_quantized_engine().
+    """
+    backend = backend or default_quantized_engine()
+    torch.backends.quantized.engine = backend
+    module.eval()
+    _wrap_linear_layers(module, quantization.get_default_qconfig(backend))
+    quantization.prepare(module, inplace=True)
+    with torch.no_grad():
+        calibrate(module)
+    quantization.convert(module, inplace=True)
+    return module
+
+
+def quantize_module(module, precision, calibrate = None):
+    """Prepare a module for a precision: int8 modes quantize its linear layers, the others leave it unchanged."""
+    if precision == 'int8':
+        return quantize_dynamic_linear(module)
+    if precision == 'int8-static':
+        if calibrate is None:
+            raise ValueError("Precision int8-static requires a calibration function")
+        return quantize_static_linear(module, calibrate)
+    return module
@@ -0,0 +1,56 @@
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image
+
+# zlib level of the PNGs: 1 encodes several times faster than the Pillow default (6) for slightly larger files
+PNG_COMPRESS_LEVEL = 1
+
+# Inverse of the ImageNet normalization of the inputs, as the float32 divisors and offsets of the two
+# transforms.Normalize the PNGs were previously denormalized with
+DENORMALIZE_STD = np.array([1 / 0.229, 1 / 0.224, 1 / 0.225], dtype = np.float32)
+DENORMALIZE_MEAN = np.array([0.485, 0.456, 0.406], dtype = np.float32)
+
+
+@lru_cache(maxsize=None)
+def colormap_lut(name = 'jet'):
+    """256 x 3 uint8 RGB lookup table of a matplotlib colormap, built once per process."""
+    # matplotlib is only imported by the first call, the lookups themselves are plain NumPy indexing.
+    from matplotlib import colormaps
+    return colormaps[name](np.arange(256), bytes = True)[:, :3]
+
+
+def colorize(values, name = 'jet'):
+    """
+    Map a 2D array to a (H, W, 3) uint8 RGB image through the lookup table of a colormap, min-max scaled like
+    plt.imsave.
+    """
+    values = np.asarray(values, dtype = np.float32)
+    vmin, vmax = values.min(), values.max()
+    scaled = (values - vmin) / (vmax - vmin) if vmax > vmin else np.zeros_like(values)
+    index = np.minimum((scaled * 256).astype(np.intp), 255)
+    return colormap_lut(name)[index]
+
+
+def denormalize_rgb(rgb):
+    """ImageNet-normalized (3, H, W) float image (array or CPU tensor) to a (H, W, 3) uint8 RGB image."""
+    rgb = np.asarray(rgb, dtype = np.float32).reshape(3, *np.shape(rgb)[-2:]).transpose(1, 2, 0)
+    rgb = rgb / DENORMALIZE_STD + DENORMALIZE_MEAN
+    return (np.clip(rgb, 0, 1) * 255).astype(np.uint8)
+
+
+def overlay(rgb_image, values, alpha = 0.5, name = 'jet'):
+    """Blend the colorized 2D array values onto a (H, W, 3) uint8 RGB image of the same size, alpha of heatmap."""
+    weight = int(round(alpha * 256))
+    blended = (rgb_image.astype(np.uint16) * (256 - weight) + colorize(values, name).astype(np.uint16) * weight + 128)
+    return (blended >> 8).astype(np.uint8)
+
+
+def write_png(path, image, compress_level = PNG_COMPRESS_LEVEL):
+    """Write a (H, W, 3) uint8 RGB image as a PNG."""
+    Image.fromarray(image).save(path, compress_level = compress_level)
+
+
+def save_colorized(path, values, name = 'jet', compress_level = PNG_COMPRESS_LEVEL):
+    """Write the colorized 2D array values as a PNG."""
+    write_png(path, colorize(values, name), compress_level)
@@ -0,0 +1,39 @@
+import base64
+import io
+
+import numpy as np
+
+MAP_DTYPES = ('float16', 'uint8')
+
+
+def quantize_map(values, dtype = 'float16'):
+    """
+    Compact copy of a residual map: float16, or uint8 min-max quantized. Returns the array and the (min, max) range
+    to dequantize it with (uint8 only, None for float16): values ~= vmin + q * (vmax - vmin) / 255.
+    """
+    values = np.asarray(values, dtype = np.float32)
+    if dtype == 'float16':
+        return values.astype(np.float16), None
+    if dtype != 'uint8':
+        raise ValueError(f"Unsupported map dtype {dtype}, expected one of {MAP_DTYPES}")
+
+    vmin, vmax = float(values.min()), float(values.max())
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0.0
+    return np.round((values - vmin) * scale).astype(np.uint8), (vmin, vmax)
+
+
+def encode_map(values, dtype = 'float16'):
+    """JSON-serializable encoding of a residual map: its quantized little-endian bytes in base64, shape and dtype."""
+    array, value_range = quantize_map(values, dtype)
+    encoded = {'dtype': dtype, 'shape': list(array.shape),
+               'data': base64.b64encode(array.astype(array.dtype.newbyteorder('<')).tobytes()).decode('ascii')}
+    if value_range is not None:
+        encoded['range'] = list(value_range)
+    return encoded
+
+
+def npz_payload(arrays):
+    """Uncompressed .npz archive (bytes) of a dict of arrays, loadable with np.load."""
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
@@ -0,0 +1,63 @@
+from functools import lru_cache
+
+import torch
+import torch.nn.functional as F
+
+# Box filters applied to the combined residual as a Gaussian blur approximation: (width, repetitions).
+BOX_FILTERS = ((5, 5), (7, 3))
+
+
+def box_blur_loop(residual, box_filters = BOX_FILTERS):
+    """
+    Reference implementation: one zero-padded box convolution per repetition.
+
+    Input:
+        residual: [B, 1, H, W]
+    """
+    for width, repetitions in box_filters:
+        weight = torch.ones(1, 1, width, width, device=residual.device, dtype=residual.dtype) / (width ** 2)
+        for _ in range(repetitions):
+            residual = F.conv2d(residual, weight=weight, padding=width // 2)
+    return residual
+
+
+def box_filter_matrix(size, width):
+    """
+    Matrix form of a 1D zero-padded box filter: (A @ x)[i] = mean(x[i - width // 2 : i + width // 2 + 1]),
+    with out of range samples counted as zeros.
+    """
+    idx = torch.arange(size)
+    return ((idx.view(-1, 1) - idx.view(1, -1)).abs() <= width // 2).double() / width
+
+
+@lru_cache(maxsize=None)
+def smoothing_operator(size, box_filters = BOX_FILTERS, device = 'cpu', dtype = torch.float32):
+    """
+    Compose all the box filters into a single [size, size] operator A.
+
+    A 2D box kernel is the outer product of two 1D box kernels and zero padding is applied independently along
+    each axis, so every zero-padded 2D box convolution of an image X equals B @ X @ B.T. The whole chain of
+    convolutions is then A @ X @ A.T, with A the product of the 1D box matrices, which is exact also at the
+    borders (unlike a single convolution with the composed kernel).
+    """
+    operator = torch.eye(size, dtype=torch.float64)
+    for width, repetitions in box_filters:
+        box = box_filter_matrix(size, width)
+        for _ in range(repetitions):
+            operator = box @ operator
+    return operator.to(device=device, dtype=dtype)
+
+
+def smooth_residuals(residual, box_filters = BOX_FILTERS):
+    """
+    Apply the box filter chain of box_blur_loop in a single pass.
+
+    Input:
+        residual: [..., H, W]
+    Return:
+        smoothed residual with the same shape.
+    """
+    height, width = residual.shape[-2:]
+    rows = smoothing_operator(height, box_filters, str(residual.device), residual.dtype)
+    cols = rows if width == height else smoothing_operator(width, box_filters, str(residual.device), residual.dtype)
+    return rows @ residual @ cols.T
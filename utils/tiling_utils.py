@@ -0,0 +1,68 @@
+import torch
+import torch.nn.functional as F
+
+
+def tile_positions(size, tile_size = 224, stride = 112):
+    """
+    Start offsets of the tiles covering [0, size) along one axis, the last tile being aligned to the end.
+    """
+    if size <= tile_size:
+        return [0]
+    positions = list(range(0, size - tile_size + 1, stride))
+    if positions[-1] != size - tile_size:
+        positions.append(size - tile_size)
+    return positions
+
+
+def tile_grid(height, width, tile_size = 224, stride = 112):
+    """(y, x) offsets of the overlapping tiles covering a height x width map."""
+    return [(y, x) for y in tile_positions(height, tile_size, stride) for x in tile_positions(width, tile_size, stride)]
+
+
+def pad_to_tile(tensor, tile_size = 224):
+    """Zero-pad the last two dimensions of a tensor up to tile_size (for inputs smaller than a tile)."""
+    height, width = tensor.shape[-2:]
+    return F.pad(tensor, (0, max(0, tile_size - width), 0, max(0, tile_size - height)))
+
+
+def extract_tiles(tensor, positions, tile_size = 224):
+    """
+    Input:
+        tensor: [C, H, W] with H, W >= tile_size
+    Return:
+        tiles: [T, C, tile_size, tile_size]
+    """
+    return torch.stack([tensor[:, y:y + tile_size, x:x + tile_size] for y, x in positions])
+
+
+def blend_window(tile_size = 224, device = 'cpu', dtype = torch.float32):
+    """
+    Separable Hann weights for overlap blending: tile centers, where the backbones see the most context, dominate
+    the stitched map while the weights stay positive up to the tile borders.
+    """
+    window = torch.hann_window(tile_size + 2, periodic=False, dtype=torch.float64)[1:-1]
+    return (window.view(-1, 1) * window.view(1, -1)).to(device=device, dtype=dtype)
+
+
+class TileStitcher:
+    """Weighted average of overlapping tile maps into a height x width map."""
+
+    def __init__(self, height, width, tile_size = 224, device = 'cpu', dtype = torch.float32):
+        self.height = height
+        self.width = width
+        self.tile_size = tile_size
+        self.window = blend_window(tile_size, device, dtype)
+
+        padded_height, padded_width = max(height, tile_size), max(width, tile_size)
+        self.values = torch.zeros((padded_height, padded_width), device=device, dtype=dtype)
+        self.weights = torch.zeros((padded_height, padded_width), device=device, dtype=dtype)
+
+    def add(self, tile_map, y, x):
+        """Accumulate a [tile_size, tile_size] map at offset (y, x)."""
+        self.values[y:y + self.tile_size, x:x + self.tile_size] += tile_map * self.window
+        self.weights[y:y + self.tile_size, x:x + self.tile_size] += self.window
+
+    def result(self):
+        """Stitched map, zero where no tile was added."""
+        stitched = self.values / self.weights.clamp(min=1e-12)
+        return stitched[:self.height, :self.width]